@@ -1,16 +1,28 @@
-import os
 import datetime
-import json
+import os
 import re
-from flask import Flask, jsonify, request
+import tempfile
+import zipfile
+from flask import Flask, Response, jsonify, request, send_file, stream_with_context
 from flask_cors import CORS
 from werkzeug.security import check_password_hash, generate_password_hash
-from sqlalchemy import or_
-from sqlalchemy.orm import joinedload
-from database import Session, User, Notice, Schedule, Attendance
+from sqlalchemy.orm import defer, load_only
+from database import Session, User, Notice, Schedule, Attendance, pack_embeddings, check_embeddings
+from attendance_sync import ingest_attendance, MAX_RECORDS_PER_REQUEST, ACCEPTED, DUPLICATE, REJECTED
+from sync_feed import fetch_page, iter_page_json, gzip_chunks, DEFAULT_PAGE_SIZE, MAX_PAGE_SIZE
+from gallery_snapshots import refresh_snapshot
+from serializers import user_load_options, notice_load_options, json_response
+from response_cache import response_cache, cached_json_response, invalidate_shared
+from pagination import parse_page_args, apply_keyset, split_page, cache_key, NEXT_CURSOR_HEADER
+from attendance_rollups import student_summary, class_summary, department_summary
+from instrumentation import init_app as init_instrumentation, log
+from event_stream import events as events_blueprint, publish
+from enrollment import enroll_students, enroll_intake, enrollment_pool, MAX_IMAGES_PER_STUDENT, MAX_IMAGE_BYTES, STUDENT_ROLES
 
 app = Flask(__name__)
-CORS(app)
+CORS(app, expose_headers=[NEXT_CURSOR_HEADER])
+init_instrumentation(app)
+app.register_blueprint(events_blueprint)  # served by its own gevent service in production
 
 @app.route('/')
 def home():
@@ -18,27 +30,31 @@ def home():
 
 @app.route('/api/login', methods=['POST'])
 def login():
-    print("Login request received:", request.json)
+    log.debug("Login request")
     data = request.json
     db_session = Session()
     try:
-        user = db_session.query(User).filter_by(email=data.get('email')).first()
+        user = db_session.query(User).options(defer(User.embeddings)).filter_by(email=data.get('email')).first()
         if user and check_password_hash(user.password_hash, data.get('password')):
-            return jsonify(user.to_dict()), 200
+            return json_response(user.to_dict())
         return jsonify({'error': 'Invalid credentials'}), 401
     except Exception as e:
-        print(f"Error in login: {str(e)}")
+        log.exception("Error in login")
         return jsonify({'error': str(e)}), 500
     finally:
         db_session.close()
 
 @app.route('/api/signup', methods=['POST'])
 def signup():
-    print("Signup request received:", request.json)
+    log.debug("Signup request")
     data = request.json
+    try:
+        embeddings = pack_embeddings(check_embeddings(data.get('embeddings', [])))
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
     db_session = Session()
     try:
-        if db_session.query(User).filter_by(email=data.get('email')).first():
+        if db_session.query(User.id).filter_by(email=data.get('email')).first():
             return jsonify({'error': 'Email already exists'}), 409
         role = data.get('role', 'student')
         if role not in ['student', 'admin']:
@@ -50,84 +66,177 @@ def signup():
             department=data.get('department'),
             year=int(data.get('year')) if data.get('year') else None,
             role=role,
-            embeddings=json.dumps(data.get('embeddings', []))
+            embeddings=embeddings
         )
         db_session.add(new_user)
         db_session.commit()
-        return jsonify(new_user.to_dict()), 201
+        return json_response(new_user.to_dict(), 201)
     except Exception as e:
         db_session.rollback()
-        print(f"Error in signup: {str(e)}")
+        log.exception("Error in signup")
+        return jsonify({'error': str(e)}), 500
+    finally:
+        db_session.close()
+
+@app.route('/api/enroll/<int:user_id>', methods=['POST'])
+def enroll_user(user_id):
+    """Multipart upload of up to MAX_IMAGES_PER_STUDENT face images ('images'); replaces the user's embeddings."""
+    log.debug("Enrollment request for ID: %s", user_id)
+    files = request.files.getlist('images')
+    if not files:
+        return jsonify({'error': 'No images uploaded'}), 400
+    if len(files) > MAX_IMAGES_PER_STUDENT:
+        return jsonify({'error': f'At most {MAX_IMAGES_PER_STUDENT} images per student'}), 400
+    images = [(f.filename or f'image_{i}', f.read(MAX_IMAGE_BYTES + 1)) for i, f in enumerate(files)]
+    if any(len(data) > MAX_IMAGE_BYTES for _, data in images):
+        return jsonify({'error': f'Images must be under {MAX_IMAGE_BYTES // (1024 * 1024)} MB'}), 413
+    db_session = Session()
+    try:
+        user = db_session.get(User, user_id, options=[load_only(User.role)])
+        if not user or user.role not in STUDENT_ROLES:
+            return jsonify({'error': 'Student not found'}), 404
+        db_session.close()
+        with enrollment_pool() as pool:
+            report = enroll_students({user_id: images}, pool=pool)[0]
+        return json_response(report, 200 if report['status'] == 'enrolled' else 422)
+    except Exception as e:
+        log.exception("Error in enroll_user")
+        return jsonify({'error': str(e)}), 500
+    finally:
+        db_session.close()
+
+@app.route('/api/admin/enroll/<int:admin_id>', methods=['POST'])
+def enroll_batch(admin_id):
+    """Zip of <email or user id>/<image> folders ('intake') for students of the admin's department.
+
+    ?dry_run=1 checks the images without storing. Whole-college intakes are better run with enrollment.py.
+    """
+    log.debug("Batch enrollment request for admin ID: %s", admin_id)
+    upload = request.files.get('intake')
+    if upload is None:
+        return jsonify({'error': 'No intake zip uploaded'}), 400
+    db_session = Session()
+    try:
+        admin = db_session.get(User, admin_id, options=[load_only(User.role, User.department)])
+        if not admin or admin.role != 'admin':
+            return jsonify({'error': 'Admin not found or invalid privileges'}), 403
+        allowed = {row.id for row in db_session.query(User.id).filter(
+            User.department == admin.department, User.role.in_(STUDENT_ROLES)
+        )}
+        db_session.close()
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'intake.zip')
+            upload.save(path)
+            if not zipfile.is_zipfile(path):
+                return jsonify({'error': 'Intake must be a zip file'}), 400
+            with enrollment_pool() as pool:
+                reports = enroll_intake(path, dry_run=request.args.get('dry_run') == '1',
+                                        allowed=allowed, pool=pool)
+        enrolled = sum(1 for report in reports if report['status'] == 'enrolled')
+        return json_response({'enrolled': enrolled, 'rejected': len(reports) - enrolled, 'students': reports})
+    except Exception as e:
+        log.exception("Error in enroll_batch")
         return jsonify({'error': str(e)}), 500
     finally:
         db_session.close()
 
 @app.route('/api/admin/users/<int:admin_id>')
 def get_users_for_admin(admin_id):
-    print("Admin users request for ID:", admin_id)
+    log.debug("Admin users request for ID: %s", admin_id)
     db_session = Session()
     try:
-        admin = db_session.get(User, admin_id)
+        admin = db_session.get(User, admin_id, options=[load_only(User.role, User.department)])
         if not admin or admin.role != 'admin':
             return jsonify({'error': 'Admin not found or invalid privileges'}), 403
-        users = db_session.query(User).filter(User.department == admin.department, User.id != admin.id).all()
-        return jsonify([u.to_dict() for u in users]), 200
+        users = (
+            db_session.query(User)
+            .options(user_load_options('admin'))
+            .filter(User.department == admin.department, User.id != admin.id)
+            .all()
+        )
+        return json_response([u.to_dict('admin') for u in users])
     except Exception as e:
-        print(f"Error in get_users_for_admin: {str(e)}")
+        log.exception("Error in get_users_for_admin")
         return jsonify({'error': str(e)}), 500
     finally:
         db_session.close()
 
 @app.route('/api/admin/toggle_cr/<int:user_id>', methods=['POST'])
 def toggle_cr_status(user_id):
-    print("Toggle CR request for ID:", user_id)
+    log.debug("Toggle CR request for ID: %s", user_id)
     db_session = Session()
     try:
-        user = db_session.get(User, user_id)
+        user = db_session.get(User, user_id, options=[load_only(User.role, User.department)])
         if not user:
             return jsonify({'error': 'User not found'}), 404
         user.role = 'cr' if user.role == 'student' else 'student'
+        # Notices embed their author's role.
+        invalidate_shared(db_session, [('notices', user.department)])
         db_session.commit()
         return jsonify({'success': True, 'new_role': user.role}), 200
     except Exception as e:
         db_session.rollback()
-        print(f"Error in toggle_cr_status: {str(e)}")
+        log.exception("Error in toggle_cr_status")
         return jsonify({'error': str(e)}), 500
     finally:
         db_session.close()
 
+def user_scope(user_id):
+    """(department, year) of a user, cached; None if there is no such user."""
+    def load():
+        db_session = Session()
+        try:
+            user = db_session.get(User, user_id, options=[load_only(User.department, User.year)])
+            return (user.department, user.year) if user else None
+        finally:
+            db_session.close()
+    return response_cache.get_or_build(('user', user_id), load)
+
+def load_notices(department, year, page):
+    db_session = Session()
+    try:
+        # Department-wide notices and this year's, as two index range scans
+        # merged here; a single OR query would have to sort the whole history.
+        year_filters = [Notice.year == None] if year is None else [Notice.year == None, Notice.year == year]
+        notices = []
+        for year_filter in year_filters:
+            query = (
+                db_session.query(Notice)
+                .options(*notice_load_options())
+                .filter(Notice.department == department, year_filter)
+            )
+            notices.extend(apply_keyset(query, Notice.timestamp, Notice.id, page).all())
+        notices.sort(key=lambda n: (n.timestamp, n.id), reverse=True)
+        notices, headers = split_page(notices, page.limit)
+        return [n.to_dict() for n in notices], headers
+    finally:
+        db_session.close()
+
 @app.route('/api/notices/<int:user_id>')
 def get_notices(user_id):
-    print("Notices request for user ID:", user_id)
-    db_session = Session()
+    log.debug("Notices request for user ID: %s", user_id)
     try:
-        user = db_session.get(User, user_id)
-        if not user:
+        page = parse_page_args(request.args)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    try:
+        scope = user_scope(user_id)
+        if scope is None:
             return jsonify({'error': 'User not found'}), 404
-        notices = (
-            db_session.query(Notice)
-            .options(joinedload(Notice.author))
-            .filter(
-                Notice.department == user.department,
-                or_(Notice.year == None, Notice.year == user.year)
-            )
-            .order_by(Notice.timestamp.desc())
-            .all()
-        )
-        return jsonify([n.to_dict() for n in notices]), 200
+        department, year = scope
+        return cached_json_response(('notices', department, year) + cache_key(page),
+                                    lambda: load_notices(department, year, page))
     except Exception as e:
-        print(f"Error in get_notices: {str(e)}")
+        log.exception("Error in get_notices")
         return jsonify({'error': str(e)}), 500
-    finally:
-        db_session.close()
 
 @app.route('/api/notices', methods=['POST'])
 def send_notice():
-    print("Send notice request:", request.json)
+    log.debug("Send notice request")
     data = request.json
     db_session = Session()
     try:
-        author = db_session.get(User, data.get('author_id'))
+        author = db_session.get(User, data.get('author_id'), options=[defer(User.embeddings)])
         if not author or author.role not in ['admin', 'cr']:
             return jsonify({'error': 'Unauthorized'}), 403
         new_notice = Notice(
@@ -137,38 +246,47 @@ def send_notice():
             author_id=author.id
         )
         db_session.add(new_notice)
+        db_session.flush()
+        notice = new_notice.to_dict()
+        publish(db_session, 'notice', new_notice.department, new_notice.year, notice)
+        invalidate_shared(db_session, [('notices', new_notice.department)])
         db_session.commit()
-        return jsonify(new_notice.to_dict()), 201
+        return json_response(notice, 201)
     except Exception as e:
         db_session.rollback()
-        print(f"Error in send_notice: {str(e)}")
+        log.exception("Error in send_notice")
         return jsonify({'error': str(e)}), 500
     finally:
         db_session.close()
 
+def load_schedules(department, year):
+    db_session = Session()
+    try:
+        schedules = db_session.query(Schedule).filter_by(department=department, year=year).all()
+        return [s.to_dict() for s in schedules]
+    finally:
+        db_session.close()
+
 @app.route('/api/schedules/<int:user_id>')
 def get_schedules(user_id):
-    print("Schedules request for user ID:", user_id)
-    db_session = Session()
+    log.debug("Schedules request for user ID: %s", user_id)
     try:
-        user = db_session.get(User, user_id)
-        if not user:
+        scope = user_scope(user_id)
+        if scope is None:
             return jsonify({'error': 'User not found'}), 404
-        schedules = db_session.query(Schedule).filter_by(department=user.department, year=user.year).all()
-        return jsonify([s.to_dict() for s in schedules]), 200
+        department, year = scope
+        return cached_json_response(('schedules', department, year), lambda: load_schedules(department, year))
     except Exception as e:
-        print(f"Error in get_schedules: {str(e)}")
+        log.exception("Error in get_schedules")
         return jsonify({'error': str(e)}), 500
-    finally:
-        db_session.close()
 
 @app.route('/api/schedules', methods=['POST'])
 def add_schedule():
-    print("Add schedule request:", request.json)
+    log.debug("Add schedule request")
     data = request.json
     db_session = Session()
     try:
-        author = db_session.get(User, data.get('author_id'))
+        author = db_session.get(User, data.get('author_id'), options=[defer(User.embeddings)])
         if not author or author.role != 'cr':
             return jsonify({'error': 'Unauthorized'}), 403
 
@@ -223,68 +341,158 @@ def add_schedule():
             cr_author_id=author.id
         )
         db_session.add(new_schedule)
+        db_session.flush()
+        schedule = new_schedule.to_dict()
+        publish(db_session, 'schedule', new_schedule.department, new_schedule.year, schedule)
+        invalidate_shared(db_session, [('schedules', new_schedule.department, new_schedule.year)])
         db_session.commit()
-        return jsonify(new_schedule.to_dict()), 201
+        return json_response(schedule, 201)
     except Exception as e:
         db_session.rollback()
-        print(f"Error in add_schedule: {str(e)}")
+        log.exception("Error in add_schedule")
         return jsonify({'error': str(e)}), 500
     finally:
         db_session.close()
 
+def load_attendance(user_id, page):
+    db_session = Session()
+    try:
+        query = db_session.query(Attendance).filter_by(user_id=user_id)
+        attendance_records, headers = split_page(apply_keyset(query, Attendance.timestamp, Attendance.id, page).all(), page.limit)
+        return [rec.to_dict() for rec in attendance_records], headers
+    finally:
+        db_session.close()
+
 @app.route('/api/attendance/<int:user_id>')
 def get_attendance(user_id):
-    print("Attendance request for user ID:", user_id)
-    db_session = Session()
+    log.debug("Attendance request for user ID: %s", user_id)
     try:
-        user = db_session.get(User, user_id)
-        if not user:
+        page = parse_page_args(request.args)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    try:
+        if user_scope(user_id) is None:
+            return jsonify({'error': 'User not found'}), 404
+        return cached_json_response(('attendance', user_id) + cache_key(page), lambda: load_attendance(user_id, page))
+    except Exception as e:
+        log.exception("Error in get_attendance")
+        return jsonify({'error': str(e)}), 500
+
+PERIOD_PATTERN = re.compile(r'^\d{4}-\d{2}$')
+
+def summary_period():
+    """Optional ?period=YYYY-MM; raises ValueError when malformed."""
+    period = request.args.get('period') or None
+    if period and not PERIOD_PATTERN.match(period):
+        raise ValueError('period must be YYYY-MM')
+    return period
+
+@app.route('/api/attendance/summary/<int:user_id>')
+def get_student_attendance_summary(user_id):
+    log.debug("Attendance summary request for user ID: %s", user_id)
+    try:
+        period = summary_period()
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    try:
+        summary = student_summary(user_id, period)
+        if summary is None:
             return jsonify({'error': 'User not found'}), 404
-        attendance_records = db_session.query(Attendance).filter_by(user_id=user_id).all()
-        return jsonify([rec.to_dict() for rec in attendance_records]), 200
+        return json_response(summary)
     except Exception as e:
-        print(f"Error in get_attendance: {str(e)}")
+        log.exception("Error in get_student_attendance_summary")
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/api/admin/attendance/summary/<int:admin_id>')
+def get_department_attendance_summary(admin_id):
+    log.debug("Department attendance summary request for ID: %s", admin_id)
+    try:
+        period = summary_period()
+        year = int(request.args['year']) if request.args.get('year') else None
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    db_session = Session()
+    try:
+        admin = db_session.get(User, admin_id, options=[load_only(User.role, User.department)])
+        if not admin or admin.role != 'admin':
+            return jsonify({'error': 'Admin not found or invalid privileges'}), 403
+        return json_response(department_summary(admin.department, year, period))
+    except Exception as e:
+        log.exception("Error in get_department_attendance_summary")
+        return jsonify({'error': str(e)}), 500
+    finally:
+        db_session.close()
+
+@app.route('/api/attendance/summary/class/<int:requester_id>')
+def get_class_attendance_summary(requester_id):
+    """?subject=..[&year=..]: admins see any year of their department, CRs their own class."""
+    log.debug("Class attendance summary request for ID: %s", requester_id)
+    subject = request.args.get('subject')
+    if not subject:
+        return jsonify({'error': 'subject is required'}), 400
+    try:
+        period = summary_period()
+        year = int(request.args['year']) if request.args.get('year') else None
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    db_session = Session()
+    try:
+        requester = db_session.get(User, requester_id, options=[load_only(User.role, User.department, User.year)])
+        if not requester or requester.role not in ['admin', 'cr']:
+            return jsonify({'error': 'Unauthorized'}), 403
+        if requester.role == 'cr':
+            year = requester.year
+        elif year is None:
+            return jsonify({'error': 'year is required'}), 400
+        summary = class_summary(requester.department, year, subject, period)
+        if summary is None:
+            return jsonify({'error': 'No such subject for this class'}), 404
+        return json_response(summary)
+    except Exception as e:
+        log.exception("Error in get_class_attendance_summary")
         return jsonify({'error': str(e)}), 500
     finally:
         db_session.close()
 
 @app.route('/api/sync/attendance', methods=['POST'])
 def sync_attendance():
-    print("Sync attendance request:", request.json)
-    data = request.json
+    data = request.get_json(silent=True) or {}
     records = data.get('records', [])
+    # Older clients send no device id; their records are stored but cannot be deduplicated.
+    device_id = data.get('device_id') or request.headers.get('X-Device-Id')
+    log.debug("Sync attendance request: %d record(s) from device %s", len(records), device_id)
     if not records:
         return jsonify({'error': 'No records to sync'}), 400
-    db_session = Session()
+    if not isinstance(records, list) or len(records) > MAX_RECORDS_PER_REQUEST:
+        return jsonify({'error': f'records must be a list of at most {MAX_RECORDS_PER_REQUEST} items'}), 400
     try:
-        for rec in records:
-            new_attendance = Attendance(
-                user_id=rec['user_id'],
-                schedule_id=rec['schedule_id'],
-                timestamp=datetime.datetime.fromisoformat(rec['timestamp']),
-                status=rec.get('status', 'present')
-            )
-            db_session.add(new_attendance)
-        db_session.commit()
-        return jsonify({'success': True, 'synced_records': len(records)}), 200
+        results = ingest_attendance(device_id, records)
+        counts = {status: 0 for status in (ACCEPTED, DUPLICATE, REJECTED)}
+        for result in results:
+            counts[result['status']] += 1
+        return jsonify({
+            'success': True,
+            'synced_records': counts[ACCEPTED] + counts[DUPLICATE],
+            'accepted': counts[ACCEPTED],
+            'duplicates': counts[DUPLICATE],
+            'rejected': counts[REJECTED],
+            'results': results
+        }), 200
     except Exception as e:
-        db_session.rollback()
-        print(f"Error in sync_attendance: {str(e)}")
+        log.exception("Error in sync_attendance")
         return jsonify({'error': f'Failed to sync attendance: {e}'}), 500
-    finally:
-        db_session.close()
 
 @app.route('/api/sync/get_updates', methods=['GET'])
 def get_updates():
-    print("Get updates request with last_sync_time:", request.args.get('last_sync_time'))
+    log.debug("Get updates request with last_sync_time: %s", request.args.get('last_sync_time'))
     last_sync_time_str = request.args.get('last_sync_time')
     db_session = Session()
     try:
         last_sync_time = datetime.datetime.fromisoformat(last_sync_time_str) if last_sync_time_str else datetime.datetime(1970, 1, 1)
-        updated_users = db_session.query(User).filter(User.updated_at > last_sync_time).all()
+        updated_users = db_session.query(User).options(user_load_options('sync')).filter(User.updated_at > last_sync_time).all()
         updated_schedules = db_session.query(Schedule).filter(Schedule.updated_at > last_sync_time).all()
         updates = {
-            'users': [user.to_dict() for user in updated_users],
+            'users': [user.to_sync_dict() for user in updated_users],
             'schedules': [schedule.to_dict() for schedule in updated_schedules]
         }
         return jsonify({
@@ -292,13 +500,59 @@ def get_updates():
             'server_time': datetime.datetime.utcnow().isoformat()
         }), 200
     except Exception as e:
-        print(f"Error in get_updates: {str(e)}")
+        log.exception("Error in get_updates")
         return jsonify({'error': str(e)}), 500
     finally:
         db_session.close()
 
+@app.route('/api/sync/changes', methods=['GET'])
+def get_changes():
+    """Paginated change feed: ?cursor=<seq>&limit=<n>[&department=..][&year=..]."""
+    try:
+        cursor = int(request.args.get('cursor', 0))
+        limit = min(max(int(request.args.get('limit', DEFAULT_PAGE_SIZE)), 1), MAX_PAGE_SIZE)
+        year = int(request.args['year']) if request.args.get('year') else None
+    except ValueError:
+        return jsonify({'error': 'cursor, limit and year must be integers'}), 400
+    department = request.args.get('department') or None
+    log.debug("Get changes request: cursor=%s limit=%s department=%s year=%s", cursor, limit, department, year)
+    try:
+        changes, has_more, next_cursor = fetch_page(cursor, limit, department, year)
+    except Exception as e:
+        log.exception("Error in get_changes")
+        return jsonify({'error': str(e)}), 500
+
+    body = iter_page_json(changes, has_more, next_cursor)
+    headers = {}
+    if 'gzip' in request.headers.get('Accept-Encoding', '') and request.args.get('gzip', '1') != '0':
+        body = gzip_chunks(body)
+        headers['Content-Encoding'] = 'gzip'
+    return Response(stream_with_context(body), mimetype='application/json', headers=headers)
+
+@app.route('/api/sync/gallery', methods=['GET'])
+def get_gallery_snapshot():
+    """Binary gallery snapshot for ?department=..&year=..; 304 when the client's ETag is current."""
+    try:
+        year = int(request.args['year']) if request.args.get('year') else None
+    except ValueError:
+        return jsonify({'error': 'year must be an integer'}), 400
+    department = request.args.get('department') or None
+    try:
+        path, snapshot = refresh_snapshot(department, year)
+    except Exception as e:
+        log.exception("Error in get_gallery_snapshot")
+        return jsonify({'error': str(e)}), 500
+    response = send_file(path, mimetype='application/octet-stream', etag=snapshot.etag,
+                         conditional=True, max_age=0)
+    response.headers['X-Gallery-Version'] = str(snapshot.version)
+    return response
+
+@app.route('/api/cache/stats', methods=['GET'])
+def get_cache_stats():
+    return jsonify(response_cache.stats()), 200
+
 if __name__ == '__main__':
-    if not os.path.exists('main_database.db'):
-        from database import create_db
-        create_db()
+    # Creates a fresh database or brings an existing one up to the current schema.
+    from database import create_db
+    create_db()
     app.run(host='0.0.0.0', port=5000, debug=True)
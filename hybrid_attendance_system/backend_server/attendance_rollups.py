@@ -0,0 +1,264 @@
+"""
+Attendance rollups for the summary endpoints.
+
+attendance_rollups holds, per (student, schedule slot, month), the number of
+distinct days the student was recorded present; session_rollups holds, per
+(schedule slot, month), the number of distinct days the slot was held at all
+(any attendance recorded). Summaries group slots by subject and read only
+these tables, so their cost depends on the number of subjects and months, not
+on how much attendance has been stored.
+
+ingest_attendance() calls record_new_attendance() inside each chunk's
+transaction, before the chunk is inserted, so only attendance that is new for
+that student/slot/day is counted.
+
+    python attendance_rollups.py --rebuild    # recompute both tables from attendance
+"""
+import argparse
+import datetime
+from collections import defaultdict
+
+from sqlalchemy import select, func, delete, text
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+
+from database import engine, Attendance, AttendanceRollup, SessionRollup, Schedule, User
+
+STUDENT_ROLES = ('student', 'cr')
+
+
+def period_of(timestamp):
+    return timestamp.strftime('%Y-%m')
+
+
+def _upsert(connection, table, key_columns, rows, counter, extra_set=None):
+    statement = sqlite_insert(table)
+    set_ = {counter: table.c[counter] + statement.excluded[counter]}
+    set_.update(extra_set(statement) if extra_set else {})
+    connection.execute(statement.on_conflict_do_update(index_elements=key_columns, set_=set_), rows)
+
+
+def record_new_attendance(connection, rows):
+    """Add attendance rows that are about to be inserted (dicts with user_id, schedule_id, timestamp) to the rollups."""
+    if not rows:
+        return
+    days = [row['timestamp'].date() for row in rows]
+    start = datetime.datetime.combine(min(days), datetime.time())
+    end = datetime.datetime.combine(max(days), datetime.time()) + datetime.timedelta(days=1)
+    user_ids = {row['user_id'] for row in rows}
+    schedule_ids = {row['schedule_id'] for row in rows}
+
+    day = func.date(Attendance.timestamp)
+    seen_presence = set(connection.execute(
+        select(Attendance.user_id, Attendance.schedule_id, day)
+        .where(Attendance.user_id.in_(user_ids), Attendance.timestamp >= start, Attendance.timestamp < end)
+        .distinct()
+    ).all())
+    seen_sessions = set(connection.execute(
+        select(Attendance.schedule_id, day)
+        .where(Attendance.schedule_id.in_(schedule_ids), Attendance.timestamp >= start, Attendance.timestamp < end)
+        .distinct()
+    ).all())
+    slots = {row.id: (row.department, row.year) for row in connection.execute(
+        select(Schedule.id, Schedule.department, Schedule.year).where(Schedule.id.in_(schedule_ids))
+    )}
+
+    present = defaultdict(lambda: [0, None])
+    sessions = defaultdict(int)
+    for row in rows:
+        user_id, schedule_id, timestamp = row['user_id'], row['schedule_id'], row['timestamp']
+        day_key, period = timestamp.date().isoformat(), period_of(timestamp)
+        counts = present[(user_id, schedule_id, period)]
+        counts[1] = max(counts[1], timestamp) if counts[1] else timestamp
+        if (user_id, schedule_id, day_key) not in seen_presence:
+            seen_presence.add((user_id, schedule_id, day_key))
+            counts[0] += 1
+        if (schedule_id, day_key) not in seen_sessions:
+            seen_sessions.add((schedule_id, day_key))
+            sessions[(schedule_id, period)] += 1
+
+    _upsert(connection, AttendanceRollup.__table__, ['user_id', 'schedule_id', 'period'], [
+        {'user_id': user_id, 'schedule_id': schedule_id, 'period': period,
+         'department': slots[schedule_id][0], 'year': slots[schedule_id][1],
+         'present_days': count, 'last_present': last}
+        for (user_id, schedule_id, period), (count, last) in present.items()
+    ], 'present_days', lambda statement: {'last_present': func.max(
+        func.coalesce(AttendanceRollup.__table__.c.last_present, statement.excluded.last_present),
+        statement.excluded.last_present
+    )})
+    if sessions:
+        _upsert(connection, SessionRollup.__table__, ['schedule_id', 'period'], [
+            {'schedule_id': schedule_id, 'period': period, 'department': slots[schedule_id][0],
+             'year': slots[schedule_id][1], 'sessions': count}
+            for (schedule_id, period), count in sessions.items()
+        ], 'sessions')
+
+
+def rebuild_rollups():
+    """Recompute both rollup tables from the attendance table in one transaction."""
+    with engine.begin() as connection:
+        connection.execute(delete(AttendanceRollup))
+        connection.execute(delete(SessionRollup))
+        connection.execute(text(
+            "INSERT INTO attendance_rollups (user_id, schedule_id, period, department, year, present_days, last_present) "
+            "SELECT a.user_id, a.schedule_id, strftime('%Y-%m', a.timestamp), s.department, s.year, "
+            "COUNT(DISTINCT date(a.timestamp)), MAX(a.timestamp) "
+            "FROM attendance a JOIN schedules s ON s.id = a.schedule_id "
+            "WHERE a.user_id IS NOT NULL "
+            "GROUP BY a.user_id, a.schedule_id, strftime('%Y-%m', a.timestamp)"
+        ))
+        connection.execute(text(
+            "INSERT INTO session_rollups (schedule_id, period, department, year, sessions) "
+            "SELECT a.schedule_id, strftime('%Y-%m', a.timestamp), s.department, s.year, COUNT(DISTINCT date(a.timestamp)) "
+            "FROM attendance a JOIN schedules s ON s.id = a.schedule_id "
+            "GROUP BY a.schedule_id, strftime('%Y-%m', a.timestamp)"
+        ))
+        students = connection.execute(select(func.count()).select_from(AttendanceRollup)).scalar()
+        slots = connection.execute(select(func.count()).select_from(SessionRollup)).scalar()
+    print(f"Rebuilt attendance rollups: {students} student rows, {slots} session rows.")
+
+
+def _percentage(present, possible):
+    return round(100.0 * present / possible, 1) if possible else None
+
+
+def _period_filter(query, column, period):
+    return query.where(column == period) if period else query
+
+
+def student_summary(user_id, period=None):
+    """Per-subject present days vs sessions held for one student, or None if there is no such user."""
+    with engine.connect() as connection:
+        user = connection.execute(select(User.department, User.year).where(User.id == user_id)).first()
+        if user is None:
+            return None
+        subjects = dict(connection.execute(
+            select(Schedule.id, Schedule.subject_name).where(Schedule.department == user.department, Schedule.year == user.year)
+        ).all())
+        held = connection.execute(_period_filter(
+            select(SessionRollup.schedule_id, func.sum(SessionRollup.sessions))
+            .where(SessionRollup.department == user.department, SessionRollup.year == user.year),
+            SessionRollup.period, period
+        ).group_by(SessionRollup.schedule_id)).all()
+        attended = connection.execute(_period_filter(
+            select(AttendanceRollup.schedule_id, func.sum(AttendanceRollup.present_days), func.max(AttendanceRollup.last_present))
+            .where(AttendanceRollup.user_id == user_id),
+            AttendanceRollup.period, period
+        ).group_by(AttendanceRollup.schedule_id)).all()
+
+    by_subject = {name: {'subject': name, 'sessions': 0, 'present': 0, 'last_present': None} for name in subjects.values()}
+    for schedule_id, count in held:
+        if schedule_id in subjects:
+            by_subject[subjects[schedule_id]]['sessions'] += count
+    for schedule_id, count, last in attended:
+        if schedule_id in subjects:
+            entry = by_subject[subjects[schedule_id]]
+            entry['present'] += count
+            if last is not None:
+                last = last.isoformat() if isinstance(last, datetime.datetime) else str(last)
+                entry['last_present'] = max(entry['last_present'] or last, last)
+    for entry in by_subject.values():
+        entry['percentage'] = _percentage(entry['present'], entry['sessions'])
+    sessions = sum(entry['sessions'] for entry in by_subject.values())
+    present = sum(entry['present'] for entry in by_subject.values())
+    return {
+        'user_id': user_id,
+        'department': user.department,
+        'year': user.year,
+        'period': period,
+        'subjects': sorted(by_subject.values(), key=lambda entry: entry['subject']),
+        'overall': {'sessions': sessions, 'present': present, 'percentage': _percentage(present, sessions)},
+    }
+
+
+def class_summary(department, year, subject, period=None):
+    """Per-student present days for one subject of a department/year, or None if no such subject is scheduled."""
+    with engine.connect() as connection:
+        schedule_ids = list(connection.scalars(select(Schedule.id).where(
+            Schedule.department == department, Schedule.year == year, Schedule.subject_name == subject
+        )))
+        if not schedule_ids:
+            return None
+        sessions = connection.execute(_period_filter(
+            select(func.coalesce(func.sum(SessionRollup.sessions), 0)).where(SessionRollup.schedule_id.in_(schedule_ids)),
+            SessionRollup.period, period
+        )).scalar()
+        attended = {row[0]: row[1:] for row in connection.execute(_period_filter(
+            select(AttendanceRollup.user_id, func.sum(AttendanceRollup.present_days), func.max(AttendanceRollup.last_present))
+            .where(AttendanceRollup.department == department, AttendanceRollup.year == year,
+                   AttendanceRollup.schedule_id.in_(schedule_ids)),
+            AttendanceRollup.period, period
+        ).group_by(AttendanceRollup.user_id))}
+        students = connection.execute(
+            select(User.id, User.name)
+            .where(User.department == department, User.year == year, User.role.in_(STUDENT_ROLES))
+            .order_by(User.name)
+        ).all()
+
+    rows = []
+    for user_id, name in students:
+        present, last = attended.get(user_id, (0, None))
+        rows.append({
+            'user_id': user_id,
+            'name': name,
+            'present': present,
+            'percentage': _percentage(present, sessions),
+            'last_present': last.isoformat() if isinstance(last, datetime.datetime) else last,
+        })
+    total_present = sum(row['present'] for row in rows)
+    return {
+        'department': department,
+        'year': year,
+        'subject': subject,
+        'period': period,
+        'sessions': sessions,
+        'average_percentage': _percentage(total_present, sessions * len(rows)),
+        'students': rows,
+    }
+
+
+def department_summary(department, year=None, period=None):
+    """Per-(year, subject) attendance totals for a department."""
+    with engine.connect() as connection:
+        query = select(Schedule.id, Schedule.year, Schedule.subject_name).where(Schedule.department == department)
+        if year is not None:
+            query = query.where(Schedule.year == year)
+        slots = {row.id: (row.year, row.subject_name) for row in connection.execute(query)}
+
+        held = select(SessionRollup.schedule_id, func.sum(SessionRollup.sessions)).where(SessionRollup.department == department)
+        attended = select(AttendanceRollup.schedule_id, func.sum(AttendanceRollup.present_days)).where(AttendanceRollup.department == department)
+        enrolled = select(User.year, func.count()).where(User.department == department, User.role.in_(STUDENT_ROLES))
+        if year is not None:
+            held = held.where(SessionRollup.year == year)
+            attended = attended.where(AttendanceRollup.year == year)
+            enrolled = enrolled.where(User.year == year)
+        held = connection.execute(_period_filter(held, SessionRollup.period, period).group_by(SessionRollup.schedule_id)).all()
+        attended = connection.execute(_period_filter(attended, AttendanceRollup.period, period).group_by(AttendanceRollup.schedule_id)).all()
+        enrolled = dict(connection.execute(enrolled.group_by(User.year)).all())
+
+    classes = {}
+    for schedule_id, (slot_year, subject) in slots.items():
+        classes.setdefault((slot_year, subject), {
+            'year': slot_year, 'subject': subject, 'sessions': 0, 'present': 0, 'students': enrolled.get(slot_year, 0)
+        })
+    for rows, field in ((held, 'sessions'), (attended, 'present')):
+        for schedule_id, count in rows:
+            if schedule_id in slots:
+                classes[slots[schedule_id]][field] += count
+    for entry in classes.values():
+        entry['average_percentage'] = _percentage(entry['present'], entry['sessions'] * entry['students'])
+    return {
+        'department': department,
+        'year': year,
+        'period': period,
+        'classes': sorted(classes.values(), key=lambda entry: (entry['year'] or 0, entry['subject'])),
+    }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Attendance rollup maintenance.")
+    parser.add_argument('--rebuild', action='store_true', help="recompute the rollups from the attendance table")
+    args = parser.parse_args()
+    if args.rebuild:
+        rebuild_rollups()
+    else:
+        parser.print_help()
@@ -0,0 +1,112 @@
+"""
+Bulk, idempotent ingestion of attendance pushed by classroom devices.
+
+Records are identified by (device_id, client record id). Each chunk of
+SYNC_CHUNK_SIZE records is validated and written in its own short transaction
+with a single executemany-style INSERT ... ON CONFLICT DO NOTHING, so a
+backlog of tens of thousands of rows never holds the SQLite writer for long
+and a retried push simply reports the already stored rows as duplicates. The
+attendance rollups, and the cached attendance of the students concerned, are
+updated in the same transaction.
+"""
+import datetime
+
+from sqlalchemy import select
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+
+from database import engine, Attendance, User, Schedule
+from attendance_rollups import record_new_attendance
+from response_cache import invalidate_shared
+
+SYNC_CHUNK_SIZE = 500
+MAX_RECORDS_PER_REQUEST = 50000
+
+ACCEPTED = 'accepted'
+DUPLICATE = 'duplicate'
+REJECTED = 'rejected'
+
+
+def _parse_record(rec):
+    """Return (row, error) for one pushed record."""
+    if not isinstance(rec, dict):
+        return None, 'record must be an object'
+    try:
+        user_id = int(rec['user_id'])
+        schedule_id = int(rec['schedule_id'])
+        timestamp = datetime.datetime.fromisoformat(rec['timestamp'])
+    except KeyError as e:
+        return None, f'missing field {e.args[0]}'
+    except (TypeError, ValueError) as e:
+        return None, f'invalid value: {e}'
+    status = rec.get('status', 'present')
+    if not isinstance(status, str) or len(status) > 10:
+        return None, 'invalid status'
+    client_id = rec.get('id')
+    if client_id is not None and not isinstance(client_id, int):
+        return None, 'id must be an integer'
+    return {
+        'user_id': user_id,
+        'schedule_id': schedule_id,
+        'timestamp': timestamp,
+        'status': status,
+        'client_record_id': client_id,
+    }, None
+
+
+def ingest_attendance(device_id, records, chunk_size=SYNC_CHUNK_SIZE):
+    """Store pushed records; returns one {'id', 'status'[, 'error']} result per record, in order."""
+    results = []
+    for start in range(0, len(records), chunk_size):
+        results.extend(_ingest_chunk(device_id, records[start:start + chunk_size]))
+    return results
+
+
+def _ingest_chunk(device_id, records):
+    results = [None] * len(records)
+    parsed = []
+    for i, rec in enumerate(records):
+        row, error = _parse_record(rec)
+        if error:
+            results[i] = {'id': rec.get('id') if isinstance(rec, dict) else None, 'status': REJECTED, 'error': error}
+        else:
+            row['device_id'] = device_id
+            parsed.append((i, row))
+
+    with engine.begin() as connection:
+        user_ids = {row['user_id'] for _, row in parsed}
+        schedule_ids = {row['schedule_id'] for _, row in parsed}
+        known_users = set(connection.scalars(select(User.id).where(User.id.in_(user_ids)))) if user_ids else set()
+        known_schedules = set(connection.scalars(select(Schedule.id).where(Schedule.id.in_(schedule_ids)))) if schedule_ids else set()
+
+        keyed = [row['client_record_id'] for _, row in parsed if row['client_record_id'] is not None]
+        stored = set()
+        if device_id is not None and keyed:
+            stored = set(connection.scalars(
+                select(Attendance.client_record_id)
+                .where(Attendance.device_id == device_id, Attendance.client_record_id.in_(keyed))
+            ))
+
+        to_insert = []
+        for i, row in parsed:
+            client_id = row['client_record_id']
+            if row['user_id'] not in known_users:
+                results[i] = {'id': client_id, 'status': REJECTED, 'error': 'unknown user_id'}
+            elif row['schedule_id'] not in known_schedules:
+                results[i] = {'id': client_id, 'status': REJECTED, 'error': 'unknown schedule_id'}
+            elif device_id is not None and client_id is not None and client_id in stored:
+                results[i] = {'id': client_id, 'status': DUPLICATE}
+            else:
+                if device_id is not None and client_id is not None:
+                    stored.add(client_id)  # a repeat inside the same push
+                to_insert.append(row)
+                results[i] = {'id': client_id, 'status': ACCEPTED}
+
+        if to_insert:
+            # Before the insert: the rollups count days that were not yet recorded.
+            record_new_attendance(connection, to_insert)
+            statement = sqlite_insert(Attendance.__table__).on_conflict_do_nothing(
+                index_elements=['device_id', 'client_record_id']
+            )
+            connection.execute(statement, to_insert)
+            invalidate_shared(connection, {('attendance', row['user_id']) for row in to_insert})
+    return results
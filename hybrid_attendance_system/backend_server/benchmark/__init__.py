@@ -0,0 +1,7 @@
+"""
+Synthetic data and load testing for the backend.
+
+    python benchmark/seed.py --reset --departments 4 --years 4
+    python benchmark/load_test.py --concurrency 16 --duration 60 --label before-change
+    python benchmark/load_test.py --concurrency 16 --duration 60 --compare benchmark/baselines/before-change.json
+"""
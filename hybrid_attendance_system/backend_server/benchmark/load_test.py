@@ -0,0 +1,288 @@
+"""
+Repeatable load test for the backend API.
+
+`--concurrency` worker threads, each with its own keep-alive session, drive a
+weighted mix of login, get_notices, get_schedules, get_attendance,
+sync_attendance and get_updates for `--duration` seconds (after `--warmup`
+seconds that are not recorded). Users and schedules are sampled from the
+database with a fixed seed, so two runs against the same seeded database
+issue the same kind of traffic. sync_attendance writes real rows, tagged with a
+device id unique to the run.
+
+Without --url the app is served in-process by werkzeug's threaded server;
+for numbers closer to production start gunicorn yourself and pass --url.
+Each run is saved as JSON under benchmark/baselines/ (throughput, p50/p95/p99
+per operation, database size); --compare exits 1 if an operation's p95 or
+throughput regressed beyond --tolerance.
+
+    python benchmark/load_test.py --concurrency 16 --duration 60 --label v1
+    python benchmark/load_test.py --url http://127.0.0.1:8000 --compare benchmark/baselines/v1.json
+"""
+import argparse
+import datetime
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import threading
+import time
+import uuid
+from collections import defaultdict
+
+import numpy as np
+import requests
+
+OPERATIONS = {
+    'login': 5,
+    'get_notices': 30,
+    'get_schedules': 20,
+    'get_attendance': 20,
+    'sync_attendance': 10,
+    'get_updates': 15,
+}
+BASELINE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'baselines')
+FIXTURE_USERS = 2000
+SYNC_BATCH_SIZE = 20
+UPDATES_WINDOW = 3600  # get_updates asks for changes in the last hour, as a kiosk would
+REQUEST_TIMEOUT = 30
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Load test the backend API.")
+    parser.add_argument('--url', help="server to test (default: serve the app in-process)")
+    parser.add_argument('--db', help="database file (default: ATTENDANCE_DB_PATH or main_database.db)")
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--duration', type=float, default=30, help="measured seconds")
+    parser.add_argument('--warmup', type=float, default=5, help="unmeasured seconds before that")
+    parser.add_argument('--mix', help="operation weights, e.g. get_notices=50,login=0")
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--label', help="baseline file name (default: timestamp)")
+    parser.add_argument('--compare', metavar='BASELINE', help="baseline JSON to compare against")
+    parser.add_argument('--tolerance', type=float, default=0.2, help="allowed p95/throughput regression (0.2 = 20%%)")
+    return parser.parse_args(argv)
+
+
+def parse_mix(value):
+    mix = dict(OPERATIONS)
+    for part in filter(None, (value or '').split(',')):
+        name, weight = part.split('=')
+        if name not in OPERATIONS:
+            raise SystemExit(f"Unknown operation {name!r}; choose from {', '.join(OPERATIONS)}")
+        mix[name] = float(weight)
+    return {name: weight for name, weight in mix.items() if weight > 0}
+
+
+def load_fixtures(seed):
+    from sqlalchemy import select, func
+    from database import engine, User, Schedule, Notice, Attendance
+    with engine.connect() as connection:
+        students = connection.execute(
+            select(User.id, User.email, User.department, User.year)
+            .where(User.role.in_(('student', 'cr')), User.year.isnot(None)).order_by(User.id)
+        ).all()
+        schedules = connection.execute(select(Schedule.id, Schedule.department, Schedule.year)).all()
+        dataset = {
+            'users': connection.execute(select(func.count()).select_from(User)).scalar(),
+            'schedules': len(schedules),
+            'notices': connection.execute(select(func.count()).select_from(Notice)).scalar(),
+            'attendance': connection.execute(select(func.count()).select_from(Attendance)).scalar(),
+        }
+    if not students or not schedules:
+        raise SystemExit("No students or schedules in the database; run benchmark/seed.py first.")
+    rng = random.Random(seed)
+    sample = rng.sample(students, min(FIXTURE_USERS, len(students)))
+    by_class = defaultdict(list)
+    for schedule_id, department, year in schedules:
+        by_class[(department, year)].append(schedule_id)
+    classmates = defaultdict(list)
+    for user_id, _, department, year in students:
+        classmates[(department, year)].append(user_id)
+    return sample, by_class, classmates, dataset
+
+
+def db_size(path):
+    return sum(os.path.getsize(path + suffix) for suffix in ('', '-wal') if os.path.exists(path + suffix))
+
+
+class Worker(threading.Thread):
+    def __init__(self, index, base_url, fixtures, mix, seed, run_id, measure_from, stop_at, results):
+        super().__init__(daemon=True)
+        self.base_url = base_url
+        self.students, self.by_class, self.classmates = fixtures
+        self.names, self.weights = list(mix), list(mix.values())
+        self.rng = random.Random(seed * 1000 + index)
+        self.device_id = f'bench-{run_id}-{index}'
+        self.next_record = 1
+        self.measure_from, self.stop_at = measure_from, stop_at
+        self.results = results  # operation -> list of (latency ms, status)
+        self.session = requests.Session()
+
+    def request(self, operation):
+        user_id, email, department, year = self.rng.choice(self.students)
+        url = self.base_url
+        if operation == 'login':
+            return self.session.post(f'{url}/api/login', json={'email': email, 'password': 'benchmark'}, timeout=REQUEST_TIMEOUT)
+        if operation == 'get_notices':
+            return self.session.get(f'{url}/api/notices/{user_id}', timeout=REQUEST_TIMEOUT)
+        if operation == 'get_schedules':
+            return self.session.get(f'{url}/api/schedules/{user_id}', timeout=REQUEST_TIMEOUT)
+        if operation == 'get_attendance':
+            return self.session.get(f'{url}/api/attendance/{user_id}', timeout=REQUEST_TIMEOUT)
+        if operation == 'get_updates':
+            since = datetime.datetime.utcnow() - datetime.timedelta(seconds=UPDATES_WINDOW)
+            return self.session.get(f'{url}/api/sync/get_updates', params={'last_sync_time': since.isoformat()}, timeout=REQUEST_TIMEOUT)
+        # sync_attendance: one kiosk push of a class's arrivals.
+        schedule_ids = self.by_class.get((department, year)) or [self.rng.choice(list(self.by_class.values()))[0]]
+        classmates = self.classmates[(department, year)]
+        now = datetime.datetime.now().isoformat()
+        records = []
+        for student in self.rng.sample(classmates, min(SYNC_BATCH_SIZE, len(classmates))):
+            records.append({'id': self.next_record, 'user_id': student, 'schedule_id': self.rng.choice(schedule_ids), 'timestamp': now})
+            self.next_record += 1
+        return self.session.post(f'{url}/api/sync/attendance', json={'device_id': self.device_id, 'records': records}, timeout=REQUEST_TIMEOUT)
+
+    def run(self):
+        while time.monotonic() < self.stop_at:
+            operation = self.rng.choices(self.names, self.weights)[0]
+            started = time.monotonic()
+            try:
+                response = self.request(operation)
+                response.content  # read the whole body
+                status = response.status_code
+            except requests.exceptions.RequestException:
+                status = 0
+            if started >= self.measure_from:
+                self.results[operation].append(((time.monotonic() - started) * 1000, status))
+        self.session.close()
+
+
+def summarize(samples, seconds):
+    latencies = np.asarray([latency for latency, _ in samples], dtype=np.float64)
+    statuses = defaultdict(int)
+    for _, status in samples:
+        statuses[str(status)] += 1
+    errors = sum(count for status, count in statuses.items() if status == '0' or status.startswith('5'))
+    if not len(latencies):
+        return {'requests': 0, 'errors': 0, 'throughput_rps': 0.0, 'statuses': {}}
+    p50, p95, p99 = np.percentile(latencies, [50, 95, 99])
+    return {
+        'requests': len(latencies),
+        'errors': errors,
+        'throughput_rps': round(len(latencies) / seconds, 2),
+        'mean_ms': round(float(latencies.mean()), 2),
+        'p50_ms': round(float(p50), 2),
+        'p95_ms': round(float(p95), 2),
+        'p99_ms': round(float(p99), 2),
+        'max_ms': round(float(latencies.max()), 2),
+        'statuses': dict(statuses),
+    }
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__)), timeout=5).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+
+def start_server():
+    import logging
+    from werkzeug.serving import make_server
+    from app import app
+    logging.getLogger('werkzeug').setLevel(logging.WARNING)  # one access line per request would skew the numbers
+    server = make_server('127.0.0.1', 0, app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f'http://127.0.0.1:{server.server_port}'
+
+
+def compare(report, baseline, tolerance):
+    """Print per-operation changes against a baseline; returns the regressed operation names."""
+    regressions = []
+    print(f"\nCompared with {baseline.get('label')} ({baseline.get('git_commit') or 'unknown commit'}):")
+    for operation, current in report['operations'].items():
+        previous = baseline.get('operations', {}).get(operation)
+        if not previous or not previous.get('requests') or not current.get('requests'):
+            continue
+        p95_change = current['p95_ms'] / previous['p95_ms'] - 1 if previous['p95_ms'] else 0.0
+        rps_change = current['throughput_rps'] / previous['throughput_rps'] - 1 if previous['throughput_rps'] else 0.0
+        regressed = p95_change > tolerance or rps_change < -tolerance
+        if regressed:
+            regressions.append(operation)
+        print(f"  {'❌' if regressed else '✅'} {operation:16} p95 {previous['p95_ms']:8.2f} -> {current['p95_ms']:8.2f} ms "
+              f"({p95_change:+.0%})   throughput {previous['throughput_rps']:8.1f} -> {current['throughput_rps']:8.1f}/s ({rps_change:+.0%})")
+    return regressions
+
+
+def run(args):
+    if args.db:
+        os.environ['ATTENDANCE_DB_PATH'] = os.path.abspath(args.db)
+    sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+    from database import db_path
+
+    mix = parse_mix(args.mix)
+    students, by_class, classmates, dataset = load_fixtures(args.seed)
+    size_before = db_size(db_path)
+    server = None
+    url = args.url.rstrip('/') if args.url else None
+    if url is None:
+        server, url = start_server()
+    run_id = uuid.uuid4().hex[:8]
+    print(f"Load testing {url}: {args.concurrency} worker(s), {args.warmup:.0f}s warmup + {args.duration:.0f}s, "
+          f"{dataset['users']} users, {dataset['attendance']} attendance records.")
+
+    results = defaultdict(list)
+    measure_from = time.monotonic() + args.warmup
+    stop_at = measure_from + args.duration
+    workers = [Worker(i, url, (students, by_class, classmates), mix, args.seed, run_id, measure_from, stop_at,
+                      defaultdict(list)) for i in range(args.concurrency)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    if server is not None:
+        server.shutdown()
+    for worker in workers:
+        for operation, samples in worker.results.items():
+            results[operation].extend(samples)
+
+    report = {
+        'label': args.label or time.strftime('%Y%m%d-%H%M%S'),
+        'created_at': datetime.datetime.now().isoformat(timespec='seconds'),
+        'git_commit': git_commit(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'url': None if server is not None else url,
+        'config': {'concurrency': args.concurrency, 'duration_s': args.duration, 'warmup_s': args.warmup,
+                   'mix': mix, 'seed': args.seed},
+        'dataset': dict(dataset, db_bytes_before=size_before, db_bytes_after=db_size(db_path)),
+        'totals': summarize([sample for samples in results.values() for sample in samples], args.duration),
+        'operations': {operation: summarize(results[operation], args.duration) for operation in mix},
+    }
+
+    print(f"\n{'operation':16} {'requests':>9} {'errors':>7} {'req/s':>9} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9}")
+    for operation, stats in list(report['operations'].items()) + [('TOTAL', report['totals'])]:
+        if stats['requests']:
+            print(f"{operation:16} {stats['requests']:9d} {stats['errors']:7d} {stats['throughput_rps']:9.1f} "
+                  f"{stats['p50_ms']:9.2f} {stats['p95_ms']:9.2f} {stats['p99_ms']:9.2f}")
+    print(f"Database: {report['dataset']['db_bytes_after'] / 1e6:.1f} MB")
+
+    os.makedirs(BASELINE_DIR, exist_ok=True)
+    path = os.path.join(BASELINE_DIR, f"{report['label']}.json")
+    with open(path, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f"Saved {path}")
+
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(report, json.load(f), args.tolerance)
+        if regressions:
+            print(f"❌ Regressed beyond {args.tolerance:.0%}: {', '.join(regressions)}")
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(run(parse_args()))
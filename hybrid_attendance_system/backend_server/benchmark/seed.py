@@ -0,0 +1,172 @@
+"""
+Populate the backend database with a synthetic college.
+
+Every department gets one admin and, per admission year, a class of students
+(the first one a CR) with FaceNet-sized embeddings, a weekly timetable,
+notices and `--history-days` of attendance up to today. Rows are written with
+Core executemany in large transactions through the `database` models, so the
+change_log triggers and indexes see exactly what production writes. Attendance
+rollups are rebuilt at the end.
+
+All users share the password BENCH_PASSWORD (hashing a distinct one per user
+would dominate seeding time). The database is the one `database` opens:
+ATTENDANCE_DB_PATH, or main_database.db; --db overrides it.
+
+    python benchmark/seed.py --reset --departments 6 --years 5 --history-days 730
+"""
+import argparse
+import datetime
+import os
+import sys
+import time
+
+import numpy as np
+
+BENCH_PASSWORD = 'benchmark'
+DEPARTMENTS = ['BCT', 'BEX', 'BEL', 'BME', 'BCE', 'BAR', 'BAM', 'BCH', 'BGE', 'BEI']
+SUBJECTS = ['Mathematics', 'Physics', 'Chemistry', 'Drawing', 'Programming', 'Electronics',
+            'Mechanics', 'Thermodynamics', 'Surveying', 'Economics', 'Communication', 'Statistics']
+TEACHING_DAYS = (6, 0, 1, 2, 3, 4)  # Sunday to Friday, as datetime.weekday()
+FIRST_SLOT_MINUTES = 10 * 60
+SLOT_MINUTES = 50
+EMBEDDINGS_PER_USER = 3
+EMBEDDING_DIM = 128
+PRESENT_RATE = 0.85
+INSERT_CHUNK = 20000
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Seed the backend database with synthetic data.")
+    parser.add_argument('--db', help="database file (default: ATTENDANCE_DB_PATH or main_database.db)")
+    parser.add_argument('--reset', action='store_true', help="delete the database file first")
+    parser.add_argument('--departments', type=int, default=4)
+    parser.add_argument('--years', type=int, default=4, help="admission years (classes) per department")
+    parser.add_argument('--students', type=int, default=48, help="students per class")
+    parser.add_argument('--slots', type=int, default=4, help="classes per teaching day")
+    parser.add_argument('--notices', type=int, default=100, help="notices per class")
+    parser.add_argument('--history-days', type=int, default=180, help="days of attendance up to today")
+    parser.add_argument('--seed', type=int, default=42)
+    return parser.parse_args(argv)
+
+
+def department_names(count):
+    return [DEPARTMENTS[i] if i < len(DEPARTMENTS) else f'D{i:02d}' for i in range(count)]
+
+
+def insert_chunked(connection, table, rows):
+    for start in range(0, len(rows), INSERT_CHUNK):
+        connection.execute(table.insert(), rows[start:start + INSERT_CHUNK])
+
+
+def seed(args):
+    # database reads ATTENDANCE_DB_PATH at import time.
+    if args.db:
+        os.environ['ATTENDANCE_DB_PATH'] = os.path.abspath(args.db)
+    sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+    from werkzeug.security import generate_password_hash
+    from sqlalchemy import select, func
+    from database import db_path, engine, create_db, pack_embeddings, User, Schedule, Notice, Attendance
+    from attendance_rollups import rebuild_rollups
+
+    if args.reset:
+        engine.dispose()
+        for suffix in ('', '-wal', '-shm'):
+            if os.path.exists(db_path + suffix):
+                os.remove(db_path + suffix)
+    create_db()
+
+    rng = np.random.default_rng(args.seed)
+    started = time.monotonic()
+    password_hash = generate_password_hash(BENCH_PASSWORD)
+    now = datetime.datetime.utcnow().replace(microsecond=0)
+    current_year = now.year
+    departments = department_names(args.departments)
+    counts = {'users': 0, 'schedules': 0, 'notices': 0, 'attendance': 0}
+
+    with engine.begin() as connection:
+        next_user = (connection.execute(select(func.max(User.id))).scalar() or 0) + 1
+        next_schedule = (connection.execute(select(func.max(Schedule.id))).scalar() or 0) + 1
+        users, schedules, classes = [], [], []
+        for department in departments:
+            admin_id = next_user
+            next_user += 1
+            users.append({'id': admin_id, 'name': f'{department} Admin', 'email': f'admin@{department.lower()}.bench',
+                          'password_hash': password_hash, 'role': 'admin', 'department': department, 'year': None,
+                          'embeddings': None, 'created_at': now, 'updated_at': now})
+            for offset in range(args.years):
+                year = current_year - offset
+                student_ids = list(range(next_user, next_user + args.students))
+                next_user += args.students
+                embeddings = rng.standard_normal((args.students, EMBEDDINGS_PER_USER, EMBEDDING_DIM)).astype(np.float32)
+                for n, user_id in enumerate(student_ids):
+                    users.append({'id': user_id, 'name': f'{department} {year} Student {n + 1}',
+                                  'email': f's{n + 1}.{year}@{department.lower()}.bench',
+                                  'password_hash': password_hash, 'role': 'cr' if n == 0 else 'student',
+                                  'department': department, 'year': year,
+                                  'embeddings': pack_embeddings(embeddings[n]), 'created_at': now, 'updated_at': now})
+                slots = []
+                for day_index, day in enumerate(TEACHING_DAYS):
+                    for slot in range(args.slots):
+                        start = FIRST_SLOT_MINUTES + slot * SLOT_MINUTES
+                        subject = SUBJECTS[(offset + day_index + slot) % len(SUBJECTS)]
+                        schedules.append({'id': next_schedule, 'department': department, 'year': year,
+                                          'subject_name': subject, 'day_of_week': day,
+                                          'start_time': f'{start // 60:02d}:{start % 60:02d}',
+                                          'end_time': f'{(start + SLOT_MINUTES) // 60:02d}:{(start + SLOT_MINUTES) % 60:02d}',
+                                          'cr_author_id': student_ids[0], 'updated_at': now})
+                        slots.append((next_schedule, day, start))
+                        next_schedule += 1
+                classes.append((department, year, admin_id, student_ids, slots))
+        insert_chunked(connection, User.__table__, users)
+        insert_chunked(connection, Schedule.__table__, schedules)
+        counts['users'], counts['schedules'] = len(users), len(schedules)
+    print(f"Seeded {counts['users']} users and {counts['schedules']} schedule slots "
+          f"in {len(classes)} classes ({time.monotonic() - started:.1f}s).")
+
+    history_start = now - datetime.timedelta(days=args.history_days)
+    for department, year, admin_id, student_ids, slots in classes:
+        notices = []
+        offsets = np.sort(rng.uniform(0, args.history_days * 86400, args.notices))
+        for n, offset in enumerate(offsets):
+            # A fifth of the notices go to the whole department (year NULL).
+            whole_department = rng.random() < 0.2
+            notices.append({'department': department, 'year': None if whole_department else year,
+                            'message': f'Notice {n + 1} for {department} {year}: ' + 'lorem ipsum ' * int(rng.integers(2, 30)),
+                            'timestamp': history_start + datetime.timedelta(seconds=float(offset)),
+                            'author_id': admin_id if whole_department else student_ids[0]})
+
+        attendance = []
+        device_id = f'seed-{department}-{year}'
+        by_weekday = {}
+        for schedule_id, day, start in slots:
+            by_weekday.setdefault(day, []).append((schedule_id, start))
+        students = np.asarray(student_ids)
+        for day_offset in range(args.history_days + 1):
+            date = (history_start + datetime.timedelta(days=day_offset)).date()
+            for schedule_id, start in by_weekday.get(date.weekday(), ()):
+                session_start = datetime.datetime.combine(date, datetime.time()) + datetime.timedelta(minutes=start)
+                if session_start > now:
+                    continue
+                present = students[rng.random(len(students)) < PRESENT_RATE]
+                arrivals = rng.integers(0, 600, len(present))
+                for user_id, seconds in zip(present.tolist(), arrivals.tolist()):
+                    attendance.append({'user_id': user_id, 'schedule_id': schedule_id,
+                                       'timestamp': session_start + datetime.timedelta(seconds=seconds),
+                                       'status': 'present', 'device_id': device_id,
+                                       'client_record_id': len(attendance) + 1})
+        with engine.begin() as connection:
+            insert_chunked(connection, Notice.__table__, notices)
+            insert_chunked(connection, Attendance.__table__, attendance)
+        counts['notices'] += len(notices)
+        counts['attendance'] += len(attendance)
+        print(f"  {department} {year}: {len(notices)} notices, {len(attendance)} attendance records")
+
+    rebuild_rollups()
+    size = sum(os.path.getsize(db_path + suffix) for suffix in ('', '-wal') if os.path.exists(db_path + suffix))
+    print(f"✅ Seeded {db_path}: {counts['users']} users, {counts['schedules']} schedules, {counts['notices']} notices, "
+          f"{counts['attendance']} attendance records, {size / 1e6:.1f} MB in {time.monotonic() - started:.1f}s.")
+    return counts
+
+
+if __name__ == '__main__':
+    seed(parse_args())
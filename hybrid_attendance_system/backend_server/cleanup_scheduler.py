@@ -1,53 +1,158 @@
+"""
+Deletes students (and CRs) who have completed their college journey.
+
+- 4-year journey for all faculties except BAR, which takes 5 (COURSE_YEARS).
+- A student is expired once the current year reaches admission year + duration.
+
+Expired ids are selected with one SQL query and deleted in chunks of
+CHUNK_SIZE users, each in its own short transaction, so the SQLite writer is
+never blocked for long. Notices, attendance, schedules a CR authored and the
+attendance rollups go with them through the ON DELETE CASCADE foreign keys
+(PRAGMA foreign_keys is switched on for the cleanup connection only).
+
+    python cleanup_scheduler.py --dry-run
+    python cleanup_scheduler.py --archive graduated_attendance.csv
+"""
+import argparse
+import csv
 import datetime
-from sqlalchemy import or_
-from database import Session, User
-
-def delete_graduated_students():
-    """
-    Checks for students who have completed their college journey and deletes their records.
-    - 4-year journey for all faculties except BAR.
-    - 5-year journey for BAR faculty.
-    Deletion occurs if the current year is past their graduation year.
-    """
-    db_session = Session()
-    current_year = datetime.datetime.now().year
+import os
+import time
+
+from sqlalchemy import select, func, case, delete, or_
+
+from database import engine, User, Notice, Schedule, Attendance
+
+COURSE_YEARS = {'BAR': 5}
+DEFAULT_COURSE_YEARS = 4
+STUDENT_ROLES = ('student', 'cr')
+CHUNK_SIZE = 200
+ARCHIVE_COLUMNS = ['id', 'user_id', 'student_name', 'department', 'year', 'schedule_id', 'subject_name',
+                   'timestamp', 'status', 'device_id', 'client_record_id']
+
+
+def expired_students_query(current_year):
+    duration = case(
+        *[(func.upper(User.department) == department, years) for department, years in COURSE_YEARS.items()],
+        else_=DEFAULT_COURSE_YEARS
+    )
+    return select(User.id).where(
+        User.role.in_(STUDENT_ROLES),
+        User.year.isnot(None),
+        User.department.isnot(None),
+        User.department != '',
+        User.year + duration <= current_year,
+    )
+
+
+def _cascaded_attendance(user_ids):
+    """Attendance that goes with these users: their own, and every record of schedules they authored."""
+    authored = select(Schedule.id).where(Schedule.cr_author_id.in_(user_ids))
+    return or_(Attendance.user_id.in_(user_ids), Attendance.schedule_id.in_(authored))
+
+
+def cleanup_report(connection, current_year):
+    """Per department/year counts of what a cleanup would remove."""
+    expired = expired_students_query(current_year).subquery()
+    groups = connection.execute(
+        select(User.department, User.year, func.count())
+        .where(User.id.in_(select(expired.c.id)))
+        .group_by(User.department, User.year)
+        .order_by(User.department, User.year)
+    ).all()
+    ids = select(expired.c.id)
+    return {
+        'groups': [{'department': d, 'year': y, 'students': n} for d, y, n in groups],
+        'students': sum(n for _, _, n in groups),
+        'attendance': connection.execute(select(func.count()).select_from(Attendance).where(_cascaded_attendance(ids))).scalar(),
+        'notices': connection.execute(select(func.count()).select_from(Notice).where(Notice.author_id.in_(ids))).scalar(),
+        'schedules': connection.execute(select(func.count()).select_from(Schedule).where(Schedule.cr_author_id.in_(ids))).scalar(),
+    }
+
+
+def _archive_chunk(connection, writer, user_ids):
+    student = User.__table__.alias('student')
+    rows = connection.execute(
+        select(Attendance.id, Attendance.user_id, student.c.name, student.c.department, student.c.year,
+               Attendance.schedule_id, Schedule.subject_name, Attendance.timestamp, Attendance.status,
+               Attendance.device_id, Attendance.client_record_id)
+        .select_from(Attendance)
+        .outerjoin(student, student.c.id == Attendance.user_id)
+        .outerjoin(Schedule, Schedule.id == Attendance.schedule_id)
+        .where(_cascaded_attendance(user_ids))
+        .order_by(Attendance.id)
+    ).all()
+    for row in rows:
+        writer.writerow([value.isoformat() if isinstance(value, datetime.datetime) else value for value in row])
+    return len(rows)
+
+
+def delete_graduated_students(dry_run=False, chunk_size=CHUNK_SIZE, archive_path=None, current_year=None):
+    current_year = current_year or datetime.datetime.now().year
     print(f"[{datetime.datetime.now()}] Running cleanup job for year {current_year}...")
-    
-    deleted_count = 0
-    try:
-        # Fetch all users who are students or CRs
-        students_to_check = db_session.query(User).filter(
-            or_(User.role == 'student', User.role == 'cr')
-        ).all()
-
-        for student in students_to_check:
-            # Ensure the student record has an admission year and department
-            if not student.year or not student.department:
-                continue
-
-            # Determine the course duration based on faculty
-            duration = 5 if student.department.upper() == 'BAR' else 4
-            
-            # The year the student is expected to have graduated
-            expiry_year = student.year + duration
-
-            # If the current year is past the student's expiry year, delete them
-            if current_year >= expiry_year:
-                print(f"DELETING -> User: {student.name} (ID: {student.id}), Admission: {student.year}, Dept: {student.department}. Expiry Year was {expiry_year}.")
-                db_session.delete(student)
-                deleted_count += 1
-        
-        if deleted_count > 0:
-            db_session.commit()
-            print(f"✅ Successfully deleted {deleted_count} graduated student(s).")
-        else:
-            print("✅ No students found for deletion at this time.")
+    started = time.monotonic()
 
+    with engine.connect() as connection:
+        report = cleanup_report(connection, current_year)
+        for group in report['groups']:
+            print(f"  {group['department']} {group['year']}: {group['students']} student(s)")
+        print(f"Expired: {report['students']} student(s), {report['attendance']} attendance record(s), "
+              f"{report['notices']} notice(s), {report['schedules']} schedule(s).")
+        if dry_run or not report['students']:
+            if not report['students']:
+                print("✅ No students found for deletion at this time.")
+            return report
+        expired_ids = list(connection.scalars(expired_students_query(current_year).order_by(User.id)))
+
+    archive_file = writer = None
+    if archive_path:
+        new_file = not os.path.exists(archive_path) or os.path.getsize(archive_path) == 0
+        archive_file = open(archive_path, 'a', newline='')
+        writer = csv.writer(archive_file)
+        if new_file:
+            writer.writerow(ARCHIVE_COLUMNS)
+
+    deleted = archived = 0
+    try:
+        with engine.connect() as connection:
+            # Only takes effect outside a transaction, and pooled connections keep it,
+            # hence the explicit reset below.
+            connection.exec_driver_sql('PRAGMA foreign_keys = ON')
+            connection.commit()
+            try:
+                for start in range(0, len(expired_ids), chunk_size):
+                    chunk = expired_ids[start:start + chunk_size]
+                    with connection.begin():
+                        if writer:
+                            archived += _archive_chunk(connection, writer, chunk)
+                            archive_file.flush()
+                            os.fsync(archive_file.fileno())  # archived before the rows are gone
+                        deleted += connection.execute(delete(User).where(User.id.in_(chunk))).rowcount
+                    elapsed = time.monotonic() - started
+                    print(f"  deleted {deleted}/{len(expired_ids)} student(s)"
+                          f"{f', archived {archived} attendance record(s)' if writer else ''}"
+                          f" ({deleted / elapsed:.0f}/s, {elapsed:.1f}s)")
+            finally:
+                connection.exec_driver_sql('PRAGMA foreign_keys = OFF')
+                connection.commit()
     except Exception as e:
-        db_session.rollback()
-        print(f"❌ An error occurred during cleanup: {e}")
+        print(f"❌ An error occurred during cleanup after deleting {deleted} student(s): {e}")
+        raise
     finally:
-        db_session.close()
+        if archive_file:
+            archive_file.close()
+
+    report.update(deleted=deleted, archived=archived, seconds=round(time.monotonic() - started, 2))
+    print(f"✅ Successfully deleted {deleted} graduated student(s) in {report['seconds']}s.")
+    return report
+
 
 if __name__ == '__main__':
-    delete_graduated_students()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="Delete students who have completed their course.")
+    parser.add_argument('--dry-run', action='store_true', help="only report what would be deleted")
+    parser.add_argument('--chunk-size', type=int, default=CHUNK_SIZE, help="students deleted per transaction")
+    parser.add_argument('--archive', metavar='CSV', help="append the attendance being removed to this CSV first")
+    parser.add_argument('--year', type=int, help="treat this as the current year")
+    args = parser.parse_args()
+    delete_graduated_students(dry_run=args.dry_run, chunk_size=args.chunk_size,
+                              archive_path=args.archive, current_year=args.year)
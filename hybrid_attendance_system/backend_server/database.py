@@ -1,13 +1,65 @@
 import os
+import sys
 import datetime
 import json
-from sqlalchemy import create_engine, Column, Integer, String, Text, DateTime, ForeignKey
+import base64
+import argparse
+from sqlalchemy import create_engine, event, Column, Integer, String, Text, DateTime, ForeignKey, LargeBinary, Index
 from sqlalchemy.orm import sessionmaker, relationship, declarative_base
 from sqlalchemy import MetaData, Table
 from sqlalchemy.sql import text  # Import text for raw SQL
 
-db_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'main_database.db')
-engine = create_engine(f'sqlite:///{db_path}')
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'shared'))
+from embedding_codec import pack_embeddings, check_embeddings, decode_embeddings
+
+db_path = os.environ.get('ATTENDANCE_DB_PATH') or os.path.join(os.path.dirname(os.path.abspath(__file__)), 'main_database.db')
+
+# Per-deployment engine settings, picked with ATTENDANCE_DB_PROFILE. Pragmas are
+# applied to every new connection; WAL lets the sync endpoints write while the
+# app's read endpoints keep serving.
+ENGINE_PROFILES = {
+    'production': {
+        'pragmas': {
+            'journal_mode': 'WAL',
+            'synchronous': 'NORMAL',  # safe with WAL; only the last commits can be lost on power failure
+            'busy_timeout': 10000,  # ms a writer waits for the lock before "database is locked"
+            'cache_size': -65536,  # KiB (negative) of page cache per connection
+            'temp_store': 'MEMORY',
+            'mmap_size': 268435456,
+        },
+        'pool': {'pool_size': 10, 'max_overflow': 20, 'pool_timeout': 30, 'pool_recycle': 3600},
+    },
+    'development': {
+        'pragmas': {
+            'journal_mode': 'WAL',
+            'synchronous': 'FULL',
+            'busy_timeout': 5000,
+            'cache_size': -16384,
+        },
+        'pool': {'pool_size': 5, 'max_overflow': 5, 'pool_timeout': 10},
+    },
+}
+DB_PROFILE = os.environ.get('ATTENDANCE_DB_PROFILE', 'production')
+
+def make_engine(path=db_path, profile=DB_PROFILE):
+    settings = ENGINE_PROFILES[profile]
+    pragmas = settings['pragmas']
+    new_engine = create_engine(
+        f'sqlite:///{path}',
+        connect_args={'timeout': pragmas.get('busy_timeout', 5000) / 1000, 'check_same_thread': False},
+        **settings['pool']
+    )
+
+    @event.listens_for(new_engine, 'connect')
+    def apply_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for name, value in pragmas.items():
+            cursor.execute(f'PRAGMA {name} = {value}')
+        cursor.close()
+
+    return new_engine
+
+engine = make_engine()
 Session = sessionmaker(bind=engine)
 Base = declarative_base()
 
@@ -20,23 +72,53 @@ class User(Base):
     role = Column(String(10), nullable=False, default='student')
     department = Column(String(50), nullable=False)
     year = Column(Integer)
-    embeddings = Column(Text, nullable=True)
+    # Packed float32 blob (see shared/embedding_codec.py). Older rows may still
+    # hold JSON text until migrate_database() converts them.
+    embeddings = Column(LargeBinary, nullable=True)
     created_at = Column(DateTime, default=datetime.datetime.utcnow)
     updated_at = Column(DateTime, default=datetime.datetime.utcnow, onupdate=datetime.datetime.utcnow)
     
     notices = relationship("Notice", back_populates="author", cascade="all, delete", passive_deletes=True)
     attendance_records = relationship("Attendance", back_populates="user", cascade="all, delete", passive_deletes=True)
 
-    def to_dict(self):
+    __table_args__ = (
+        Index('ix_users_department_year', 'department', 'year'),
+        Index('ix_users_updated_at', 'updated_at'),
+    )
+
+    # Named projections for to_dict(). serializers.user_load_options(view) loads
+    # exactly these columns, so a view without 'embeddings' never reads the blob.
+    VIEWS = {
+        'public': ('id', 'name', 'email', 'role', 'department', 'year'),
+        'admin': ('id', 'name', 'email', 'role', 'department', 'year', 'created_at', 'updated_at'),
+        'sync': ('id', 'name', 'embeddings'),
+        'full': ('id', 'name', 'email', 'role', 'department', 'year', 'embeddings'),
+    }
+
+    def to_dict(self, view='public'):
+        if view == 'sync':
+            return self.to_sync_dict()
+        data = {}
+        for field in self.VIEWS[view]:
+            value = getattr(self, field)
+            if field == 'embeddings':
+                value = decode_embeddings(value).tolist()
+            elif isinstance(value, datetime.datetime):
+                value = value.isoformat()
+            data[field] = value
+        data['avatarUrl'] = f'https://i.pravatar.cc/150?u={self.id}'
+        return data
+
+    def to_sync_dict(self):
+        # Classroom clients store the packed blob as-is, so ship it base64 encoded
+        # instead of expanding it into a JSON float array.
+        blob = self.embeddings
+        if isinstance(blob, str):
+            blob = pack_embeddings(json.loads(blob))
         return {
             'id': self.id,
             'name': self.name,
-            'email': self.email,
-            'role': self.role,
-            'department': self.department,
-            'year': self.year,
-            'avatarUrl': f'https://i.pravatar.cc/150?u={self.id}',
-            'embeddings': json.loads(self.embeddings) if self.embeddings else []
+            'embeddings_blob': base64.b64encode(blob).decode('ascii') if blob else None
         }
 
 class Schedule(Base):
@@ -53,6 +135,11 @@ class Schedule(Base):
     
     attendance_records = relationship("Attendance", back_populates="schedule", cascade="all, delete", passive_deletes=True)
 
+    __table_args__ = (
+        Index('ix_schedules_department_year', 'department', 'year'),
+        Index('ix_schedules_updated_at', 'updated_at'),
+    )
+
     def to_dict(self):
         return {
             'id': self.id,
@@ -74,12 +161,17 @@ class Notice(Base):
     author_id = Column(Integer, ForeignKey('users.id', ondelete="CASCADE"))
     author = relationship("User", back_populates="notices")
 
-    def to_dict(self):
+    __table_args__ = (
+        # Serves "department = ? AND (year IS NULL OR year = ?) ORDER BY timestamp DESC".
+        Index('ix_notices_department_year_timestamp', 'department', 'year', 'timestamp'),
+    )
+
+    def to_dict(self, author_view='public'):
         return {
             'id': self.id,
             'message': self.message,
             'timestamp': self.timestamp.isoformat(),
-            'author': self.author.to_dict() if self.author else {},
+            'author': self.author.to_dict(author_view) if self.author else {},
             'department': self.department,
             'year': self.year
         }
@@ -91,6 +183,18 @@ class Attendance(Base):
     schedule_id = Column(Integer, ForeignKey('schedules.id', ondelete="CASCADE"))
     timestamp = Column(DateTime, nullable=False)
     status = Column(String(10), default='present')
+    # Where the record came from: classroom device and that device's local row id.
+    # Unique together so a retried push cannot store the same record twice.
+    device_id = Column(String(64), nullable=True)
+    client_record_id = Column(Integer, nullable=True)
+
+    __table_args__ = (
+        Index('ux_attendance_device_record', 'device_id', 'client_record_id', unique=True),
+        # Per-student history, newest first (keyset pages on timestamp, id).
+        Index('ix_attendance_user_timestamp', 'user_id', 'timestamp'),
+        # Whether a class session already has attendance that day (rollups), and schedule cascades.
+        Index('ix_attendance_schedule_timestamp', 'schedule_id', 'timestamp'),
+    )
 
     user = relationship("User", back_populates="attendance_records")
     schedule = relationship("Schedule", back_populates="attendance_records")
@@ -104,28 +208,259 @@ class Attendance(Base):
             'status': self.status
         }
 
-def migrate_database():
+class AttendanceRollup(Base):
+    """Days a student attended one schedule slot in one month, kept current by ingest (see attendance_rollups.py)."""
+    __tablename__ = 'attendance_rollups'
+    user_id = Column(Integer, ForeignKey('users.id', ondelete="CASCADE"), primary_key=True)
+    schedule_id = Column(Integer, ForeignKey('schedules.id', ondelete="CASCADE"), primary_key=True)
+    period = Column(String(7), primary_key=True)  # 'YYYY-MM'
+    department = Column(String(50), nullable=False)
+    year = Column(Integer)
+    present_days = Column(Integer, nullable=False, default=0)
+    last_present = Column(DateTime)
+
+    __table_args__ = (
+        Index('ix_attendance_rollups_class', 'department', 'year', 'schedule_id', 'period'),
+    )
+
+class SessionRollup(Base):
+    """Days a schedule slot was held (had any attendance) in one month: the denominator for percentages."""
+    __tablename__ = 'session_rollups'
+    schedule_id = Column(Integer, ForeignKey('schedules.id', ondelete="CASCADE"), primary_key=True)
+    period = Column(String(7), primary_key=True)
+    department = Column(String(50), nullable=False)
+    year = Column(Integer)
+    sessions = Column(Integer, nullable=False, default=0)
+
+    __table_args__ = (
+        Index('ix_session_rollups_class', 'department', 'year', 'period'),
+    )
+
+class ChangeLog(Base):
+    """Append-only feed of user/schedule changes for classroom sync, filled by triggers."""
+    __tablename__ = 'change_log'
+    seq = Column(Integer, primary_key=True)
+    entity = Column(String(16), nullable=False)  # 'user' or 'schedule'
+    entity_id = Column(Integer, nullable=False)
+    op = Column(String(8), nullable=False)  # 'upsert' or 'delete'
+    department = Column(String(50))
+    year = Column(Integer)
+    changed_at = Column(DateTime, server_default=text('CURRENT_TIMESTAMP'))
+
+    __table_args__ = (
+        Index('ix_change_log_department_year_seq', 'department', 'year', 'seq'),
+        # AUTOINCREMENT: seq never goes backwards, even after the newest rows are pruned.
+        {'sqlite_autoincrement': True},
+    )
+
+class EventLog(Base):
+    """Notices and schedule entries for /api/events streams; every serving process polls it (see event_stream.py)."""
+    __tablename__ = 'event_log'
+    seq = Column(Integer, primary_key=True)
+    kind = Column(String(16), nullable=False)  # 'notice' or 'schedule'
+    department = Column(String(50), nullable=False)
+    year = Column(Integer)  # NULL: the whole department
+    payload = Column(Text, nullable=False)  # JSON
+    created_at = Column(DateTime, server_default=text('CURRENT_TIMESTAMP'))
+
+    __table_args__ = (
+        # AUTOINCREMENT: seq is the event id clients resume from, so it must never be reused.
+        {'sqlite_autoincrement': True},
+    )
+
+class CacheGeneration(Base):
+    """Generation of each response-cache scope; writes bump it so every process's cache sees them (see response_cache.py)."""
+    __tablename__ = 'cache_generations'
+    scope = Column(String(120), primary_key=True)  # e.g. 'notices/BCT', 'attendance/42'
+    generation = Column(Integer, nullable=False, default=0)
+
+# Triggers keep change_log complete no matter how rows change (ORM, raw SQL or
+# database-level cascades). A user or schedule that moves to another
+# department/year leaves a tombstone in the feed it left.
+CHANGE_LOG_TRIGGERS = []
+for _table, _entity in (('users', 'user'), ('schedules', 'schedule')):
+    CHANGE_LOG_TRIGGERS += [
+        f"""CREATE TRIGGER IF NOT EXISTS {_table}_change_insert AFTER INSERT ON {_table} BEGIN
+            INSERT INTO change_log (entity, entity_id, op, department, year) VALUES ('{_entity}', NEW.id, 'upsert', NEW.department, NEW.year);
+        END""",
+        f"""CREATE TRIGGER IF NOT EXISTS {_table}_change_update AFTER UPDATE ON {_table} BEGIN
+            INSERT INTO change_log (entity, entity_id, op, department, year)
+                SELECT '{_entity}', OLD.id, 'delete', OLD.department, OLD.year
+                WHERE OLD.department IS NOT NEW.department OR OLD.year IS NOT NEW.year;
+            INSERT INTO change_log (entity, entity_id, op, department, year) VALUES ('{_entity}', NEW.id, 'upsert', NEW.department, NEW.year);
+        END""",
+        f"""CREATE TRIGGER IF NOT EXISTS {_table}_change_delete AFTER DELETE ON {_table} BEGIN
+            INSERT INTO change_log (entity, entity_id, op, department, year) VALUES ('{_entity}', OLD.id, 'delete', OLD.department, OLD.year);
+        END""",
+    ]
+
+def install_change_log():
+    with engine.begin() as connection:
+        for statement in CHANGE_LOG_TRIGGERS:
+            connection.execute(text(statement))
+        # First run on an existing database: seed the feed with every current row.
+        if connection.execute(text('SELECT COUNT(*) FROM change_log')).scalar() == 0:
+            connection.execute(text(
+                "INSERT INTO change_log (entity, entity_id, op, department, year) "
+                "SELECT 'user', id, 'upsert', department, year FROM users ORDER BY id"
+            ))
+            connection.execute(text(
+                "INSERT INTO change_log (entity, entity_id, op, department, year) "
+                "SELECT 'schedule', id, 'upsert', department, year FROM schedules ORDER BY id"
+            ))
+
+def add_schedule_author_column():
     metadata = MetaData()
-    metadata.reflect(bind=engine)
-    with engine.connect() as connection:
-        # Check if schedules table exists and if cr_author_id column is missing
-        if 'schedules' in metadata.tables:
-            schedules_table = Table('schedules', metadata, autoload_with=engine)
-            if 'cr_author_id' not in schedules_table.c:
-                print("Adding cr_author_id column to schedules table...")
-                connection.execute(
-                    text('ALTER TABLE schedules ADD COLUMN cr_author_id INTEGER REFERENCES users(id) ON DELETE CASCADE')
-                )
-                print("cr_author_id column added successfully.")
-            else:
-                print("cr_author_id column already exists in schedules table.")
-        else:
-            print("schedules table does not exist, will be created.")
+    metadata.reflect(bind=engine, only=['schedules'])
+    if 'cr_author_id' in metadata.tables['schedules'].c:
+        return
+    with engine.begin() as connection:
+        connection.execute(
+            text('ALTER TABLE schedules ADD COLUMN cr_author_id INTEGER REFERENCES users(id) ON DELETE CASCADE')
+        )
+    print("cr_author_id column added to schedules table.")
+
+def create_missing_indexes():
+    """Create every index declared on the models that an older database lacks."""
+    with engine.begin() as connection:
+        for table in Base.metadata.sorted_tables:
+            for index in table.indexes:
+                index.create(bind=connection, checkfirst=True)
+
+def add_attendance_source_columns():
+    metadata = MetaData()
+    metadata.reflect(bind=engine, only=['attendance'])
+    attendance_table = metadata.tables['attendance']
+    with engine.begin() as connection:
+        for name, ddl in (('device_id', 'VARCHAR(64)'), ('client_record_id', 'INTEGER')):
+            if name not in attendance_table.c:
+                print(f"Adding {name} column to attendance table...")
+                connection.execute(text(f'ALTER TABLE attendance ADD COLUMN {name} {ddl}'))
+        connection.execute(text(
+            'CREATE UNIQUE INDEX IF NOT EXISTS ux_attendance_device_record ON attendance (device_id, client_record_id)'
+        ))
+
+def convert_embeddings_to_blobs(batch_size=500):
+    """Rewrite legacy JSON-text embeddings as packed float32 blobs, in batches."""
+    converted = 0
+    while True:
+        with engine.begin() as connection:
+            rows = connection.execute(
+                text("SELECT id, embeddings FROM users WHERE typeof(embeddings) = 'text' LIMIT :limit"),
+                {'limit': batch_size}
+            ).fetchall()
+            if not rows:
+                break
+            connection.execute(
+                text('UPDATE users SET embeddings = :blob WHERE id = :id'),
+                [{'id': row[0], 'blob': pack_embeddings(json.loads(row[1]) if row[1] else [])} for row in rows]
+            )
+            converted += len(rows)
+    if converted:
+        print(f"Converted embeddings of {converted} user(s) to packed float32 blobs.")
+
+def replace_attendance_user_index():
+    create_missing_indexes()
+    with engine.begin() as connection:
+        # A prefix of ix_attendance_user_timestamp, so no longer needed.
+        connection.execute(text('DROP INDEX IF EXISTS ix_attendance_user_id'))
+
+def create_event_log():
+    EventLog.__table__.create(bind=engine, checkfirst=True)
+
+def create_cache_generations():
+    CacheGeneration.__table__.create(bind=engine, checkfirst=True)
+
+def backfill_attendance_rollups():
+    create_missing_indexes()
+    # Imported here: attendance_rollups itself imports this module.
+    from attendance_rollups import rebuild_rollups
+    rebuild_rollups()
+
+# Applied in order by migrate_database(); each step is recorded in schema_version.
+# Steps must be safe on a database that already has the change (databases
+# created before schema_version existed start at version 0), and new steps are
+# only ever appended.
+MIGRATIONS = [
+    (1, 'add schedules.cr_author_id', add_schedule_author_column),
+    (2, 'pack user embeddings as float32 blobs', convert_embeddings_to_blobs),
+    (3, 'record attendance device and client record id', add_attendance_source_columns),
+    (4, 'install change_log triggers', install_change_log),
+    (5, 'add secondary indexes for the hot queries', create_missing_indexes),
+    (6, 'index attendance history by (user_id, timestamp)', replace_attendance_user_index),
+    (7, 'build attendance rollups', backfill_attendance_rollups),
+    (8, 'add event_log for server-sent events', create_event_log),
+    (9, 'add cache_generations for cross-process cache invalidation', create_cache_generations),
+]
+
+def migrate_database():
+    """Apply the migrations newer than the database's schema_version. Tables must exist."""
+    with engine.begin() as connection:
+        connection.execute(text(
+            'CREATE TABLE IF NOT EXISTS schema_version ('
+            'version INTEGER PRIMARY KEY, description TEXT, applied_at DATETIME DEFAULT CURRENT_TIMESTAMP)'
+        ))
+        current = connection.execute(text('SELECT COALESCE(MAX(version), 0) FROM schema_version')).scalar()
+    for version, description, migrate in MIGRATIONS:
+        if version <= current:
+            continue
+        print(f"Applying migration {version}: {description}...")
+        migrate()
+        with engine.begin() as connection:
+            connection.execute(
+                text('INSERT INTO schema_version (version, description) VALUES (:version, :description)'),
+                {'version': version, 'description': description}
+            )
+    return MIGRATIONS[-1][0]
 
 def create_db():
-    migrate_database()  # Apply migrations before creating tables
+    # New tables are created at the current schema; the migrations then bring
+    # tables from older versions up to date.
     Base.metadata.create_all(engine)
-    print("Database tables created or updated successfully.")
+    version = migrate_database()
+    print(f"Database tables created or updated successfully (schema version {version}).")
+
+# One representative statement per endpoint query and the index it must use.
+QUERY_PLAN_CHECKS = [
+    ('login / signup', "SELECT id FROM users WHERE email = 'a@b.c'", 'sqlite_autoindex_users_1'),
+    ('admin users', "SELECT id FROM users WHERE department = 'BCT' AND id != 1", 'ix_users_department_year'),
+    ('notices page',
+     "SELECT id FROM notices WHERE department = 'BCT' AND year = 2080 AND timestamp <= '2025-01-01 00:00:00' "
+     "AND (timestamp < '2025-01-01 00:00:00' OR id < 10) ORDER BY timestamp DESC, id DESC LIMIT 51",
+     'ix_notices_department_year_timestamp'),
+    ('schedules', "SELECT id FROM schedules WHERE department = 'BCT' AND year = 2080", 'ix_schedules_department_year'),
+    ('attendance page',
+     "SELECT id FROM attendance WHERE user_id = 1 AND timestamp >= '2024-01-01 00:00:00' "
+     "ORDER BY timestamp DESC, id DESC LIMIT 51",
+     'ix_attendance_user_timestamp'),
+    ('get_updates users', "SELECT id FROM users WHERE updated_at > '2025-01-01 00:00:00'", 'ix_users_updated_at'),
+    ('get_updates schedules', "SELECT id FROM schedules WHERE updated_at > '2025-01-01 00:00:00'", 'ix_schedules_updated_at'),
+    ('sync changes',
+     "SELECT seq FROM change_log WHERE seq > 0 AND department = 'BCT' AND year = 2080 ORDER BY seq LIMIT 501",
+     'ix_change_log_department_year_seq'),
+    ('sync attendance dedup',
+     "SELECT client_record_id FROM attendance WHERE device_id = 'd' AND client_record_id IN (1, 2)",
+     'ux_attendance_device_record'),
+]
+
+def check_query_plans():
+    """EXPLAIN every QUERY_PLAN_CHECKS statement; returns the labels that do not use their index."""
+    failures = []
+    with engine.connect() as connection:
+        for label, sql, index_name in QUERY_PLAN_CHECKS:
+            plan = [row[-1] for row in connection.exec_driver_sql(f'EXPLAIN QUERY PLAN {sql}')]
+            used = any(index_name in step for step in plan)
+            # A temp b-tree means the ORDER BY is not served by the index.
+            used = used and not any('TEMP B-TREE' in step for step in plan)
+            print(f"{'✅' if used else '❌'} {label}: {' | '.join(plan)}")
+            if not used:
+                failures.append(label)
+    return failures
 
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Create or migrate the central database.")
+    parser.add_argument('--check-plans', action='store_true', help="verify that endpoint queries use their indexes")
+    args = parser.parse_args()
     create_db()
+    if args.check_plans:
+        sys.exit(1 if check_query_plans() else 0)
@@ -0,0 +1,431 @@
+"""
+Server-side face enrollment.
+
+Images are decoded, checked and embedded in a spawned process pool (one warm
+ModelManager per worker). The CLI starts ENROLL_WORKERS processes for its
+intake; each web process starts ENROLL_SERVER_WORKERS (one by default) on its
+first enrollment request and shuts them down after ENROLL_POOL_IDLE_SECONDS
+without one, so gunicorn workers do not each keep TensorFlow resident. Each task takes ENROLL_BATCH_SIZE images, runs the
+detector on each and then a single FaceNet forward pass over every face that
+passed the quality checks. Back in the parent, images that disagree with the
+student's other images are dropped, students whose face is already in the
+gallery of their department/year under another account (or appears twice in
+the same intake) are rejected, and the rest are stored as packed embeddings,
+replacing whatever the client posted at signup. Only the gallery snapshots of
+the enrolled students' department/year are refreshed, once per call (once per
+intake for bulk enrollment).
+
+    python enrollment.py intake.zip              # <email or user id>/<image>, one folder per student
+    python enrollment.py intake_dir --dry-run --workers 8
+"""
+import argparse
+import contextlib
+import datetime
+import multiprocessing
+import os
+import sys
+import threading
+import time
+import zipfile
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+from sqlalchemy import select, bindparam, or_
+
+from database import engine, User, pack_embeddings
+from gallery_snapshots import refresh_snapshot
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'shared'))
+from model_manager import get_model_manager
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.bmp', '.webp')
+STUDENT_ROLES = ('student', 'cr')
+ENROLL_WORKERS = int(os.environ.get('ENROLL_WORKERS', max(1, (os.cpu_count() or 2) - 1)))  # CLI intakes
+ENROLL_SERVER_WORKERS = int(os.environ.get('ENROLL_SERVER_WORKERS', 1))  # per web process
+ENROLL_POOL_IDLE_SECONDS = 300   # a web process's pool is shut down after this long unused
+ENROLL_BATCH_SIZE = 16           # images per pool task, embedded in one forward pass
+STUDENTS_PER_ROUND = 100         # bulk intakes are read and stored this many students at a time
+MAX_IMAGES_PER_STUDENT = 10
+MAX_IMAGE_BYTES = 8 * 1024 * 1024
+
+# Quality gates, applied to the detected face region.
+MIN_FACE_CONFIDENCE = 0.90
+MIN_FACE_SIZE = 80               # pixels, shorter side of the face box
+MIN_SHARPNESS = 40.0             # variance of the Laplacian
+BRIGHTNESS_RANGE = (40, 220)     # mean grey level
+# Cosine distances. The classroom recognizer accepts matches at 0.40, so a new
+# face that close to someone else's would be confused with them.
+CONSISTENCY_DISTANCE = 0.40      # from the centroid of the student's own images
+DUPLICATE_DISTANCE = 0.40        # to any other user's gallery row
+
+
+def init_worker():
+    """Pool initializer: build and warm the models before the worker takes its first batch."""
+    get_model_manager().load()
+
+
+def face_quality(image, face):
+    """(quality dict, rejection reason or None) for one detected face."""
+    import cv2
+    area = face['facial_area']
+    x, y = max(int(area['x']), 0), max(int(area['y']), 0)
+    w, h = int(area['w']), int(area['h'])
+    grey = cv2.cvtColor(image[y:y + h, x:x + w], cv2.COLOR_BGR2GRAY)
+    quality = {
+        'confidence': round(float(face['confidence']), 3),
+        'face_size': min(w, h),
+        'sharpness': round(float(cv2.Laplacian(grey, cv2.CV_64F).var()), 1) if grey.size else 0.0,
+        'brightness': round(float(grey.mean()), 1) if grey.size else 0.0,
+    }
+    if quality['face_size'] < MIN_FACE_SIZE:
+        return quality, 'face too small'
+    if quality['sharpness'] < MIN_SHARPNESS:
+        return quality, 'image too blurry'
+    if not BRIGHTNESS_RANGE[0] <= quality['brightness'] <= BRIGHTNESS_RANGE[1]:
+        return quality, 'face too dark' if quality['brightness'] < BRIGHTNESS_RANGE[0] else 'face overexposed'
+    return quality, None
+
+
+def embed_images(items):
+    """Runs in a pool worker: [(key, image bytes)] -> [{'key', 'embedding', 'quality', 'reason'}]."""
+    import cv2
+    manager = get_model_manager()
+    results, faces, owners = [], [], []
+    for key, data in items:
+        result = {'key': key, 'embedding': None, 'quality': None, 'reason': None}
+        results.append(result)
+        image = cv2.imdecode(np.frombuffer(data, np.uint8), cv2.IMREAD_COLOR) if data else None
+        if image is None:
+            result['reason'] = 'unreadable image'
+            continue
+        try:
+            detected = [f for f in manager.detect_faces(image) if f['confidence'] >= MIN_FACE_CONFIDENCE]
+        except Exception as e:
+            result['reason'] = f'face detection failed: {e}'
+            continue
+        if not detected:
+            result['reason'] = 'no face found'
+            continue
+        if len(detected) > 1:
+            result['reason'] = 'more than one face'
+            continue
+        result['quality'], result['reason'] = face_quality(image, detected[0])
+        if result['reason'] is None:
+            faces.append(detected[0]['face'])
+            owners.append(result)
+    if faces:
+        for result, embedding in zip(owners, manager.embed_aligned(faces)):
+            result['embedding'] = embedding
+    return results
+
+
+_pool = None
+_pool_users = 0
+_pool_idle_timer = None
+_pool_lock = threading.Lock()
+
+
+def make_pool(workers=ENROLL_WORKERS):
+    # spawn: forking a process that has TensorFlow (or Flask's threads) loaded is unsafe.
+    return ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn'),
+                               initializer=init_worker)
+
+
+@contextlib.contextmanager
+def enrollment_pool():
+    """This process's pool for the enrollment endpoints, started on first use and stopped when idle."""
+    global _pool, _pool_users
+    with _pool_lock:
+        if _pool is None:
+            _pool = make_pool(ENROLL_SERVER_WORKERS)
+        _pool_users += 1
+        pool = _pool
+    try:
+        yield pool
+    finally:
+        with _pool_lock:
+            _pool_users -= 1
+            if _pool_users == 0:
+                _schedule_idle_shutdown()
+
+
+def _schedule_idle_shutdown():
+    # Caller holds _pool_lock.
+    global _pool_idle_timer
+    if _pool_idle_timer is not None:
+        _pool_idle_timer.cancel()
+    _pool_idle_timer = threading.Timer(ENROLL_POOL_IDLE_SECONDS, _shutdown_idle_pool)
+    _pool_idle_timer.daemon = True
+    _pool_idle_timer.start()
+
+
+def _shutdown_idle_pool():
+    global _pool, _pool_idle_timer
+    with _pool_lock:
+        if _pool is None or _pool_users or _pool_idle_timer is not threading.current_thread():
+            return  # in use again, or a newer timer will decide
+        pool, _pool, _pool_idle_timer = _pool, None, None
+    pool.shutdown()
+
+
+def embed_all(items, pool):
+    """Embed [(key, image bytes)] across the pool in ENROLL_BATCH_SIZE tasks; results in input order."""
+    batches = [items[i:i + ENROLL_BATCH_SIZE] for i in range(0, len(items), ENROLL_BATCH_SIZE)]
+    results = []
+    for batch_results in pool.map(embed_images, batches):
+        results.extend(batch_results)
+    return results
+
+
+def _normalize(matrix):
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return matrix / norms
+
+
+def _consistent_rows(normalized):
+    """Indices of the rows that agree with the student's other images."""
+    keep = np.arange(len(normalized))
+    while len(keep) > 2:
+        centroid = _normalize(normalized[keep].mean(axis=0, keepdims=True))[0]
+        distances = 1.0 - normalized[keep] @ centroid
+        worst = int(np.argmax(distances))
+        if distances[worst] <= CONSISTENCY_DISTANCE:
+            break
+        keep = np.delete(keep, worst)
+    if len(keep) == 2 and 1.0 - float(normalized[keep[0]] @ normalized[keep[1]]) > CONSISTENCY_DISTANCE * 2:
+        return keep[:0]  # two images of (apparently) different people; no way to tell which is right
+    return keep
+
+
+def _closest_other(normalized, user_id, ids, matrix):
+    """(user id, distance) of the nearest row in `matrix` not belonging to user_id, or None."""
+    if not len(ids) or matrix.shape[1] != normalized.shape[1]:
+        return None
+    others = ids != user_id
+    if not others.any():
+        return None
+    similarities = normalized @ matrix[others].T
+    best = np.unravel_index(int(np.argmax(similarities)), similarities.shape)
+    return int(ids[others][best[1]]), 1.0 - float(similarities[best])
+
+
+def student_partitions(user_ids):
+    """{user_id: (department, year)} of the given users."""
+    with engine.connect() as connection:
+        rows = connection.execute(select(User.id, User.department, User.year).where(User.id.in_(list(user_ids)))).all()
+    return {user_id: (department, year) for user_id, department, year in rows}
+
+
+def load_gallery(partitions):
+    """(ids, rows) of the current gallery snapshots of the given (department, year) partitions."""
+    ids, rows = [], []
+    for department, year in partitions:
+        _, snapshot = refresh_snapshot(department, year)
+        if len(snapshot.ids):
+            ids.append(np.asarray(snapshot.ids))
+            rows.append(np.asarray(snapshot.embeddings))
+    if not ids:
+        return np.empty(0, dtype=np.int64), np.empty((0, 0), dtype=np.float32)
+    return np.concatenate(ids), np.vstack(rows)
+
+
+def refresh_partitions(partitions):
+    for department, year in partitions:
+        refresh_snapshot(department, year)
+
+
+def enroll_students(students, pool=None, dry_run=False, intake=None, gallery=None, refresh=True):
+    """Enroll {user_id: [(image name, bytes)]}; returns one report dict per student.
+
+    `intake` collects (ids, normalized rows) of the students accepted so far, so
+    a bulk intake processed in several calls still catches a face enrolled twice.
+    `gallery` is the (ids, rows) to check for duplicates, by default the
+    snapshots of the students' departments/years; with `refresh`, those
+    snapshots are brought up to date after storing.
+    """
+    if pool is None:
+        with enrollment_pool() as pool:
+            return enroll_students(students, pool, dry_run, intake, gallery, refresh)
+    intake = intake if intake is not None else {'ids': [], 'rows': []}
+    items = [((user_id, i), data) for user_id, images in students.items()
+             for i, (_, data) in enumerate(images[:MAX_IMAGES_PER_STUDENT])]
+    results = {result['key']: result for result in embed_all(items, pool)}
+
+    partitions = set(student_partitions(students).values())
+    gallery_ids, gallery_rows = gallery if gallery is not None else load_gallery(partitions)
+
+    reports, to_store = [], []
+    for user_id, images in students.items():
+        report = {'user_id': user_id, 'status': 'rejected', 'reason': None, 'embeddings': 0, 'images': []}
+        reports.append(report)
+        accepted = []
+        for i, (name, _) in enumerate(images):
+            result = results.get((user_id, i), {'reason': 'too many images', 'quality': None, 'embedding': None})
+            report['images'].append({'name': name, 'accepted': result['embedding'] is not None,
+                                     'reason': result['reason'], 'quality': result['quality']})
+            if result['embedding'] is not None:
+                accepted.append(i)
+        if not accepted:
+            report['reason'] = 'no usable face image'
+            continue
+
+        embeddings = np.vstack([results[(user_id, i)]['embedding'] for i in accepted]).astype(np.float32)
+        normalized = _normalize(embeddings)
+        keep = _consistent_rows(normalized)
+        for position, i in enumerate(accepted):
+            if position not in keep:
+                report['images'][i].update(accepted=False, reason="does not match the student's other images")
+        if not len(keep):
+            report['reason'] = 'images do not show the same person'
+            continue
+        embeddings, normalized = embeddings[keep], normalized[keep]
+
+        duplicate = _closest_other(normalized, user_id, gallery_ids, gallery_rows)
+        if intake['ids']:
+            in_intake = _closest_other(normalized, user_id, np.asarray(intake['ids']), np.vstack(intake['rows']))
+            if in_intake and (duplicate is None or in_intake[1] < duplicate[1]):
+                duplicate = in_intake
+        if duplicate and duplicate[1] <= DUPLICATE_DISTANCE:
+            report['reason'] = f'face already enrolled for user {duplicate[0]} (distance {duplicate[1]:.2f})'
+            continue
+
+        intake['ids'].extend([user_id] * len(normalized))
+        intake['rows'].append(normalized)
+        report.update(status='enrolled', embeddings=len(embeddings))
+        to_store.append({'b_id': user_id, 'b_embeddings': pack_embeddings(embeddings),
+                         'b_updated_at': datetime.datetime.utcnow()})
+
+    if to_store and not dry_run:
+        users = User.__table__
+        with engine.begin() as connection:
+            connection.execute(
+                users.update().where(users.c.id == bindparam('b_id'))
+                .values(embeddings=bindparam('b_embeddings'), updated_at=bindparam('b_updated_at')),
+                to_store
+            )
+        if refresh:
+            refresh_partitions(partitions)
+    return reports
+
+
+def resolve_students(keys):
+    """{key: user id} for folder names that are a student's user id or email."""
+    ids = {key: int(key) for key in keys if key.isdigit()}
+    emails = {key.lower(): key for key in keys if not key.isdigit()}
+    with engine.connect() as connection:
+        rows = connection.execute(
+            select(User.id, User.email).where(
+                User.role.in_(STUDENT_ROLES),
+                or_(User.id.in_(ids.values()), User.email.in_(emails))
+            )
+        ).all()
+    by_id = {user_id for user_id, _ in rows}
+    by_email = {email.lower(): user_id for user_id, email in rows if email}
+    resolved = {key: user_id for key, user_id in ids.items() if user_id in by_id}
+    resolved.update({key: by_email[email] for email, key in emails.items() if email in by_email})
+    return resolved
+
+
+def scan_intake(path):
+    """{folder name: [image path or zip member]} for a folder or zip laid out as <student>/<image>."""
+    if zipfile.is_zipfile(path):
+        with zipfile.ZipFile(path) as archive:
+            names = [info.filename for info in archive.infolist() if not info.is_dir()]
+    else:
+        names = [os.path.relpath(os.path.join(root, filename), path)
+                 for root, _, filenames in os.walk(path) for filename in filenames]
+    students = {}
+    for name in sorted(names):
+        parts = name.replace(os.sep, '/').split('/')
+        if len(parts) < 2 or any(part.startswith(('.', '__MACOSX')) for part in parts):
+            continue
+        if parts[-1].lower().endswith(IMAGE_EXTENSIONS):
+            students.setdefault(parts[-2], []).append(name)
+    return students
+
+
+def iter_intake_rounds(path, students, per_round=STUDENTS_PER_ROUND):
+    """Yield {folder name: [(image name, bytes)]} for `per_round` students at a time."""
+    archive = zipfile.ZipFile(path) if zipfile.is_zipfile(path) else None
+    try:
+        keys = list(students)
+        for start in range(0, len(keys), per_round):
+            chunk = {}
+            for key in keys[start:start + per_round]:
+                images = []
+                for name in students[key][:MAX_IMAGES_PER_STUDENT]:
+                    if archive is not None:
+                        images.append((name, archive.read(name)))
+                    else:
+                        with open(os.path.join(path, name), 'rb') as f:
+                            images.append((name, f.read()))
+                chunk[key] = images
+            yield chunk
+    finally:
+        if archive is not None:
+            archive.close()
+
+
+def enroll_intake(path, workers=ENROLL_WORKERS, dry_run=False, per_round=STUDENTS_PER_ROUND, allowed=None, pool=None):
+    """Enroll every student folder in a folder or zip; returns the per-student reports.
+
+    `allowed`, if given, is a set of user ids the caller may enroll (e.g. an admin's department).
+    Without a `pool`, one with `workers` processes is started for this intake.
+    """
+    started = time.monotonic()
+    students = scan_intake(path)
+    resolved = resolve_students(students)
+    reports = []
+    for key in students:
+        if key not in resolved or (allowed is not None and resolved[key] not in allowed):
+            reports.append({'student': key, 'user_id': resolved.get(key), 'status': 'rejected',
+                            'reason': 'no such student', 'embeddings': 0, 'images': []})
+    students = {key: names for key, names in students.items() if key in resolved
+                and (allowed is None or resolved[key] in allowed)}
+    total = len(students)
+    print(f"Enrolling {total} student(s) from {path}{' (dry run)' if dry_run else ''}...")
+
+    # Every chunk checks against the galleries as they were before the intake;
+    # faces enrolled by earlier chunks are caught through `intake`.
+    partitions = set(student_partitions(resolved[key] for key in students).values())
+    gallery = load_gallery(partitions)
+    intake = {'ids': [], 'rows': []}
+    own_pool = pool is None
+    pool = make_pool(workers) if own_pool else pool
+    try:
+        done = 0
+        for chunk in iter_intake_rounds(path, students, per_round):
+            keys_by_id = {resolved[key]: key for key in chunk}
+            round_reports = enroll_students({resolved[key]: images for key, images in chunk.items()},
+                                            pool=pool, dry_run=dry_run, intake=intake, gallery=gallery, refresh=False)
+            for report in round_reports:
+                report['student'] = keys_by_id[report['user_id']]
+            reports.extend(round_reports)
+            done += len(chunk)
+            elapsed = time.monotonic() - started
+            print(f"  {done}/{total} student(s) processed ({done / elapsed:.1f}/s, {elapsed:.1f}s)")
+    finally:
+        if own_pool:
+            pool.shutdown()
+
+    enrolled = sum(1 for report in reports if report['status'] == 'enrolled')
+    if enrolled and not dry_run:
+        refresh_partitions(partitions)
+    print(f"✅ Enrolled {enrolled} student(s), rejected {len(reports) - enrolled} "
+          f"in {time.monotonic() - started:.1f}s.")
+    return reports
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Enroll student faces from a folder or zip of <email or user id>/<image>.")
+    parser.add_argument('path', help="intake folder or zip file")
+    parser.add_argument('--workers', type=int, default=ENROLL_WORKERS, help="embedding processes")
+    parser.add_argument('--dry-run', action='store_true', help="check and embed, but do not store")
+    args = parser.parse_args()
+    for report in enroll_intake(args.path, workers=args.workers, dry_run=args.dry_run):
+        if report['status'] != 'enrolled':
+            print(f"  ❌ {report['student']}: {report['reason']}")
+            for image in report['images']:
+                if not image['accepted']:
+                    print(f"      {image['name']}: {image['reason']}")
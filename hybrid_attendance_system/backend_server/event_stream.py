@@ -0,0 +1,320 @@
+"""
+Server-sent event stream of new notices and timetable entries.
+
+The write endpoints (send_notice, add_schedule) publish() in the transaction
+that stores the notice or schedule, so an event exists exactly when its row
+does; GET /api/events/<user_id> streams the events for that user's department and
+year as text/event-stream, so the mobile app can stop re-polling
+/api/notices and /api/schedules. Department-wide notices (year NULL) go to
+every year of the department.
+
+- publish() adds an event_log row to the caller's session, so every process
+  sees every committed event: each process that serves streams runs one EventLogPoller, which
+  preloads the last EVENT_BACKLOG rows and then reads new ones every
+  POLL_INTERVAL into the process's EventBroker. With
+  ATTENDANCE_EVENT_BACKEND=memory, the session's events go straight to the
+  broker once it commits instead (one process; for local testing).
+- Event ids are event_log.seq. A reconnecting client sends its last one back
+  as Last-Event-ID (or ?last_event_id= on the first connect) and gets what it
+  missed from the broker's backlog; if the id is older than that, or unknown,
+  it gets a `resync` event and should re-fetch over the REST endpoints.
+- Idle connections get a comment line every HEARTBEAT_INTERVAL seconds, which
+  keeps proxies from timing them out and detects clients that went away.
+  Streams end after STREAM_MAX_SECONDS; EventSource reconnects by itself.
+- A subscriber holds no queue, only the id of the last event it sent: waiting
+  connections sleep on one Condition per department and read new events
+  from the shared backlog, each serialized once.
+
+Streams are long-lived and mostly idle, so they get their own gevent service
+(gunicorn_events.conf.py serves create_events_app()) and the proxy sends
+/api/events/ there, while the rest of the API keeps its sync workers
+(gunicorn.conf.py). app.py registers the same blueprint for development.
+"""
+import os
+import threading
+import time
+from collections import deque, namedtuple
+
+from flask import Blueprint, Flask, Response, jsonify, request
+from flask_cors import CORS
+from sqlalchemy import event as sa_event, select, func
+from sqlalchemy.orm import load_only
+
+from database import engine, Session, User, EventLog
+from instrumentation import init_app as init_instrumentation, log
+from serializers import dumps
+
+EVENT_BACKEND = os.environ.get('ATTENDANCE_EVENT_BACKEND', 'database')  # or 'memory'
+EVENT_BACKLOG = 1000  # recent events each process keeps for Last-Event-ID resume
+EVENT_LOG_KEEP = 10000  # event_log rows kept; older ones are pruned by publish()
+PRUNE_EVERY = 100  # publishes between prunes
+POLL_INTERVAL = float(os.environ.get('ATTENDANCE_EVENT_POLL_INTERVAL', 0.5))  # seconds
+POLL_BATCH = 500  # event_log rows read per poll
+HEARTBEAT_INTERVAL = float(os.environ.get('ATTENDANCE_SSE_HEARTBEAT', 20))  # seconds
+STREAM_MAX_SECONDS = float(os.environ.get('ATTENDANCE_SSE_MAX_SECONDS', 3600))
+RETRY_MS = 5000  # client reconnect delay sent in the retry: field
+
+Event = namedtuple('Event', ['seq', 'department', 'year', 'payload'])
+
+
+class EventBroker:
+    """In-process fan-out of recent events to the streams waiting in this process."""
+
+    def __init__(self, backlog=EVENT_BACKLOG, epoch=None):
+        # Ids of events numbered here by publish() carry the broker's epoch, so
+        # ones from before a restart are recognized; event_log ids need none.
+        self.epoch = epoch
+        self.backlog = backlog
+        self._events = deque(maxlen=backlog)
+        self._sequence = 0
+        self._lock = threading.Lock()
+        self._conditions = {}  # department -> Condition sharing self._lock
+        self._subscribers = 0
+
+    def _condition(self, department):
+        condition = self._conditions.get(department)
+        if condition is None:
+            condition = self._conditions.setdefault(department, threading.Condition(self._lock))
+        return condition
+
+    def format_id(self, seq):
+        return f'{self.epoch}-{seq}' if self.epoch else str(seq)
+
+    def parse_id(self, event_id):
+        """Sequence number of an id this broker would issue, else None."""
+        event_id = event_id or ''
+        if self.epoch:
+            epoch, _, event_id = event_id.partition('-')
+            if epoch != self.epoch:
+                return None
+        return int(event_id) if event_id.isdigit() else None
+
+    def _append(self, seq, kind, department, year, body):
+        # Caller holds self._lock.
+        payload = f'id: {self.format_id(seq)}\nevent: {kind}\ndata: '.encode() + body + b'\n\n'
+        self._events.append(Event(seq, department, year, payload))
+        self._sequence = seq
+        self._condition(department).notify_all()
+
+    def publish(self, kind, department, year, data):
+        """Number an event here and wake its subscribers; returns the event id."""
+        body = dumps(data)
+        with self._lock:
+            seq = self._sequence + 1
+            self._append(seq, kind, department, year, body)
+        return self.format_id(seq)
+
+    def deliver(self, rows):
+        """Add events numbered elsewhere: (seq, kind, department, year, JSON bytes) rows in seq order."""
+        with self._lock:
+            for seq, kind, department, year, body in rows:
+                if seq > self._sequence:
+                    self._append(seq, kind, department, year, body)
+
+    def latest(self):
+        with self._lock:
+            return self._sequence
+
+    def resume_point(self, last_event_id):
+        """Sequence to continue after, or None if events since `last_event_id` are gone."""
+        seq = self.parse_id(last_event_id)
+        with self._lock:
+            oldest = self._events[0].seq if self._events else self._sequence + 1
+            if seq is None or seq > self._sequence or seq < oldest - 1:
+                return None
+            return seq
+
+    def _matching(self, after, department, year):
+        if self._sequence <= after:
+            return [], after
+        events = []
+        for event in reversed(self._events):
+            if event.seq <= after:
+                break
+            if event.department == department and (event.year is None or event.year == year):
+                events.append(event)
+        events.reverse()
+        return events, self._sequence
+
+    def wait(self, after, department, year, timeout):
+        """Events for (department, year) after sequence `after`, waiting up to `timeout` seconds.
+
+        Returns (events, new position); events is empty on timeout.
+        """
+        condition = self._condition(department)
+        with self._lock:
+            events, position = self._matching(after, department, year)
+            deadline = time.monotonic() + timeout
+            while not events:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                condition.wait(remaining)
+                events, position = self._matching(position, department, year)
+            return events, position
+
+    def subscribed(self, delta):
+        with self._lock:
+            self._subscribers += delta
+
+    def stats(self):
+        with self._lock:
+            return {
+                'latest': self._sequence,
+                'backlog': len(self._events),
+                'subscribers': self._subscribers,
+            }
+
+
+class EventLogPoller(threading.Thread):
+    """Feeds a broker from event_log: preload() the recent rows, then run() polls for new ones."""
+
+    def __init__(self, events, interval=POLL_INTERVAL):
+        super().__init__(daemon=True)
+        self.events = events
+        self.interval = interval
+        self.position = 0
+
+    def preload(self):
+        with engine.connect() as connection:
+            latest = connection.execute(select(func.coalesce(func.max(EventLog.seq), 0))).scalar()
+        self.position = max(0, latest - self.events.backlog)
+        while self.poll() == POLL_BATCH:
+            pass
+
+    def poll(self):
+        """Deliver the rows after the last one seen; returns how many there were."""
+        with engine.connect() as connection:
+            rows = connection.execute(
+                select(EventLog.seq, EventLog.kind, EventLog.department, EventLog.year, EventLog.payload)
+                .where(EventLog.seq > self.position).order_by(EventLog.seq).limit(POLL_BATCH)
+            ).all()
+        if rows:
+            self.events.deliver([(seq, kind, department, year, payload.encode())
+                                 for seq, kind, department, year, payload in rows])
+            self.position = rows[-1][0]
+        return len(rows)
+
+    def run(self):
+        while True:
+            try:
+                if self.poll() == POLL_BATCH:
+                    continue
+            except Exception:
+                log.exception("Error while polling event_log")
+            time.sleep(self.interval)
+
+
+broker = EventBroker(epoch=format(int(time.time()), 'x') if EVENT_BACKEND == 'memory' else None)
+_poller = None
+_poller_lock = threading.Lock()
+
+
+def start_poller():
+    """Start this process's event_log poller, once; the first stream served calls it."""
+    global _poller
+    if EVENT_BACKEND == 'memory':
+        return
+    with _poller_lock:
+        if _poller is None:
+            poller = EventLogPoller(broker)
+            poller.preload()
+            poller.start()
+            _poller = poller
+
+
+def publish(db_session, kind, department, year, data):
+    """Publish an event for (department, year) when db_session commits; year None reaches the whole department.
+
+    Nothing is published if the transaction rolls back.
+    """
+    if EVENT_BACKEND == 'memory':
+        db_session.connection()  # begin the transaction the event belongs to, so a rollback drops it
+        db_session.info.setdefault('events', []).append((kind, department, year, data))
+        return
+    row = EventLog(kind=kind, department=department, year=year, payload=dumps(data).decode('utf-8'))
+    db_session.add(row)
+    db_session.flush()
+    if row.seq % PRUNE_EVERY == 0:
+        db_session.query(EventLog).filter(EventLog.seq <= row.seq - EVENT_LOG_KEEP).delete(synchronize_session=False)
+
+
+@sa_event.listens_for(Session, 'after_commit')
+def _publish_committed(db_session):
+    for kind, department, year, data in db_session.info.pop('events', ()):
+        broker.publish(kind, department, year, data)
+
+
+@sa_event.listens_for(Session, 'after_soft_rollback')
+def _drop_rolled_back(db_session, previous_transaction):
+    db_session.info.pop('events', None)
+
+
+def iter_stream(department, year, last_event_id=None, events=broker,
+                heartbeat=HEARTBEAT_INTERVAL, max_seconds=STREAM_MAX_SECONDS):
+    """SSE lines for one connection: resume or resync, then events and heartbeats."""
+    yield f'retry: {RETRY_MS}\n\n'.encode()
+    position = events.resume_point(last_event_id) if last_event_id else None
+    if position is None:
+        position = events.latest()
+        if last_event_id:
+            yield b'event: resync\ndata: {"reason": "missed events are no longer available"}\n\n'
+    events.subscribed(1)
+    try:
+        ends_at = time.monotonic() + max_seconds
+        while True:
+            remaining = ends_at - time.monotonic()
+            if remaining <= 0:
+                return
+            batch, position = events.wait(position, department, year, min(heartbeat, remaining))
+            if batch:
+                yield b''.join(event.payload for event in batch)
+            else:
+                yield b': heartbeat\n\n'
+    finally:
+        events.subscribed(-1)
+
+
+def user_partition(user_id):
+    """(department, year) of a user, or None."""
+    db_session = Session()
+    try:
+        user = db_session.get(User, user_id, options=[load_only(User.department, User.year)])
+        return (user.department, user.year) if user else None
+    finally:
+        db_session.close()
+
+
+events = Blueprint('events', __name__)
+
+
+@events.route('/api/events/<int:user_id>')
+def get_events(user_id):
+    """Server-sent events for the user's department and year (new notices and schedules)."""
+    try:
+        start_poller()
+        scope = user_partition(user_id)
+    except Exception as e:
+        log.exception("Error in get_events")
+        return jsonify({'error': str(e)}), 500
+    if scope is None:
+        return jsonify({'error': 'User not found'}), 404
+    department, year = scope
+    last_event_id = request.headers.get('Last-Event-ID') or request.args.get('last_event_id')
+    body = iter_stream(department, year, last_event_id)
+    headers = {'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}  # no proxy buffering
+    return Response(body, mimetype='text/event-stream', headers=headers)
+
+
+@events.route('/api/events/stats', methods=['GET'])
+def get_event_stats():
+    return jsonify(broker.stats()), 200
+
+
+def create_events_app():
+    """The event stream endpoints alone, for the gevent service."""
+    app = Flask(__name__)
+    CORS(app)
+    app.register_blueprint(events)
+    init_instrumentation(app)
+    return app
@@ -0,0 +1,122 @@
+"""
+Per-department/year gallery snapshots served at /api/sync/gallery.
+
+A snapshot is rebuilt lazily when it is requested: user rows logged in
+change_log for that department/year after the snapshot's version are applied to
+the previous snapshot (their old rows dropped, current embeddings appended), so
+a signup only re-reads that user and not the whole department. Without a
+previous snapshot, or when it cannot be read, the gallery is built from scratch.
+Rebuilds of one partition are serialized across threads and processes (every
+gunicorn worker) with an flock on the snapshot's .lock file.
+
+    python gallery_snapshots.py           # refresh every department/year
+"""
+import fcntl
+import os
+import re
+import sys
+
+import numpy as np
+from sqlalchemy import select, func
+
+from database import engine, ChangeLog, User, decode_embeddings
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'shared'))
+from gallery_snapshot import write_snapshot, read_snapshot
+
+SNAPSHOT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'gallery_snapshots')
+
+
+def snapshot_path(department=None, year=None):
+    key = re.sub(r'[^A-Za-z0-9_-]', '_', department) if department else 'all'
+    return os.path.join(SNAPSHOT_DIR, f"{key}_{year if year is not None else 'all'}.gal")
+
+
+def _partition_filter(query, column_owner, department, year):
+    if department is not None:
+        query = query.where(column_owner.department == department)
+    if year is not None:
+        query = query.where(column_owner.year == year)
+    return query
+
+
+def _load_users(connection, department, year, user_ids=None):
+    """(ids, names, matrix) of the partition's users with embeddings, user rows contiguous."""
+    query = _partition_filter(select(User.id, User.name, User.embeddings), User, department, year)
+    if user_ids is not None:
+        query = query.where(User.id.in_(user_ids))
+    ids, names, blocks = [], {}, []
+    for user_id, name, blob in connection.execute(query.order_by(User.id)):
+        block = decode_embeddings(blob)
+        if block.size == 0:
+            continue
+        blocks.append(block)
+        ids.extend([user_id] * len(block))
+        names[user_id] = name
+    return ids, names, blocks
+
+
+def refresh_snapshot(department=None, year=None):
+    """Bring the partition's snapshot file up to date; returns (path, GallerySnapshot)."""
+    path = snapshot_path(department, year)
+    os.makedirs(SNAPSHOT_DIR, exist_ok=True)
+    # flock locks belong to the open file, so this excludes other threads as well as other workers.
+    with open(f'{path}.lock', 'a') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        return _refresh_locked(path, department, year)
+
+
+def _refresh_locked(path, department, year):
+    previous = None
+    if os.path.exists(path):
+        try:
+            previous = read_snapshot(path)
+        except (OSError, ValueError) as e:
+            print(f"Rebuilding unreadable gallery snapshot {path}: {e}")
+
+    with engine.connect() as connection:
+        if previous is None:
+            version = connection.execute(select(func.coalesce(func.max(ChangeLog.seq), 0))).scalar()
+            ids, names, blocks = _load_users(connection, department, year)
+            write_snapshot(path, np.vstack(blocks) if blocks else np.empty((0, 0)), ids, names, version,
+                           department=department, year=year)
+            print(f"Built gallery snapshot {path}: {len(names)} user(s), version {version}.")
+            return path, read_snapshot(path)
+
+        changes = connection.execute(_partition_filter(
+            select(ChangeLog.seq, ChangeLog.entity_id)
+            .where(ChangeLog.entity == 'user', ChangeLog.seq > previous.version),
+            ChangeLog, department, year
+        ).order_by(ChangeLog.seq)).all()
+        if not changes:
+            return path, previous
+
+        # Whatever the op, a changed user's current rows (if any) are re-read;
+        # users deleted or moved out of the partition simply are not found.
+        changed = {user_id for _, user_id in changes}
+        new_ids, new_names, new_blocks = _load_users(connection, department, year, changed)
+
+    keep = ~np.isin(previous.ids, list(changed))
+    names = {user_id: name for user_id, name in previous.names.items() if user_id not in changed}
+    names.update(new_names)
+    kept = np.asarray(previous.embeddings[keep])
+    blocks = ([kept] if len(kept) else []) + new_blocks
+    ids = np.concatenate([np.asarray(previous.ids[keep]), np.asarray(new_ids, dtype=np.int64)])
+    version = changes[-1][0]
+    # Drop the memmaps before the file is replaced underneath them.
+    del previous, kept
+    write_snapshot(path, np.vstack(blocks) if blocks else np.empty((0, 0)), ids, names, version,
+                   department=department, year=year)
+    print(f"Updated gallery snapshot {path}: {len(changed)} user(s) changed, version {version}.")
+    return path, read_snapshot(path)
+
+
+def refresh_all():
+    with engine.connect() as connection:
+        partitions = connection.execute(select(User.department, User.year).distinct()).all()
+    for department, year in partitions:
+        refresh_snapshot(department, year)
+
+
+if __name__ == '__main__':
+    refresh_all()
@@ -0,0 +1,30 @@
+"""
+gunicorn settings for the API: `gunicorn -c gunicorn.conf.py app:app`.
+
+Sync workers: requests block on SQLite, password hashing and the enrollment
+pool, so each gets a process of its own. A worker only starts its enrollment
+pool (ENROLL_SERVER_WORKERS processes, default one) when it serves an
+enrollment request and stops it once idle; run large intakes with
+enrollment.py instead. /api/events streams are served by the separate gevent
+service in gunicorn_events.conf.py; route /api/events/ to it at the proxy.
+The proxy must set X-Forwarded-For: /metrics is refused to requests that
+carry it, so it stays reachable from this host only.
+"""
+import multiprocessing
+import os
+import shutil
+import tempfile
+
+bind = os.environ.get('ATTENDANCE_BIND', '0.0.0.0:5000')
+worker_class = 'sync'
+workers = int(os.environ.get('ATTENDANCE_WORKERS', multiprocessing.cpu_count() * 2 + 1))
+timeout = 120  # an admin's bulk enrollment request can take a while
+keepalive = 5
+
+# Each worker writes its metrics here and /metrics adds them all up (see instrumentation.py).
+os.environ.setdefault('ATTENDANCE_METRICS_DIR', os.path.join(tempfile.gettempdir(), 'attendance_metrics', 'api'))
+
+
+def on_starting(server):
+    # Counters start at zero with the master: drop the files of a previous run.
+    shutil.rmtree(os.environ['ATTENDANCE_METRICS_DIR'], ignore_errors=True)
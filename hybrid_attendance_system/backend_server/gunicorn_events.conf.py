@@ -0,0 +1,29 @@
+"""
+gunicorn settings for the event stream service: `gunicorn -c gunicorn_events.conf.py`.
+
+Serves only the /api/events endpoints (event_stream.create_events_app). The
+gevent worker runs each stream in a greenlet, so an idle connection costs a
+few KB instead of a thread; gevent patches the threading primitives the
+broker waits on. Events come from the event_log table, so any number of
+workers (here or in the API service) can publish and stream.
+"""
+import os
+import shutil
+import tempfile
+
+wsgi_app = 'event_stream:create_events_app()'
+bind = os.environ.get('ATTENDANCE_EVENTS_BIND', '0.0.0.0:5001')
+worker_class = 'gevent'
+workers = int(os.environ.get('ATTENDANCE_EVENT_WORKERS', 2))
+worker_connections = int(os.environ.get('ATTENDANCE_WORKER_CONNECTIONS', 5000))  # open streams per worker
+timeout = 60  # worker heartbeat; idle streams still send data every HEARTBEAT_INTERVAL
+graceful_timeout = 10  # streams are cut on restart; clients resume with Last-Event-ID
+keepalive = 75
+
+# Each worker writes its metrics here and /metrics adds them all up (see instrumentation.py).
+os.environ.setdefault('ATTENDANCE_METRICS_DIR', os.path.join(tempfile.gettempdir(), 'attendance_metrics', 'events'))
+
+
+def on_starting(server):
+    # Counters start at zero with the master: drop the files of a previous run.
+    shutil.rmtree(os.environ['ATTENDANCE_METRICS_DIR'], ignore_errors=True)
@@ -0,0 +1,488 @@
+"""
+Per-route request metrics, SQL accounting and structured logging for the API.
+
+init_app(app) installs request hooks that record, per (method, route):
+latency histogram, SQL statement count and time (from engine events on
+database.engine), response size and 5xx count. /metrics serves them in the
+Prometheus text format (?format=json for JSON). The slowest SQL statements are
+tracked too.
+
+Metrics are kept per process. With ATTENDANCE_METRICS_DIR set (the gunicorn
+configs set it), every worker writes its counters to <dir>/<pid>.json every
+METRICS_FLUSH_INTERVAL seconds and /metrics, whichever worker answers it, adds
+up all the files, so a scrape sees the whole service. Workers that have exited
+keep their counters; only their open-stream gauges are dropped.
+
+/metrics (which includes SQL text) is served only to requests made directly
+from this host: a request that came through the proxy carries X-Forwarded-For
+(or Forwarded / X-Real-IP) and is refused, unless ATTENDANCE_METRICS_REMOTE=1.
+
+Logging goes through a QueueHandler, so a request thread never blocks on
+stdout; a QueueListener thread writes one JSON object per line. Access log
+lines are sampled at LOG_SAMPLE_RATE; errors and slow requests are always
+logged.
+
+With ATTENDANCE_PROFILE_SLOW_MS set, PROFILE_SAMPLE_RATE of the requests run
+under cProfile (one at a time) and those slower than the threshold are dumped
+to PROFILE_DIR as .prof files, with their top functions logged.
+
+text/event-stream responses stay open for as long as the client listens, so
+they are counted as streams (opened, currently open) instead: no latency,
+slow-request log line or profile.
+"""
+import cProfile
+import io
+import itertools
+import json
+import logging
+import logging.handlers
+import math
+import os
+import pstats
+import queue
+import random
+import re
+import tempfile
+import threading
+import time
+from collections import defaultdict
+
+from flask import Response, g, has_request_context, jsonify, request
+from sqlalchemy import event
+
+from database import engine
+
+LATENCY_BUCKETS_MS = (5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, math.inf)
+SQL_COUNT_BUCKETS = (0, 1, 2, 5, 10, 25, 50, 100, math.inf)
+SIZE_BUCKETS = (1 << 10, 1 << 14, 1 << 16, 1 << 18, 1 << 20, 1 << 22, math.inf)
+SLOW_REQUEST_MS = float(os.environ.get('ATTENDANCE_SLOW_REQUEST_MS', 500))
+LOG_SAMPLE_RATE = float(os.environ.get('ATTENDANCE_LOG_SAMPLE_RATE', 0.05))
+LOG_LEVEL = os.environ.get('ATTENDANCE_LOG_LEVEL', 'INFO')
+METRICS_ALLOW_REMOTE = os.environ.get('ATTENDANCE_METRICS_REMOTE') == '1'
+METRICS_DIR = os.environ.get('ATTENDANCE_METRICS_DIR') or None  # shared by the workers of one service
+METRICS_FLUSH_INTERVAL = 5  # seconds between a worker's writes of its metrics file
+PROFILE_SLOW_MS = float(os.environ['ATTENDANCE_PROFILE_SLOW_MS']) if os.environ.get('ATTENDANCE_PROFILE_SLOW_MS') else None
+PROFILE_SAMPLE_RATE = float(os.environ.get('ATTENDANCE_PROFILE_SAMPLE_RATE', 0.1))
+PROFILE_DIR = os.environ.get('ATTENDANCE_PROFILE_DIR') or os.path.join(os.path.dirname(os.path.abspath(__file__)), 'profiles')
+MAX_TRACKED_STATEMENTS = 200
+LOCAL_ADDRESSES = ('127.0.0.1', '::1')
+FORWARDING_HEADERS = ('X-Forwarded-For', 'Forwarded', 'X-Real-IP')  # set by the proxy
+
+log = logging.getLogger('attendance')
+
+
+# --- structured logging ------------------------------------------------------
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            'ts': self.formatTime(record, '%Y-%m-%dT%H:%M:%S'),
+            'level': record.levelname,
+            'logger': record.name,
+            'msg': record.getMessage(),
+        }
+        entry.update(getattr(record, 'fields', {}))
+        if record.exc_info:
+            entry['exc'] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+_listener = None
+
+
+def configure_logging(level=LOG_LEVEL):
+    """Route the 'attendance' logger through a queue to a background stdout writer. Idempotent."""
+    global _listener
+    if _listener is not None:
+        return _listener
+    records = queue.SimpleQueue()
+    stream = logging.StreamHandler()
+    stream.setFormatter(JsonFormatter())
+    _listener = logging.handlers.QueueListener(records, stream, respect_handler_level=True)
+    _listener.start()
+    log.addHandler(logging.handlers.QueueHandler(records))
+    log.setLevel(level)
+    log.propagate = False
+    return _listener
+
+
+# --- metrics -----------------------------------------------------------------
+
+class Histogram:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+        self.sum += value
+        self.count += 1
+
+    def add(self, counts, total):
+        """Add another process's bucket counts and sum."""
+        self.counts = [mine + theirs for mine, theirs in zip(self.counts, counts)]
+        self.sum += total
+        self.count += sum(counts)
+
+    def quantile(self, q):
+        """Upper bucket bound below which a fraction q of observations fall."""
+        if not self.count:
+            return None
+        target, seen = q * self.count, 0
+        for bound, count in zip(self.buckets, self.counts):
+            seen += count
+            if seen >= target:
+                return bound
+        return self.buckets[-1]
+
+    def to_dict(self):
+        cumulative, buckets = 0, {}
+        for bound, count in zip(self.buckets, self.counts):
+            cumulative += count
+            buckets['+Inf' if bound == math.inf else str(bound)] = cumulative
+        quantiles = {f'p{round(q * 100)}': self.quantile(q) for q in (0.5, 0.95, 0.99)}
+        return dict({'count': self.count, 'sum': round(self.sum, 3), 'buckets': buckets},
+                    **{name: '+Inf' if value == math.inf else value for name, value in quantiles.items()})
+
+
+class RouteMetrics:
+    def __init__(self):
+        self.latency_ms = Histogram(LATENCY_BUCKETS_MS)
+        self.sql_statements = Histogram(SQL_COUNT_BUCKETS)
+        self.sql_ms = 0.0
+        self.response_bytes = Histogram(SIZE_BUCKETS)
+        self.statuses = defaultdict(int)
+        self.streamed = 0
+        self.streams_opened = 0
+        self.streams_open = 0
+
+
+class Metrics:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.routes = defaultdict(RouteMetrics)
+        self.statements = {}  # normalized SQL -> [count, total ms, max ms]
+        self.started = time.time()
+
+    def record_request(self, route, status, latency_ms, sql_count, sql_ms, size):
+        with self._lock:
+            metrics = self.routes[route]
+            metrics.latency_ms.observe(latency_ms)
+            metrics.sql_statements.observe(sql_count)
+            metrics.sql_ms += sql_ms
+            metrics.statuses[status] += 1
+            if size is None:
+                metrics.streamed += 1
+            else:
+                metrics.response_bytes.observe(size)
+
+    def record_stream(self, route, status=None, closed=False):
+        """An event stream opened (with its status) or, with `closed`, ended."""
+        with self._lock:
+            metrics = self.routes[route]
+            if closed:
+                metrics.streams_open -= 1
+            else:
+                metrics.statuses[status] += 1
+                metrics.streams_opened += 1
+                metrics.streams_open += 1
+
+    def record_statement(self, statement, ms):
+        key = re.sub(r'\s+', ' ', statement).strip()[:300]
+        with self._lock:
+            stats = self.statements.get(key)
+            if stats is None:
+                if len(self.statements) >= MAX_TRACKED_STATEMENTS:
+                    # Keep the table bounded: forget the cheapest statement seen so far.
+                    del self.statements[min(self.statements, key=lambda k: self.statements[k][1])]
+                stats = self.statements[key] = [0, 0.0, 0.0]
+            stats[0] += 1
+            stats[1] += ms
+            stats[2] = max(stats[2], ms)
+
+    def state(self):
+        """The counters as plain JSON, for the other workers' /metrics to add up."""
+        with self._lock:
+            return {
+                'pid': os.getpid(),
+                'started': self.started,
+                'routes': [
+                    [method, rule, {
+                        'latency_ms': [m.latency_ms.counts, m.latency_ms.sum],
+                        'sql_statements': [m.sql_statements.counts, m.sql_statements.sum],
+                        'response_bytes': [m.response_bytes.counts, m.response_bytes.sum],
+                        'sql_ms': m.sql_ms,
+                        'statuses': dict(m.statuses),
+                        'streamed': m.streamed,
+                        'streams_opened': m.streams_opened,
+                        'streams_open': m.streams_open,
+                    }]
+                    for (method, rule), m in self.routes.items()
+                ],
+                'statements': {sql: list(stats) for sql, stats in self.statements.items()},
+            }
+
+    def add_state(self, state, live=True):
+        """Add a state() from another process; `live` False drops its open-stream gauges."""
+        with self._lock:
+            self.started = min(self.started, state['started'])
+            for method, rule, values in state['routes']:
+                m = self.routes[(method, rule)]
+                for attribute in ('latency_ms', 'sql_statements', 'response_bytes'):
+                    getattr(m, attribute).add(*values[attribute])
+                m.sql_ms += values['sql_ms']
+                for status, count in values['statuses'].items():
+                    m.statuses[int(status)] += count
+                m.streamed += values['streamed']
+                m.streams_opened += values['streams_opened']
+                if live:
+                    m.streams_open += values['streams_open']
+            for sql, (count, total, worst) in state['statements'].items():
+                stats = self.statements.setdefault(sql, [0, 0.0, 0.0])
+                stats[0] += count
+                stats[1] += total
+                stats[2] = max(stats[2], worst)
+
+    def snapshot(self, top_statements=20):
+        with self._lock:
+            routes = {}
+            for (method, rule), m in sorted(self.routes.items()):
+                routes[f'{method} {rule}'] = {
+                    'requests': m.latency_ms.count,
+                    'statuses': dict(m.statuses),
+                    'latency_ms': m.latency_ms.to_dict(),
+                    'sql_statements': m.sql_statements.to_dict(),
+                    'sql_ms_total': round(m.sql_ms, 3),
+                    'response_bytes': m.response_bytes.to_dict(),
+                    'streamed_responses': m.streamed,
+                    'streams_opened': m.streams_opened,
+                    'streams_open': m.streams_open,
+                }
+            slowest = sorted(self.statements.items(), key=lambda item: item[1][1], reverse=True)[:top_statements]
+            return {
+                'uptime_s': round(time.time() - self.started, 1),
+                'routes': routes,
+                'slowest_statements': [
+                    {'sql': sql, 'count': count, 'total_ms': round(total, 3), 'max_ms': round(worst, 3),
+                     'avg_ms': round(total / count, 3)}
+                    for sql, (count, total, worst) in slowest
+                ],
+            }
+
+    def prometheus(self):
+        lines = []
+
+        def histogram(name, help_text, attribute):
+            lines.append(f'# HELP {name} {help_text}')
+            lines.append(f'# TYPE {name} histogram')
+            for (method, rule), m in sorted(self.routes.items()):
+                h = getattr(m, attribute)
+                labels = f'method="{method}",route="{rule}"'
+                cumulative = 0
+                for bound, count in zip(h.buckets, h.counts):
+                    cumulative += count
+                    le = '+Inf' if bound == math.inf else bound
+                    lines.append(f'{name}_bucket{{{labels},le="{le}"}} {cumulative}')
+                lines.append(f'{name}_sum{{{labels}}} {h.sum:.3f}')
+                lines.append(f'{name}_count{{{labels}}} {h.count}')
+
+        with self._lock:
+            histogram('http_request_duration_ms', 'Request latency in milliseconds.', 'latency_ms')
+            histogram('http_request_sql_statements', 'SQL statements executed per request.', 'sql_statements')
+            histogram('http_response_size_bytes', 'Response body size (non-streamed responses).', 'response_bytes')
+            lines.append('# HELP http_request_sql_ms_total Time spent in SQL, milliseconds.')
+            lines.append('# TYPE http_request_sql_ms_total counter')
+            for (method, rule), m in sorted(self.routes.items()):
+                lines.append(f'http_request_sql_ms_total{{method="{method}",route="{rule}"}} {m.sql_ms:.3f}')
+            streams = [((method, rule), m) for (method, rule), m in sorted(self.routes.items()) if m.streams_opened]
+            lines.append('# HELP http_event_streams_total Event streams opened.')
+            lines.append('# TYPE http_event_streams_total counter')
+            for (method, rule), m in streams:
+                lines.append(f'http_event_streams_total{{method="{method}",route="{rule}"}} {m.streams_opened}')
+            lines.append('# HELP http_event_streams_open Event streams currently open.')
+            lines.append('# TYPE http_event_streams_open gauge')
+            for (method, rule), m in streams:
+                lines.append(f'http_event_streams_open{{method="{method}",route="{rule}"}} {m.streams_open}')
+            lines.append('# HELP http_responses_total Responses by status code.')
+            lines.append('# TYPE http_responses_total counter')
+            for (method, rule), m in sorted(self.routes.items()):
+                for status, count in sorted(m.statuses.items()):
+                    lines.append(f'http_responses_total{{method="{method}",route="{rule}",status="{status}"}} {count}')
+        return '\n'.join(lines) + '\n'
+
+
+metrics = Metrics()
+
+
+def write_process_metrics(directory=METRICS_DIR):
+    """Replace this process's file in the shared metrics directory."""
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=directory, suffix='.tmp')
+    with os.fdopen(fd, 'w') as f:
+        json.dump(metrics.state(), f)
+    os.replace(tmp_path, os.path.join(directory, f'{os.getpid()}.json'))
+
+
+def _process_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def service_metrics(directory=METRICS_DIR):
+    """Every worker's metrics added up; just this process's without a metrics directory."""
+    if directory is None:
+        return metrics
+    write_process_metrics(directory)
+    combined = Metrics()
+    for name in os.listdir(directory):
+        if not name.endswith('.json'):
+            continue
+        try:
+            with open(os.path.join(directory, name)) as f:
+                state = json.load(f)
+        except (OSError, ValueError):
+            continue  # removed since listdir
+        combined.add_state(state, live=_process_alive(state['pid']))
+    return combined
+
+
+def _flush_metrics_forever():
+    while True:
+        time.sleep(METRICS_FLUSH_INTERVAL)
+        try:
+            write_process_metrics(METRICS_DIR)
+        except OSError:
+            log.exception("Could not write process metrics")
+
+
+# --- SQL accounting ----------------------------------------------------------
+
+@event.listens_for(engine, 'before_cursor_execute')
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('query_started', []).append(time.perf_counter())
+
+
+@event.listens_for(engine, 'after_cursor_execute')
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    ms = (time.perf_counter() - conn.info['query_started'].pop()) * 1000
+    metrics.record_statement(statement, ms)
+    if has_request_context():
+        state = g.get('request_metrics')
+        if state is not None:
+            state['sql_count'] += 1
+            state['sql_ms'] += ms
+
+
+# --- request hooks -----------------------------------------------------------
+
+_profiling = threading.Lock()  # cProfile cannot profile two threads' requests at once
+_profile_ids = itertools.count(1)
+
+
+def _route():
+    return request.method, request.url_rule.rule if request.url_rule else '<unmatched>'
+
+
+def _finish(state, status, size):
+    if state.get('done'):
+        return
+    state['done'] = True
+    latency_ms = (time.perf_counter() - state['started']) * 1000
+    method, rule = state['route']
+    metrics.record_request((method, rule), status, latency_ms, state['sql_count'], state['sql_ms'], size)
+    slow = latency_ms >= SLOW_REQUEST_MS
+    if status >= 500 or slow or random.random() < LOG_SAMPLE_RATE:
+        log.log(logging.WARNING if status >= 500 or slow else logging.INFO, 'request', extra={'fields': {
+            'method': method, 'route': rule, 'path': state['path'], 'status': status,
+            'ms': round(latency_ms, 2), 'sql': state['sql_count'], 'sql_ms': round(state['sql_ms'], 2),
+            'bytes': size, 'slow': slow,
+        }})
+    profiler = _stop_profiler(state)
+    if profiler is not None and latency_ms >= PROFILE_SLOW_MS:
+        _dump_profile(profiler, rule, latency_ms)
+
+
+def _stop_profiler(state):
+    profiler = state.pop('profiler', None)
+    if profiler is not None:
+        profiler.disable()
+        _profiling.release()
+    return profiler
+
+
+def _dump_profile(profiler, rule, latency_ms):
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+    name = re.sub(r'[^A-Za-z0-9]+', '_', rule).strip('_') or 'root'
+    path = os.path.join(PROFILE_DIR, f'{time.strftime("%Y%m%d-%H%M%S")}_{os.getpid()}-{next(_profile_ids)}'
+                                     f'_{name}_{latency_ms:.0f}ms.prof')
+    profiler.dump_stats(path)
+    summary = io.StringIO()
+    pstats.Stats(profiler, stream=summary).sort_stats('cumulative').print_stats(15)
+    log.warning('slow request profile', extra={'fields': {'route': rule, 'ms': round(latency_ms, 2),
+                                                          'profile': path, 'top': summary.getvalue()}})
+
+
+def _before_request():
+    g.request_metrics = state = {
+        'started': time.perf_counter(), 'route': _route(), 'path': request.path, 'sql_count': 0, 'sql_ms': 0.0,
+    }
+    if PROFILE_SLOW_MS is not None and random.random() < PROFILE_SAMPLE_RATE and _profiling.acquire(blocking=False):
+        state['profiler'] = profiler = cProfile.Profile()
+        profiler.enable()
+
+
+def _after_request(response):
+    state = g.get('request_metrics')
+    if state is None:
+        return response
+    if response.mimetype == 'text/event-stream':
+        state['done'] = True
+        _stop_profiler(state)
+        metrics.record_stream(state['route'], response.status_code)
+        response.call_on_close(lambda: metrics.record_stream(state['route'], closed=True))
+    elif response.content_length is None and response.is_streamed:
+        # Generated bodies finish when the server closes them, so SQL run while streaming is counted too.
+        response.call_on_close(lambda: _finish(state, response.status_code, None))
+    else:
+        _finish(state, response.status_code, response.content_length or 0)
+    return response
+
+
+def _teardown_request(exc):
+    state = g.get('request_metrics')
+    if state is not None and exc is not None:
+        _finish(state, 500, 0)
+
+
+def _local_request():
+    # Behind the proxy every request comes from 127.0.0.1; the proxy's forwarding headers tell them apart.
+    return request.remote_addr in LOCAL_ADDRESSES and not any(name in request.headers for name in FORWARDING_HEADERS)
+
+
+def metrics_endpoint():
+    if not METRICS_ALLOW_REMOTE and not _local_request():
+        return jsonify({'error': 'Metrics are only served to local clients'}), 403
+    combined = service_metrics(METRICS_DIR)
+    if request.args.get('format') == 'json':
+        return jsonify(combined.snapshot()), 200
+    return Response(combined.prometheus(), mimetype='text/plain; version=0.0.4')
+
+
+def init_app(app):
+    configure_logging()
+    app.before_request(_before_request)
+    app.after_request(_after_request)
+    app.teardown_request(_teardown_request)
+    app.add_url_rule('/metrics', 'metrics', metrics_endpoint)
+    if METRICS_DIR is not None:
+        threading.Thread(target=_flush_metrics_forever, daemon=True).start()
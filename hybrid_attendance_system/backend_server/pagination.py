@@ -0,0 +1,84 @@
+"""
+Keyset pagination over (timestamp, id), newest first.
+
+List endpoints take ?limit=&cursor=&since=&until= and keep returning a plain
+JSON list; the cursor for the next (older) page is sent in the X-Next-Cursor
+header and is absent on the last page. Each page is an index range scan that
+starts where the previous one stopped, so its cost does not depend on how
+much history precedes it.
+"""
+import base64
+import datetime
+from collections import namedtuple
+
+from sqlalchemy import or_
+
+DEFAULT_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 200
+NEXT_CURSOR_HEADER = 'X-Next-Cursor'
+
+# cursor is (timestamp, id) of the last row of the previous page, or None.
+PageParams = namedtuple('PageParams', ['limit', 'cursor', 'since', 'until'])
+
+
+def encode_cursor(timestamp, row_id):
+    return base64.urlsafe_b64encode(f'{timestamp.isoformat()}|{row_id}'.encode('utf-8')).decode('ascii')
+
+
+def decode_cursor(value):
+    try:
+        timestamp, row_id = base64.urlsafe_b64decode(value.encode('ascii')).decode('utf-8').split('|')
+        return datetime.datetime.fromisoformat(timestamp), int(row_id)
+    except (ValueError, UnicodeError):
+        raise ValueError('invalid cursor')
+
+
+def _parse_time(value, name):
+    try:
+        parsed = datetime.datetime.fromisoformat(value)
+    except ValueError:
+        raise ValueError(f'{name} must be an ISO 8601 date or datetime')
+    if parsed.tzinfo is not None:
+        # Stored timestamps are naive; compare in UTC.
+        parsed = parsed.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+    return parsed
+
+
+def parse_page_args(args):
+    """PageParams from request args; raises ValueError with a client-facing message."""
+    try:
+        limit = int(args.get('limit', DEFAULT_PAGE_SIZE))
+    except ValueError:
+        raise ValueError('limit must be an integer')
+    limit = min(max(limit, 1), MAX_PAGE_SIZE)
+    cursor = decode_cursor(args['cursor']) if args.get('cursor') else None
+    since = _parse_time(args['since'], 'since') if args.get('since') else None
+    until = _parse_time(args['until'], 'until') if args.get('until') else None
+    return PageParams(limit, cursor, since, until)
+
+
+def cache_key(page):
+    """Hashable form of the page parameters for response cache keys."""
+    return (page.limit, page.cursor, page.since, page.until)
+
+
+def apply_keyset(query, timestamp_column, id_column, page):
+    """Filter to the page's window; order by (timestamp, id) descending and fetch one extra row."""
+    if page.since is not None:
+        query = query.filter(timestamp_column >= page.since)
+    if page.until is not None:
+        query = query.filter(timestamp_column < page.until)
+    if page.cursor is not None:
+        timestamp, row_id = page.cursor
+        # The first term is the index range; the second only breaks timestamp ties.
+        query = query.filter(timestamp_column <= timestamp,
+                             or_(timestamp_column < timestamp, id_column < row_id))
+    return query.order_by(timestamp_column.desc(), id_column.desc()).limit(page.limit + 1)
+
+
+def split_page(rows, limit):
+    """(rows of this page, extra headers) from up to limit + 1 rows with .timestamp and .id."""
+    if len(rows) <= limit:
+        return rows, {}
+    rows = rows[:limit]
+    return rows, {NEXT_CURSOR_HEADER: encode_cursor(rows[-1].timestamp, rows[-1].id)}
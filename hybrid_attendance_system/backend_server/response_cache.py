@@ -0,0 +1,218 @@
+"""
+In-process read-through cache for the endpoints the mobile app polls.
+
+Keys are tuples whose first element is the namespace, e.g.
+('notices', department, year, <page>), ('schedules', department, year),
+('attendance', user_id, <page>) and ('user', user_id) for the user ->
+(department, year) lookup those endpoints start with. Entries expire after CACHE_TTL
+seconds and the least recently used one is evicted beyond CACHE_MAX_ENTRIES.
+
+Every gunicorn worker has its own cache, so writes are announced through the
+database: write endpoints call invalidate_shared() with key prefixes inside
+their own transaction, which bumps the generation of each prefix's scope in
+cache_generations (SHARED_SCOPES says how much of a key is its scope).
+cached_json_response() reads the scope's generation (one primary-key lookup)
+before every lookup and treats an entry built at an older one as a miss, so
+no process serves, or answers 304 for, a response from before a committed
+write. The TTL still bounds staleness from writes that bypass the endpoints
+(cleanup_scheduler, direct SQL).
+
+Cached responses carry a content-hash ETag and a Last-Modified time, so a
+client that revalidates gets a 304 without a body.
+"""
+import datetime
+import hashlib
+import threading
+import time
+from collections import OrderedDict, namedtuple, defaultdict
+
+from flask import Response, request
+from sqlalchemy import select
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+
+from database import engine, CacheGeneration
+from serializers import dumps
+
+CACHE_MAX_ENTRIES = 2048
+CACHE_TTL = 300  # seconds
+# Leading key parts that make up a namespace's shared scope: notices are
+# invalidated per department (department-wide notices reach every year).
+SHARED_SCOPES = {'notices': 2, 'schedules': 3, 'attendance': 2}
+
+CachedBody = namedtuple('CachedBody', ['body', 'etag', 'last_modified', 'headers', 'shared_generation'])
+
+_MISSING = object()
+
+
+class ResponseCache:
+    def __init__(self, max_entries=CACHE_MAX_ENTRIES, ttl=CACHE_TTL):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries = OrderedDict()  # key -> (expires_at, value)
+        self._lock = threading.Lock()
+        # Bumped by every invalidation; a value built while one happened is not stored.
+        self._generation = 0
+        self._counters = defaultdict(lambda: defaultdict(int))
+
+    @property
+    def generation(self):
+        return self._generation
+
+    def get(self, key, default=None, shared_generation=None):
+        """Cached value for `key`; a CachedBody built at another `shared_generation` counts as a miss."""
+        with self._lock:
+            counters = self._counters[key[0]]
+            item = self._entries.get(key)
+            if item is None:
+                counters['misses'] += 1
+                return default
+            if item[0] <= time.monotonic():
+                # Left in place so put() can keep Last-Modified if the content is unchanged.
+                counters['expired'] += 1
+                counters['misses'] += 1
+                return default
+            if shared_generation is not None and item[1].shared_generation != shared_generation:
+                counters['invalidated_elsewhere'] += 1
+                counters['misses'] += 1
+                return default
+            self._entries.move_to_end(key)
+            counters['hits'] += 1
+            return item[1]
+
+    def put(self, key, value, generation=None):
+        """Store a value; skipped (and the value still returned) if invalidated since `generation`."""
+        with self._lock:
+            if generation is not None and generation != self._generation:
+                self._counters[key[0]]['stale_builds'] += 1
+                return value
+            self._entries[key] = (time.monotonic() + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                evicted, _ = self._entries.popitem(last=False)
+                self._counters[evicted[0]]['evictions'] += 1
+            return value
+
+    def put_body(self, key, body, headers=(), generation=None, shared_generation=None):
+        etag = hashlib.sha1(body).hexdigest()
+        last_modified = datetime.datetime.now(datetime.timezone.utc).replace(microsecond=0)
+        with self._lock:
+            previous = self._entries.get(key)
+        if previous is not None and isinstance(previous[1], CachedBody) and previous[1].etag == etag:
+            last_modified = previous[1].last_modified
+        return self.put(key, CachedBody(body, etag, last_modified, tuple(headers), shared_generation), generation)
+
+    def get_or_build(self, key, build):
+        value = self.get(key, _MISSING)
+        if value is _MISSING:
+            generation = self._generation
+            value = build()
+            if value is not None:
+                self.put(key, value, generation)
+        return value
+
+    def invalidate(self, *prefix):
+        """Drop every entry whose key starts with `prefix`."""
+        with self._lock:
+            self._generation += 1
+            doomed = [key for key in self._entries if key[:len(prefix)] == prefix]
+            for key in doomed:
+                del self._entries[key]
+            self._counters[prefix[0]]['invalidations'] += len(doomed)
+            return len(doomed)
+
+    def invalidate_many(self, prefixes):
+        """invalidate() for many prefixes in one pass, e.g. every user a sync touched."""
+        by_length = {}
+        for prefix in prefixes:
+            by_length.setdefault(len(prefix), set()).add(tuple(prefix))
+        with self._lock:
+            self._generation += 1
+            doomed = [key for key in self._entries
+                      if any(key[:length] in group for length, group in by_length.items())]
+            for key in doomed:
+                del self._entries[key]
+                self._counters[key[0]]['invalidations'] += 1
+            return len(doomed)
+
+    def clear(self):
+        with self._lock:
+            self._generation += 1
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            namespaces = {}
+            for namespace, counters in self._counters.items():
+                lookups = counters['hits'] + counters['misses']
+                namespaces[namespace] = dict(counters, hit_rate=round(counters['hits'] / lookups, 4) if lookups else None)
+            hits = sum(c['hits'] for c in self._counters.values())
+            lookups = hits + sum(c['misses'] for c in self._counters.values())
+            return {
+                'entries': len(self._entries),
+                'max_entries': self.max_entries,
+                'ttl_seconds': self.ttl,
+                'hits': hits,
+                'misses': lookups - hits,
+                'hit_rate': round(hits / lookups, 4) if lookups else None,
+                'namespaces': namespaces,
+            }
+
+
+response_cache = ResponseCache()
+
+
+def shared_scope(key):
+    """cache_generations scope of a key or invalidation prefix, or None for namespaces kept per process."""
+    depth = SHARED_SCOPES.get(key[0])
+    if depth is None:
+        return None
+    if len(key) < depth:
+        raise ValueError(f'{key[0]} invalidations need at least {depth} key parts')
+    return '/'.join(str(part) for part in key[:depth])
+
+
+def invalidate_shared(connection, prefixes):
+    """Invalidate key prefixes in every process once the caller's transaction (a Session or Connection) commits."""
+    scopes = sorted({shared_scope(tuple(prefix)) for prefix in prefixes} - {None})
+    if not scopes:
+        return
+    statement = sqlite_insert(CacheGeneration.__table__)
+    connection.execute(
+        statement.values(generation=1).on_conflict_do_update(
+            index_elements=['scope'], set_={'generation': CacheGeneration.__table__.c.generation + 1}
+        ),
+        [{'scope': scope} for scope in scopes]
+    )
+
+
+def shared_generation(key):
+    """Current generation of the key's scope (0 if never written), or None if it has none."""
+    scope = shared_scope(key)
+    if scope is None:
+        return None
+    with engine.connect() as connection:
+        generation = connection.execute(
+            select(CacheGeneration.generation).where(CacheGeneration.scope == scope)
+        ).scalar()
+    return generation or 0
+
+
+def cached_json_response(key, build, cache=response_cache):
+    """JSON response for `key`, built on a miss; 304 when the client's copy is current.
+
+    build() returns the payload, or (payload, extra response headers).
+    """
+    shared = shared_generation(key)
+    entry = cache.get(key, shared_generation=shared)
+    hit = entry is not None
+    if not hit:
+        generation = cache.generation
+        result = build()
+        payload, headers = result if isinstance(result, tuple) else (result, {})
+        entry = cache.put_body(key, dumps(payload), headers.items(), generation, shared)
+    response = Response(entry.body, mimetype='application/json', headers=list(entry.headers))
+    response.set_etag(entry.etag)
+    response.last_modified = entry.last_modified
+    response.headers['Cache-Control'] = 'no-cache'  # always revalidate; the 304 is the cheap path
+    response.headers['X-Cache'] = 'HIT' if hit else 'MISS'
+    return response.make_conditional(request)
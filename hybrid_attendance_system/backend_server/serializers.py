@@ -0,0 +1,43 @@
+"""
+Column projections and JSON encoding for API responses.
+
+Each endpoint picks a named view (see User.VIEWS): the query loads only that
+view's columns, so the embeddings blob is neither read from SQLite nor decoded
+unless the view asks for it, and any other attribute access raises instead of
+silently issuing a lazy load. Responses are encoded with orjson when it is
+installed, falling back to the standard library.
+"""
+import json
+
+from flask import Response
+from sqlalchemy.orm import joinedload, load_only
+
+from database import User, Notice
+
+try:
+    import orjson
+except ImportError:  # optional; ~5-10x faster on large lists
+    orjson = None
+
+NOTICE_COLUMNS = ('id', 'message', 'timestamp', 'department', 'year', 'author_id')
+
+
+def user_load_options(view='public'):
+    return load_only(*(getattr(User, field) for field in User.VIEWS[view]), raiseload=True)
+
+
+def notice_load_options(author_view='public'):
+    return (
+        load_only(*(getattr(Notice, field) for field in NOTICE_COLUMNS), raiseload=True),
+        joinedload(Notice.author).load_only(*(getattr(User, field) for field in User.VIEWS[author_view]), raiseload=True),
+    )
+
+
+def dumps(payload):
+    if orjson is not None:
+        return orjson.dumps(payload)
+    return json.dumps(payload, separators=(',', ':')).encode('utf-8')
+
+
+def json_response(payload, status=200):
+    return Response(dumps(payload), status=status, mimetype='application/json')
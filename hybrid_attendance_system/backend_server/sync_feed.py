@@ -0,0 +1,84 @@
+"""
+Cursor-paginated change feed for classroom devices (/api/sync/changes).
+
+A page is the next `limit` change_log entries after the client's cursor,
+optionally filtered to one department/year. Several changes to the same row
+within a page collapse into the latest one. Upserts carry the row as it is now
+and deletes are tombstones with only an id. The JSON body is generated
+incrementally and entity rows are loaded in small batches, so even the first
+sync of a large department never builds the whole response in memory.
+"""
+import datetime
+import json
+import zlib
+
+from sqlalchemy import select
+
+from database import engine, ChangeLog, User, Schedule
+
+DEFAULT_PAGE_SIZE = 500
+MAX_PAGE_SIZE = 2000
+ENTITY_BATCH_SIZE = 200
+
+
+def fetch_page(cursor, limit, department=None, year=None):
+    """Return (changes, has_more, next_cursor); changes are (seq, entity, entity_id, op) tuples."""
+    query = select(ChangeLog.seq, ChangeLog.entity, ChangeLog.entity_id, ChangeLog.op).where(ChangeLog.seq > cursor)
+    if department is not None:
+        query = query.where(ChangeLog.department == department)
+    if year is not None:
+        query = query.where(ChangeLog.year == year)
+    with engine.connect() as connection:
+        rows = connection.execute(query.order_by(ChangeLog.seq).limit(limit + 1)).all()
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    latest = {}
+    for seq, entity, entity_id, op in rows:
+        latest[(entity, entity_id)] = (seq, entity, entity_id, op)
+    return sorted(latest.values()), has_more, (rows[-1][0] if rows else cursor)
+
+
+def _load_entities(connection, entity, ids):
+    if entity == 'user':
+        rows = connection.execute(select(User.id, User.name, User.embeddings).where(User.id.in_(ids))).all()
+        return {row.id: User(id=row.id, name=row.name, embeddings=row.embeddings).to_sync_dict() for row in rows}
+    rows = connection.execute(select(Schedule.__table__).where(Schedule.id.in_(ids))).mappings().all()
+    return {row['id']: Schedule(**row).to_dict() for row in rows}
+
+
+def iter_page_json(changes, has_more, next_cursor):
+    """Yield the page as JSON text pieces."""
+    yield '{"changes":['
+    first = True
+    with engine.connect() as connection:
+        for start in range(0, len(changes), ENTITY_BATCH_SIZE):
+            batch = changes[start:start + ENTITY_BATCH_SIZE]
+            loaded = {}
+            for entity in ('user', 'schedule'):
+                ids = [entity_id for _, e, entity_id, op in batch if e == entity and op == 'upsert']
+                if ids:
+                    loaded[entity] = _load_entities(connection, entity, ids)
+            for seq, entity, entity_id, op in batch:
+                data = loaded.get(entity, {}).get(entity_id) if op == 'upsert' else None
+                if op == 'upsert' and data is None:
+                    # Deleted after this change was logged; its tombstone is further on.
+                    op = 'delete'
+                change = {'seq': seq, 'entity': entity, 'id': entity_id, 'op': op}
+                if data is not None:
+                    change['data'] = data
+                yield ('' if first else ',') + json.dumps(change, separators=(',', ':'))
+                first = False
+    yield '],' + json.dumps({
+        'next_cursor': next_cursor,
+        'has_more': has_more,
+        'server_time': datetime.datetime.utcnow().isoformat()
+    }, separators=(',', ':'))[1:]
+
+
+def gzip_chunks(chunks):
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31)  # wbits=31 -> gzip container
+    for chunk in chunks:
+        data = compressor.compress(chunk.encode('utf-8'))
+        if data:
+            yield data
+    yield compressor.flush()
@@ -1,107 +1,187 @@
+import argparse
+import os
 import cv2
 import time
-import datetime
-import sqlite3
-import json
-from deepface import DeepFace
+import threading
 from recognition_core import FaceRecognitionCore
-
-LOCAL_DB_PATH = 'local_database.db'
-RECOGNITION_INTERVAL = 3  # seconds
-
-def setup_local_db():
-    conn = sqlite3.connect(LOCAL_DB_PATH)
-    cursor = conn.cursor()
-    cursor.execute('CREATE TABLE IF NOT EXISTS users (id INTEGER PRIMARY KEY, name TEXT, embeddings TEXT)')
-    cursor.execute('CREATE TABLE IF NOT EXISTS schedules (id INTEGER PRIMARY KEY, subject_name TEXT, day_of_week INTEGER, start_time TEXT, end_time TEXT)')
-    cursor.execute('CREATE TABLE IF NOT EXISTS attendance (id INTEGER PRIMARY KEY AUTOINCREMENT, user_id INTEGER, schedule_id INTEGER, timestamp TEXT, synced INTEGER DEFAULT 0)')
-    conn.commit()
-    conn.close()
-
-def get_data_from_local_db(query, params=()):
-    conn = sqlite3.connect(LOCAL_DB_PATH)
-    cursor = conn.cursor()
-    cursor.execute(query, params)
-    result = cursor.fetchall()
-    conn.close()
-    return result
-
-def get_current_schedule():
-    now = datetime.datetime.now()
-    query = "SELECT id, end_time FROM schedules WHERE day_of_week = ? AND start_time <= ? AND end_time >= ?"
-    schedule = get_data_from_local_db(query, (now.weekday(), now.strftime("%H:%M"), now.strftime("%H:%M")))
-    return schedule[0] if schedule else None
-
-def mark_local_attendance(user_id, schedule_id):
-    conn = sqlite3.connect(LOCAL_DB_PATH)
-    cursor = conn.cursor()
-    cursor.execute("INSERT INTO attendance (user_id, schedule_id, timestamp) VALUES (?, ?, ?)",
-                   (user_id, schedule_id, datetime.datetime.now().isoformat()))
-    conn.commit()
-    conn.close()
+from pipeline import StageStats, LatestFrameCapture, EmbeddingStage, MatchStage, embed_frame, embed_crops
+from face_gate import FaceGate
+from face_tracker import FaceTracker
+from local_store import LocalStore, LOCAL_DB_PATH
+
+RECOGNITION_INTERVAL = 0.5  # seconds between frames offered to the gate / embedding stage
+GATE_ENABLED = True  # motion + Haar pre-check; thresholds live in face_gate.py
+TRACKING_ENABLED = True  # needs the gate's boxes; vote/IoU settings live in face_tracker.py
+FRAME_POLL_INTERVAL = 0.05  # seconds
+PIPELINE_WORKERS = 2  # embedding processes; size to the kiosk's cores
+PIPELINE_MAX_INFLIGHT = 2  # frames being embedded at once; extra frames are dropped
+STATS_INTERVAL = 60  # seconds between pipeline throughput reports
+FACE_INDEX_KIND = 'auto'  # 'exact', 'ivf' or 'auto' (IVF only for large galleries)
+FACE_INDEX_PARAMS = {'n_probe': 8}
+FACE_INDEX_PATH = 'face_index.npz'
+GALLERY_POLL_INTERVAL = 1  # seconds between checks for users changed by sync
+GALLERY_SNAPSHOT_PATH = 'gallery_snapshot.gal'  # written by sync_client
+
+def apply_gallery_changes(store, recognizer, since_version):
+    """Apply users changed after `since_version` to the running recognizer. Returns the new version."""
+    changes = store.user_changes_since(since_version)
+    if not changes:
+        return since_version
+    last_op = {user_id: op for _, user_id, op in changes}
+    upserted = [user_id for user_id, op in last_op.items() if op == 'upsert']
+    removed = [user_id for user_id, op in last_op.items() if op == 'delete']
+    if upserted:
+        recognizer.upsert_users(store.load_users(upserted))
+    if removed:
+        recognizer.remove_users(removed)
+    print(f"🔄 Gallery updated: {len(upserted)} added/replaced, {len(removed)} removed.")
+    return changes[-1][0]
+
+def watch_gallery(store, recognizer, version):
+    while True:
+        time.sleep(GALLERY_POLL_INTERVAL)
+        try:
+            if store.gallery_version() != version:
+                version = apply_gallery_changes(store, recognizer, version)
+        except Exception as e:
+            print(f"❗️ Error while applying gallery changes: {e}")
+
+def load_gallery(store, recognizer):
+    """Load the gallery, from the downloaded snapshot when there is one. Returns the local gallery version."""
+    snapshot_version = store.snapshot_gallery_version()
+    if snapshot_version is not None and os.path.exists(GALLERY_SNAPSHOT_PATH):
+        try:
+            recognizer.load_snapshot(GALLERY_SNAPSHOT_PATH)
+            # Users synced after the snapshot was installed are replayed by watch_gallery.
+            return snapshot_version
+        except (OSError, ValueError) as e:
+            print(f"⚠️ Could not load gallery snapshot ({e}); loading from the local database.")
+    # Read the version first so a sync that lands while loading is replayed, not lost.
+    gallery_version = store.gallery_version()
+    recognizer.load_known_faces(store.load_users())
+    return gallery_version
+
+def mark_local_attendance(store, user_id, schedule_id):
+    # Buffered; the main loop flushes it in batches (see local_store).
+    store.queue_attendance(user_id, schedule_id)
     print(f"✅ Attendance marked for user ID {user_id}")
 
-def run_attendance_system():
-    setup_local_db()
+def run_attendance_system(warmup=False):
+    store = LocalStore(LOCAL_DB_PATH)
+    store.setup()
 
-    recognizer = FaceRecognitionCore()
-    user_rows = get_data_from_local_db("SELECT id, name, embeddings FROM users")
-    users = [(row[0], row[1], json.loads(row[2])) for row in user_rows]
-    recognizer.load_known_faces(users)
+    recognizer = FaceRecognitionCore(index_kind=FACE_INDEX_KIND, index_params=FACE_INDEX_PARAMS, index_path=FACE_INDEX_PATH)
+    gallery_version = load_gallery(store, recognizer)
+    threading.Thread(target=watch_gallery, args=(store, recognizer, gallery_version), daemon=True).start()
 
     cap = cv2.VideoCapture(0)
     if not cap.isOpened():
         print("❌ Error: Cannot open camera.")
         return
 
-    print("🚀 Automated attendance system is running...")
+    # (schedule_id, user_id) pairs already recorded; read and written by the match thread.
+    marked = set()
+
+    def record(schedule_id, user_id):
+        if (schedule_id, user_id) not in marked:
+            started = time.monotonic()
+            mark_local_attendance(store, user_id, schedule_id)
+            marked.add((schedule_id, user_id))
+            stats.count('recorded', seconds=time.monotonic() - started)
+
+    def on_match(context, index, match):
+        schedule_id, track_ids = context
+        if track_ids is None:
+            if match.user_id:
+                record(schedule_id, match.user_id)
+            return
+        track = tracker.add_vote(track_ids[index], match)
+        if track:
+            stats.count('tracks_identified')
+            record(schedule_id, track.user_id)
+
+    stats = StageStats(report_interval=STATS_INTERVAL)
+    capture = LatestFrameCapture(cap, stats)
+    gate = FaceGate(stats) if GATE_ENABLED else None
+    tracker = FaceTracker() if gate and TRACKING_ENABLED else None
+    embedder = EmbeddingStage(stats, workers=PIPELINE_WORKERS, max_inflight=PIPELINE_MAX_INFLIGHT,
+                              worker_fn=embed_crops if gate else embed_frame)
+    matcher = MatchStage(recognizer, embedder.results, on_match, stats)
+    if warmup:
+        # Pay the TensorFlow import and model build now, not on the first face of the first class.
+        started = time.monotonic()
+        for i, timings in enumerate(embedder.warmup()):
+            print(f"🔥 Worker {i}: " + ", ".join(f"{k}={v:.2f}" for k, v in timings.items()))
+        print(f"🔥 Models warm in {time.monotonic() - started:.1f}s.")
+    capture.start()
+    matcher.start()
+
+    print(f"🚀 Automated attendance system is running with {PIPELINE_WORKERS} embedding worker(s)...")
 
     current_class_session = None
-    students_marked_this_session = set()
-
-    while True:
-        schedule_info = get_current_schedule()
+    last_frame_seq = 0
+    last_submit = 0.0
+
+    try:
+        while True:
+            store.maybe_flush_attendance()
+            schedule_info = store.current_schedule()
+
+            if not schedule_info:
+                if current_class_session is not None:
+                    print("🔕 Class session ended. Pausing until next scheduled class.")
+                    current_class_session = None
+                    capture.pause()
+                    marked.clear()
+                    if tracker:
+                        tracker.reset()
+                time.sleep(10)
+                continue
 
-        if schedule_info:
             schedule_id, end_time_str = schedule_info
-
             if schedule_id != current_class_session:
+                # Back-to-back classes share no free minute, so the branch above never
+                # ran: tracks identified in the previous class must vote again here.
                 current_class_session = schedule_id
-                students_marked_this_session.clear()
+                if tracker:
+                    tracker.reset()
+                capture.resume()
                 print(f"🔔 New class session started: ID {schedule_id}. Scanning until {end_time_str}.")
 
-            ret, frame = cap.read()
-            if not ret:
-                print("⚠️ Warning: Failed to capture frame from camera.")
-                time.sleep(1)
-                continue
-
-            try:
-                results = DeepFace.represent(img_path=frame, model_name='FaceNet', detector_backend='mtcnn', enforce_detection=False)
-                for face_data in results:
-                    embedding = face_data.get('embedding')
-                    if not embedding:
-                        continue
-
-                    user_id, user_name = recognizer.find_matching_face(embedding)
-
-                    if user_id and user_id not in students_marked_this_session:
-                        mark_local_attendance(user_id, schedule_id)
-                        students_marked_this_session.add(user_id)
-            except Exception as e:
-                print(f"❗️ Error during face recognition process: {e}")
-
-        else:
-            if current_class_session is not None:
-                print("🔕 Class session ended. Pausing until next scheduled class.")
-                current_class_session = None
-            time.sleep(10)
-            continue
-
-        time.sleep(RECOGNITION_INTERVAL)
-
-    cap.release()
-    cv2.destroyAllWindows()
+            if time.monotonic() - last_submit >= RECOGNITION_INTERVAL:
+                last_frame_seq, frame = capture.latest(last_frame_seq)
+                if frame is not None:
+                    last_submit = now = time.monotonic()
+                    payload, track_ids = frame, None
+                    if gate:
+                        # Only frames with motion and a Haar face go on, as face crops.
+                        boxes, payload = gate.process(frame, now)
+                        if tracker and boxes is not None:
+                            # Identified tracks are never embedded again; only new or
+                            # still-unresolved faces go to the recognizer.
+                            tracks = tracker.update(boxes, now)
+                            wanted = [i for i, track in enumerate(tracks) if tracker.needs_recognition(track, now)]
+                            stats.count('tracks_skipped', len(tracks) - len(wanted))
+                            payload = [payload[i] for i in wanted]
+                            track_ids = [tracks[i].id for i in wanted]
+                    # A busy pool drops the frame; the next fresh one is tried on the next tick.
+                    if len(payload):
+                        embedder.submit(payload, (schedule_id, track_ids))
+
+            stats.maybe_report()
+            time.sleep(FRAME_POLL_INTERVAL)
+    except KeyboardInterrupt:
+        print("Stopping attendance system...")
+    finally:
+        capture.stop()
+        matcher.stop()
+        embedder.shutdown()
+        store.close()
+        cap.release()
+        cv2.destroyAllWindows()
 
 if __name__ == '__main__':
-    run_attendance_system()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="Automated classroom attendance.")
+    parser.add_argument('--warmup', action='store_true', help="load and warm the face models in every worker before starting")
+    args = parser.parse_args()
+    run_attendance_system(warmup=args.warmup)
@@ -0,0 +1,118 @@
+"""
+Cheap front end that decides whether a frame is worth sending to MTCNN + FaceNet.
+
+    frame -> MotionGate (frame differencing) -> FastFaceDetector (Haar cascade) -> face crops
+
+Both stages run on a downscaled grayscale copy in the main process, which
+costs a few milliseconds. Only frames with motion *and* at least one face
+candidate reach the embedding pool, and only their padded face crops are sent.
+"""
+import time
+
+import cv2
+
+# Frame differencing
+MOTION_SCALE_WIDTH = 160  # px; motion is measured on a small copy of the frame
+MOTION_PIXEL_DELTA = 25  # grey levels a pixel must change by to count as moving
+MOTION_MIN_FRACTION = 0.005  # share of moving pixels needed to pass the gate
+MOTION_KEEPALIVE = 10  # seconds; re-check still frames this often (seated students barely move)
+
+# Haar cascade detector
+DETECT_SCALE_WIDTH = 480  # px
+HAAR_SCALE_FACTOR = 1.1
+HAAR_MIN_NEIGHBORS = 5
+HAAR_MIN_FACE_SIZE = 24  # px at DETECT_SCALE_WIDTH
+CROP_PADDING = 0.25  # extra margin around a detection so MTCNN can still align the face
+
+
+class MotionGate:
+    def __init__(self, pixel_delta=MOTION_PIXEL_DELTA, min_fraction=MOTION_MIN_FRACTION,
+                 keepalive=MOTION_KEEPALIVE, scale_width=MOTION_SCALE_WIDTH):
+        self.pixel_delta = pixel_delta
+        self.min_fraction = min_fraction
+        self.keepalive = keepalive
+        self.scale_width = scale_width
+        self._previous = None
+        self._last_pass = None
+
+    def has_motion(self, frame, now):
+        small = _resize_to_width(frame, self.scale_width)
+        grey = cv2.GaussianBlur(cv2.cvtColor(small, cv2.COLOR_BGR2GRAY), (5, 5), 0)
+        previous, self._previous = self._previous, grey
+        if previous is None or previous.shape != grey.shape:
+            return self._pass(now)
+        _, changed = cv2.threshold(cv2.absdiff(previous, grey), self.pixel_delta, 255, cv2.THRESH_BINARY)
+        if cv2.countNonZero(changed) >= self.min_fraction * changed.size:
+            return self._pass(now)
+        if self.keepalive is not None and now - self._last_pass >= self.keepalive:
+            return self._pass(now)
+        return False
+
+    def _pass(self, now):
+        self._last_pass = now
+        return True
+
+
+class FastFaceDetector:
+    def __init__(self, scale_width=DETECT_SCALE_WIDTH, scale_factor=HAAR_SCALE_FACTOR,
+                 min_neighbors=HAAR_MIN_NEIGHBORS, min_face_size=HAAR_MIN_FACE_SIZE):
+        self.scale_width = scale_width
+        self.scale_factor = scale_factor
+        self.min_neighbors = min_neighbors
+        self.min_face_size = min_face_size
+        self.cascade = cv2.CascadeClassifier(cv2.data.haarcascades + 'haarcascade_frontalface_default.xml')
+
+    def detect(self, frame):
+        """Return face boxes as (x, y, w, h) in full-frame coordinates."""
+        small = _resize_to_width(frame, self.scale_width)
+        scale = frame.shape[1] / small.shape[1]
+        grey = cv2.equalizeHist(cv2.cvtColor(small, cv2.COLOR_BGR2GRAY))
+        boxes = self.cascade.detectMultiScale(
+            grey, scaleFactor=self.scale_factor, minNeighbors=self.min_neighbors,
+            minSize=(self.min_face_size, self.min_face_size)
+        )
+        return [tuple(int(round(v * scale)) for v in box) for box in boxes]
+
+
+class FaceGate:
+    """Motion gate + fast detector; returns padded face crops for frames worth embedding.
+
+    `stats` is anything with a count(name, n=1, seconds=None) method, e.g.
+    pipeline.StageStats; gate_no_motion / gate_no_face / gate_passed count frames.
+    """
+
+    def __init__(self, stats, motion_gate=None, detector=None, padding=CROP_PADDING):
+        self.stats = stats
+        self.motion_gate = motion_gate or MotionGate()
+        self.detector = detector or FastFaceDetector()
+        self.padding = padding
+
+    def process(self, frame, now):
+        """Return (boxes, crops). boxes is None when the motion gate skipped the
+        frame (nothing was detected, so trackers should hold their state) and
+        empty when the detector found no face."""
+        started = time.monotonic()
+        if not self.motion_gate.has_motion(frame, now):
+            self.stats.count('gate_no_motion', seconds=time.monotonic() - started)
+            return None, []
+        boxes = self.detector.detect(frame)
+        if not boxes:
+            self.stats.count('gate_no_face', seconds=time.monotonic() - started)
+            return [], []
+        self.stats.count('gate_passed', seconds=time.monotonic() - started)
+        self.stats.count('gate_faces', len(boxes))
+        return boxes, [crop_face(frame, box, self.padding) for box in boxes]
+
+
+def crop_face(frame, box, padding=CROP_PADDING):
+    x, y, w, h = box
+    pad_x, pad_y = int(w * padding), int(h * padding)
+    height, width = frame.shape[:2]
+    return frame[max(0, y - pad_y):min(height, y + h + pad_y), max(0, x - pad_x):min(width, x + w + pad_x)].copy()
+
+
+def _resize_to_width(frame, width):
+    if frame.shape[1] <= width:
+        return frame
+    height = int(frame.shape[0] * width / frame.shape[1])
+    return cv2.resize(frame, (width, height), interpolation=cv2.INTER_AREA)
@@ -0,0 +1,254 @@
+"""
+Search indexes for the face gallery used by FaceRecognitionCore.
+
+Both backends work on a pre-L2-normalized float32 matrix and answer
+"which gallery rows are closest to these queries" by cosine similarity:
+
+- ExactIndex: one matrix product over the whole gallery.
+- IVFIndex: spherical k-means coarse clustering; a query only scans the
+  `n_probe` closest clusters. Raise `n_probe` for recall, lower it for latency.
+
+Indexes can be saved next to the local database so a kiosk does not re-cluster
+the gallery at every start; a fingerprint of the gallery decides whether a
+saved index is still valid.
+"""
+import argparse
+import hashlib
+import json
+import os
+import time
+
+import numpy as np
+
+# Below this many rows an exhaustive scan is as fast as probing clusters.
+IVF_MIN_ROWS = 2000
+
+
+def gallery_fingerprint(matrix, ids):
+    digest = hashlib.sha1()
+    digest.update(np.ascontiguousarray(ids, dtype=np.int64).tobytes())
+    digest.update(np.ascontiguousarray(matrix, dtype=np.float32).tobytes())
+    return digest.hexdigest()
+
+
+def _savez(path, **arrays):
+    # Write through a temp file so a crash never leaves a truncated index behind.
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'wb') as f:
+        np.savez(f, **arrays)
+    os.replace(tmp_path, path)
+
+
+def _top_k(similarities, rows, k):
+    """Sort each row of `similarities` descending and keep k, padding with -1."""
+    n_queries, n_candidates = similarities.shape
+    out_rows = np.full((n_queries, k), -1, dtype=np.int64)
+    out_sims = np.full((n_queries, k), -np.inf, dtype=np.float32)
+    take = min(k, n_candidates)
+    if take == 0:
+        return out_rows, out_sims
+    if take < n_candidates:
+        part = np.argpartition(-similarities, take - 1, axis=1)[:, :take]
+    else:
+        part = np.broadcast_to(np.arange(n_candidates), (n_queries, n_candidates))
+    part_sims = np.take_along_axis(similarities, part, axis=1)
+    order = np.argsort(-part_sims, axis=1)
+    out_sims[:, :take] = np.take_along_axis(part_sims, order, axis=1)
+    out_rows[:, :take] = rows[np.take_along_axis(part, order, axis=1)]
+    return out_rows, out_sims
+
+
+class ExactIndex:
+    kind = 'exact'
+
+    def __init__(self):
+        self.matrix = np.empty((0, 0), dtype=np.float32)
+
+    def params(self):
+        return {}
+
+    def build(self, matrix):
+        self.matrix = matrix
+
+    def search(self, queries, k):
+        similarities = queries @ self.matrix.T
+        return _top_k(similarities, np.arange(len(self.matrix)), k)
+
+    def save(self, path, fingerprint):
+        _savez(path, kind=self.kind, fingerprint=fingerprint, params=json.dumps(self.params()))
+
+    def restore(self, data, matrix):
+        self.matrix = matrix
+
+
+class IVFIndex:
+    kind = 'ivf'
+
+    def __init__(self, n_lists=None, n_probe=8, n_iter=10, seed=0):
+        self.n_lists = n_lists
+        self.n_probe = n_probe
+        self.n_iter = n_iter
+        self.seed = seed
+        self.centroids = np.empty((0, 0), dtype=np.float32)
+        self.list_rows = np.empty(0, dtype=np.int64)
+        self.list_offsets = np.zeros(1, dtype=np.int64)
+        self.list_vectors = np.empty((0, 0), dtype=np.float32)
+
+    def params(self):
+        return {'n_lists': self.n_lists, 'n_iter': self.n_iter, 'seed': self.seed}
+
+    def build(self, matrix):
+        n_lists = self.n_lists or max(1, int(np.sqrt(len(matrix))))
+        self.centroids = self._train(matrix, min(n_lists, len(matrix)))
+        self.assign(matrix)
+
+    def _train(self, matrix, n_lists):
+        rng = np.random.default_rng(self.seed)
+        # k-means only needs a sample; ~256 points per list is plenty.
+        sample_size = min(len(matrix), 256 * n_lists)
+        sample = matrix[rng.choice(len(matrix), sample_size, replace=False)]
+        centroids = sample[rng.choice(len(sample), n_lists, replace=False)].copy()
+        for _ in range(self.n_iter):
+            labels = np.argmax(sample @ centroids.T, axis=1)
+            sums = np.zeros_like(centroids)
+            np.add.at(sums, labels, sample)
+            counts = np.bincount(labels, minlength=n_lists)
+            empty = counts == 0
+            sums[empty] = sample[rng.choice(len(sample), int(empty.sum()))]
+            norms = np.linalg.norm(sums, axis=1, keepdims=True)
+            norms[norms == 0] = 1.0
+            centroids = (sums / norms).astype(np.float32)
+        return centroids
+
+    def assign(self, matrix):
+        """(Re)build the inverted lists against the current centroids."""
+        if len(matrix):
+            labels = np.argmax(matrix @ self.centroids.T, axis=1)
+        else:
+            labels = np.empty(0, dtype=np.int64)
+        self.list_rows = np.argsort(labels, kind='stable').astype(np.int64)
+        counts = np.bincount(labels, minlength=len(self.centroids))
+        self.list_offsets = np.concatenate([[0], np.cumsum(counts)]).astype(np.int64)
+        self.list_vectors = np.ascontiguousarray(matrix[self.list_rows])
+
+    def search(self, queries, k):
+        n_probe = min(self.n_probe, len(self.centroids))
+        probes = np.argsort(-(queries @ self.centroids.T), axis=1)[:, :n_probe]
+        out_rows = np.full((len(queries), k), -1, dtype=np.int64)
+        out_sims = np.full((len(queries), k), -np.inf, dtype=np.float32)
+        for q, lists in enumerate(probes):
+            starts, ends = self.list_offsets[lists], self.list_offsets[lists + 1]
+            lengths = ends - starts
+            positions = np.repeat(starts - np.cumsum(lengths) + lengths, lengths) + np.arange(lengths.sum())
+            similarities = self.list_vectors[positions] @ queries[q]
+            rows, sims = _top_k(similarities[None, :], self.list_rows[positions], k)
+            out_rows[q], out_sims[q] = rows[0], sims[0]
+        return out_rows, out_sims
+
+    def save(self, path, fingerprint):
+        _savez(
+            path, kind=self.kind, fingerprint=fingerprint, params=json.dumps(self.params()),
+            centroids=self.centroids,
+        )
+
+    def restore(self, data, matrix):
+        self.centroids = data['centroids']
+        self.assign(matrix)
+
+
+def create_index(kind='exact', n_rows=0, **params):
+    """Build an empty index of the requested kind. 'auto' picks IVF only for large galleries."""
+    if kind == 'auto':
+        kind = 'ivf' if n_rows >= IVF_MIN_ROWS else 'exact'
+    if kind == 'exact':
+        return ExactIndex()
+    if kind == 'ivf':
+        return IVFIndex(**params)
+    raise ValueError(f"Unknown index kind: {kind}")
+
+
+def load_or_build_index(index, matrix, ids, path=None):
+    """Restore `index` from `path` when it matches this gallery, otherwise build and save it."""
+    fingerprint = gallery_fingerprint(matrix, ids)
+    if path and os.path.exists(path):
+        try:
+            with np.load(path) as data:
+                if (str(data['kind']) == index.kind and str(data['fingerprint']) == fingerprint
+                        and json.loads(str(data['params'])) == index.params()):
+                    index.restore(data, matrix)
+                    return index
+        except (OSError, KeyError, ValueError) as e:
+            print(f"⚠️ Ignoring unreadable face index at {path}: {e}")
+    index.build(matrix)
+    if path:
+        index.save(path, fingerprint)
+    return index
+
+
+def recall_report(matrix, queries, index, k=10):
+    """Compare `index` against an exhaustive search on the same queries."""
+    exact = ExactIndex()
+    exact.build(matrix)
+
+    started = time.perf_counter()
+    exact_rows, _ = exact.search(queries, k)
+    exact_seconds = time.perf_counter() - started
+
+    started = time.perf_counter()
+    approx_rows, _ = index.search(queries, k)
+    approx_seconds = time.perf_counter() - started
+
+    # recall@k: the true nearest row is among the k returned rows.
+    # overlap@k: share of the exact top-k that the index also returned.
+    recall = [e[0] in a for a, e in zip(approx_rows, exact_rows)]
+    overlap = [len(set(a[a >= 0]) & set(e[e >= 0])) / max(1, (e >= 0).sum()) for a, e in zip(approx_rows, exact_rows)]
+    return {
+        'index': index.kind,
+        'params': index.params(),
+        'n_probe': getattr(index, 'n_probe', None),
+        'gallery_rows': len(matrix),
+        'queries': len(queries),
+        'k': k,
+        f'recall@{k}': float(np.mean(recall)),
+        f'overlap@{k}': float(np.mean(overlap)),
+        'top1_agreement': float(np.mean(approx_rows[:, 0] == exact_rows[:, 0])),
+        'exact_ms_per_query': 1000 * exact_seconds / len(queries),
+        'approx_ms_per_query': 1000 * approx_seconds / len(queries),
+        'speedup': exact_seconds / approx_seconds if approx_seconds else float('inf'),
+    }
+
+
+def _synthetic_gallery(n_rows, dim, per_user=3, seed=0):
+    # A few enrollment shots per identity, scattered around the identity's direction.
+    rng = np.random.default_rng(seed)
+    centers = rng.normal(size=(n_rows // per_user + 1, dim))
+    matrix = np.repeat(centers, per_user, axis=0)[:n_rows] + rng.normal(scale=0.3, size=(n_rows, dim))
+    return (matrix / np.linalg.norm(matrix, axis=1, keepdims=True)).astype(np.float32)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Recall-vs-exact report for the IVF face index.")
+    parser.add_argument('--rows', type=int, default=20000, help="synthetic gallery size")
+    parser.add_argument('--dim', type=int, default=128)
+    parser.add_argument('--queries', type=int, default=500)
+    parser.add_argument('--noise', type=float, default=0.5, help="probe noise relative to a unit embedding")
+    parser.add_argument('--n-lists', type=int, default=None)
+    parser.add_argument('--n-probe', type=int, nargs='+', default=[1, 4, 8, 16, 32])
+    parser.add_argument('-k', type=int, default=10)
+    args = parser.parse_args()
+
+    gallery = _synthetic_gallery(args.rows, args.dim)
+    rng = np.random.default_rng(1)
+    probes = gallery[rng.choice(len(gallery), args.queries)] + rng.normal(scale=args.noise / np.sqrt(args.dim), size=(args.queries, args.dim))
+    probes = (probes / np.linalg.norm(probes, axis=1, keepdims=True)).astype(np.float32)
+
+    ivf = IVFIndex(n_lists=args.n_lists)
+    started = time.perf_counter()
+    ivf.build(gallery)
+    print(f"Built IVF index with {len(ivf.centroids)} lists in {time.perf_counter() - started:.2f}s")
+    for n_probe in args.n_probe:
+        ivf.n_probe = n_probe
+        report = recall_report(gallery, probes, ivf, k=args.k)
+        print(f"n_probe={n_probe:>3}  recall@{args.k}={report[f'recall@{args.k}']:.3f}  "
+              f"overlap@{args.k}={report[f'overlap@{args.k}']:.3f}  top1={report['top1_agreement']:.3f}  exact={report['exact_ms_per_query']:.3f}ms  "
+              f"ivf={report['approx_ms_per_query']:.3f}ms  speedup={report['speedup']:.1f}x")
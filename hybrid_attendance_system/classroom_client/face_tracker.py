@@ -0,0 +1,135 @@
+"""
+IoU/centroid tracker for faces found by the gate's fast detector.
+
+A track that has been identified keeps its identity for as long as it is
+tracked, so that face is never embedded again. Unidentified tracks are sent to
+the recognizer at most once per `recheck_interval`. A track is accepted only
+after `votes_required` consecutive matches to the same user, which filters out
+one-frame false matches. Low-margin (ambiguous) matches cast no vote.
+"""
+import itertools
+import threading
+
+IOU_THRESHOLD = 0.3
+CENTROID_MAX_SHIFT = 0.6  # of the box width, for fast movers whose boxes no longer overlap
+MAX_MISSED_FRAMES = 5  # detector passes without the face before the track is dropped
+VOTES_REQUIRED = 3
+MIN_MATCH_MARGIN = 0.05  # cosine-distance gap to the runner-up user for a vote to count
+RECHECK_INTERVAL = 0.5  # seconds between recognizer requests for one unidentified track
+
+
+def iou(a, b):
+    ax, ay, aw, ah = a
+    bx, by, bw, bh = b
+    inter_w = max(0, min(ax + aw, bx + bw) - max(ax, bx))
+    inter_h = max(0, min(ay + ah, by + bh) - max(ay, by))
+    inter = inter_w * inter_h
+    union = aw * ah + bw * bh - inter
+    return inter / union if union else 0.0
+
+
+def centroid_shift(a, b):
+    ax, ay, aw, ah = a
+    bx, by, bw, bh = b
+    dx = (ax + aw / 2) - (bx + bw / 2)
+    dy = (ay + ah / 2) - (by + bh / 2)
+    return (dx * dx + dy * dy) ** 0.5 / max(aw, 1)
+
+
+class Track:
+    def __init__(self, track_id, box, now):
+        self.id = track_id
+        self.box = box
+        self.last_seen = now
+        self.missed = 0
+        self.user_id = None
+        self.name = None
+        self.candidate = None
+        self.streak = 0
+        self.last_requested = None
+
+    @property
+    def identified(self):
+        return self.user_id is not None
+
+
+class FaceTracker:
+    def __init__(self, iou_threshold=IOU_THRESHOLD, max_shift=CENTROID_MAX_SHIFT, max_missed=MAX_MISSED_FRAMES,
+                 votes_required=VOTES_REQUIRED, min_margin=MIN_MATCH_MARGIN, recheck_interval=RECHECK_INTERVAL):
+        self.iou_threshold = iou_threshold
+        self.max_shift = max_shift
+        self.max_missed = max_missed
+        self.votes_required = votes_required
+        self.min_margin = min_margin
+        self.recheck_interval = recheck_interval
+        self.tracks = {}
+        self._ids = itertools.count(1)
+        # update() runs on the main loop, add_vote() on the match thread.
+        self._lock = threading.Lock()
+
+    def update(self, boxes, now):
+        """Associate detections with tracks; returns the track for each box, in order."""
+        with self._lock:
+            pairs = []
+            for t_id, track in self.tracks.items():
+                for b, box in enumerate(boxes):
+                    overlap = iou(track.box, box)
+                    if overlap >= self.iou_threshold:
+                        pairs.append((1 + overlap, t_id, b))
+                    elif centroid_shift(track.box, box) <= self.max_shift:
+                        pairs.append((1 - centroid_shift(track.box, box), t_id, b))
+            # Greedy assignment, best IoU first, then closest centroids.
+            assigned, used_tracks = {}, set()
+            for _, t_id, b in sorted(pairs, reverse=True):
+                if t_id in used_tracks or b in assigned:
+                    continue
+                assigned[b] = t_id
+                used_tracks.add(t_id)
+
+            for t_id in list(self.tracks):
+                if t_id not in used_tracks:
+                    self.tracks[t_id].missed += 1
+                    if self.tracks[t_id].missed > self.max_missed:
+                        del self.tracks[t_id]
+
+            result = []
+            for b, box in enumerate(boxes):
+                if b in assigned:
+                    track = self.tracks[assigned[b]]
+                    track.box, track.last_seen, track.missed = box, now, 0
+                else:
+                    track = Track(next(self._ids), box, now)
+                    self.tracks[track.id] = track
+                result.append(track)
+            return result
+
+    def needs_recognition(self, track, now):
+        """True (and marks the request) if this track should be embedded now."""
+        with self._lock:
+            if track.identified:
+                return False
+            if track.last_requested is not None and now - track.last_requested < self.recheck_interval:
+                return False
+            track.last_requested = now
+            return True
+
+    def add_vote(self, track_id, match):
+        """Record a recognizer result for a track; returns the track if this vote identified it."""
+        with self._lock:
+            track = self.tracks.get(track_id)
+            if track is None or track.identified:
+                return None
+            if match.user_id is None or match.margin < self.min_margin:
+                return None
+            if match.user_id == track.candidate:
+                track.streak += 1
+            else:
+                track.candidate, track.streak = match.user_id, 1
+            if track.streak >= self.votes_required:
+                track.user_id, track.name = match.user_id, match.name
+                return track
+            return None
+
+    def reset(self):
+        with self._lock:
+            self.tracks.clear()
@@ -0,0 +1,215 @@
+"""
+The classroom client's local SQLite database, behind one long-lived connection.
+
+- WAL journal so sync_client can write while attendance_taker reads.
+- The timetable is cached in memory as a per-weekday minute-of-day lookup and
+  is rebuilt only when a trigger reports that `schedules` changed.
+- Attendance rows are buffered and written with executemany in one transaction
+  per flush, so a whole class arriving together costs a few commits.
+- sync_state holds sync_client's cursor, device id and gallery ETag, written in
+  the same transaction as the data they describe.
+"""
+import datetime
+import json
+import os
+import sqlite3
+import sys
+import threading
+import time
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'shared'))
+from embedding_codec import pack_embeddings, decode_embeddings
+
+LOCAL_DB_PATH = 'local_database.db'
+PRAGMAS = {
+    'journal_mode': 'WAL',
+    'synchronous': 'NORMAL',  # durable across app crashes; WAL makes FULL unnecessary here
+    'busy_timeout': 5000,  # ms to wait for sync_client's write lock
+    'cache_size': -8000,  # KiB (negative) of page cache
+    'temp_store': 'MEMORY',
+}
+ATTENDANCE_FLUSH_INTERVAL = 2  # seconds a buffered attendance row may wait
+ATTENDANCE_FLUSH_SIZE = 50  # rows that force an immediate flush
+
+SCHEMA = [
+    'CREATE TABLE IF NOT EXISTS users (id INTEGER PRIMARY KEY, name TEXT, embeddings BLOB)',
+    'CREATE TABLE IF NOT EXISTS schedules (id INTEGER PRIMARY KEY, subject_name TEXT, day_of_week INTEGER, start_time TEXT, end_time TEXT)',
+    'CREATE TABLE IF NOT EXISTS attendance (id INTEGER PRIMARY KEY AUTOINCREMENT, user_id INTEGER, schedule_id INTEGER, timestamp TEXT, synced INTEGER DEFAULT 0)',
+    # Change log for the users table: its max(seq) is the gallery version the
+    # running recognizer compares against, and rows after it are the delta.
+    'CREATE TABLE IF NOT EXISTS user_changes (seq INTEGER PRIMARY KEY AUTOINCREMENT, user_id INTEGER NOT NULL, op TEXT NOT NULL)',
+    "CREATE TRIGGER IF NOT EXISTS users_after_insert AFTER INSERT ON users BEGIN INSERT INTO user_changes (user_id, op) VALUES (NEW.id, 'upsert'); END",
+    "CREATE TRIGGER IF NOT EXISTS users_after_update AFTER UPDATE ON users BEGIN INSERT INTO user_changes (user_id, op) VALUES (NEW.id, 'upsert'); END",
+    "CREATE TRIGGER IF NOT EXISTS users_after_delete AFTER DELETE ON users BEGIN INSERT INTO user_changes (user_id, op) VALUES (OLD.id, 'delete'); END",
+    # Bumped on every schedules write so the in-memory timetable knows when to reload.
+    'CREATE TABLE IF NOT EXISTS table_versions (name TEXT PRIMARY KEY, version INTEGER NOT NULL)',
+    "INSERT OR IGNORE INTO table_versions (name, version) VALUES ('schedules', 0)",
+    "CREATE TRIGGER IF NOT EXISTS schedules_after_insert AFTER INSERT ON schedules BEGIN UPDATE table_versions SET version = version + 1 WHERE name = 'schedules'; END",
+    "CREATE TRIGGER IF NOT EXISTS schedules_after_update AFTER UPDATE ON schedules BEGIN UPDATE table_versions SET version = version + 1 WHERE name = 'schedules'; END",
+    "CREATE TRIGGER IF NOT EXISTS schedules_after_delete AFTER DELETE ON schedules BEGIN UPDATE table_versions SET version = version + 1 WHERE name = 'schedules'; END",
+    'CREATE INDEX IF NOT EXISTS ix_attendance_synced ON attendance (synced)',
+    'CREATE TABLE IF NOT EXISTS sync_state (key TEXT PRIMARY KEY, value TEXT NOT NULL)',
+]
+
+
+def connect(path=LOCAL_DB_PATH):
+    conn = sqlite3.connect(path, timeout=PRAGMAS['busy_timeout'] / 1000, check_same_thread=False)
+    for name, value in PRAGMAS.items():
+        conn.execute(f'PRAGMA {name} = {value}')
+    return conn
+
+
+def get_sync_state(conn, key, default=None):
+    row = conn.execute("SELECT value FROM sync_state WHERE key = ?", (key,)).fetchone()
+    return row[0] if row else default
+
+
+def set_sync_state(conn, key, value):
+    """Does not commit: callers write state inside the transaction that made it true."""
+    conn.execute("INSERT OR REPLACE INTO sync_state (key, value) VALUES (?, ?)", (key, str(value)))
+
+
+def time_to_minutes(value):
+    """'9:05' or '09:05' -> 545."""
+    hours, minutes = value.split(':')
+    return int(hours) * 60 + int(minutes)
+
+
+class Timetable:
+    """Per-weekday lookup table from minute of day to the scheduled class, if any."""
+
+    def __init__(self, rows):
+        self.slots = [[None] * (24 * 60) for _ in range(7)]
+        # Lowest id wins when classes overlap, as the old SQL lookup effectively did.
+        for schedule_id, day_of_week, start_time, end_time in sorted(rows):
+            try:
+                start, end = time_to_minutes(start_time), time_to_minutes(end_time)
+            except (AttributeError, ValueError):
+                print(f"⚠️ Skipping schedule {schedule_id} with invalid times {start_time!r}-{end_time!r}.")
+                continue
+            day = self.slots[day_of_week]
+            for minute in range(max(start, 0), min(end, 24 * 60 - 1) + 1):
+                if day[minute] is None:
+                    day[minute] = (schedule_id, end_time)
+
+    def lookup(self, now):
+        """(schedule_id, end_time) of the class running at `now`, or None."""
+        return self.slots[now.weekday()][now.hour * 60 + now.minute]
+
+
+class LocalStore:
+    def __init__(self, path=LOCAL_DB_PATH):
+        self.path = path
+        self.conn = connect(path)
+        # One connection shared by the main loop, the match thread and the gallery watcher.
+        self._lock = threading.RLock()
+        self._timetables = {}  # None (every schedule) or a frozenset of schedule ids -> Timetable
+        self._timetable_version = None
+        self._pending = []
+        self._oldest_pending = None
+
+    def setup(self):
+        with self._lock, self.conn:
+            for statement in SCHEMA:
+                self.conn.execute(statement)
+        self._convert_embeddings()
+
+    def _convert_embeddings(self):
+        """Rewrite users synced before the binary format (JSON text) as packed float32 blobs."""
+        with self._lock, self.conn:
+            rows = self.conn.execute("SELECT id, embeddings FROM users WHERE typeof(embeddings) = 'text'").fetchall()
+            if not rows:
+                return
+            self.conn.executemany("UPDATE users SET embeddings = ? WHERE id = ?",
+                                  [(pack_embeddings(json.loads(row[1]) if row[1] else []), row[0]) for row in rows])
+        print(f"Converted {len(rows)} local user embedding(s) to the binary format.")
+
+    def query(self, sql, params=()):
+        with self._lock:
+            return self.conn.execute(sql, params).fetchall()
+
+    # --- gallery -------------------------------------------------------------
+
+    def gallery_version(self):
+        return self.query("SELECT COALESCE(MAX(seq), 0) FROM user_changes")[0][0]
+
+    def user_changes_since(self, version):
+        return self.query("SELECT seq, user_id, op FROM user_changes WHERE seq > ? ORDER BY seq", (version,))
+
+    def snapshot_gallery_version(self):
+        """Local gallery version the installed gallery snapshot already covers, or None.
+
+        sync_client installs a snapshot only after a complete pull, so every
+        user change up to this version is in it; later ones are replayed on top.
+        """
+        row = self.query("SELECT version FROM table_versions WHERE name = 'gallery_snapshot'")
+        return row[0][0] if row else None
+
+    def load_users(self, user_ids=None):
+        if user_ids is None:
+            rows = self.query("SELECT id, name, embeddings FROM users")
+        else:
+            placeholders = ', '.join('?' for _ in user_ids)
+            rows = self.query(f"SELECT id, name, embeddings FROM users WHERE id IN ({placeholders})", tuple(user_ids))
+        return [(row[0], row[1], decode_embeddings(row[2])) for row in rows]
+
+    # --- timetable -----------------------------------------------------------
+
+    def _current_timetable(self, schedule_ids=None):
+        with self._lock:
+            version = self.conn.execute("SELECT version FROM table_versions WHERE name = 'schedules'").fetchone()[0]
+            if version != self._timetable_version:
+                self._timetables.clear()
+                self._timetable_version = version
+            timetable = self._timetables.get(schedule_ids)
+            if timetable is None:
+                rows = self.conn.execute("SELECT id, day_of_week, start_time, end_time FROM schedules").fetchall()
+                if schedule_ids is not None:
+                    rows = [row for row in rows if row[0] in schedule_ids]
+                timetable = self._timetables[schedule_ids] = Timetable(rows)
+            return timetable
+
+    def current_schedule(self, now=None, schedule_ids=None):
+        """(schedule_id, end_time) of the class running now, among `schedule_ids` (a frozenset) if given."""
+        return self._current_timetable(schedule_ids).lookup(now or datetime.datetime.now())
+
+    def class_in_window(self, now=None, after_minutes=0):
+        """True if a class is running at `now` or ended at most `after_minutes` earlier."""
+        now = now or datetime.datetime.now()
+        timetable = self._current_timetable()
+        return any(timetable.lookup(now - datetime.timedelta(minutes=m)) for m in range(after_minutes + 1))
+
+    # --- attendance ----------------------------------------------------------
+
+    def queue_attendance(self, user_id, schedule_id, timestamp=None):
+        timestamp = timestamp or datetime.datetime.now().isoformat()
+        with self._lock:
+            if not self._pending:
+                self._oldest_pending = time.monotonic()
+            self._pending.append((user_id, schedule_id, timestamp))
+            if len(self._pending) >= ATTENDANCE_FLUSH_SIZE:
+                self.flush_attendance()
+
+    def maybe_flush_attendance(self):
+        with self._lock:
+            if self._pending and time.monotonic() - self._oldest_pending >= ATTENDANCE_FLUSH_INTERVAL:
+                self.flush_attendance()
+
+    def flush_attendance(self):
+        with self._lock:
+            if not self._pending:
+                return 0
+            rows, self._pending = self._pending, []
+            try:
+                with self.conn:
+                    self.conn.executemany("INSERT INTO attendance (user_id, schedule_id, timestamp) VALUES (?, ?, ?)", rows)
+            except sqlite3.Error:
+                # Keep the rows for the next flush rather than losing a student's attendance.
+                self._pending = rows + self._pending
+                raise
+            return len(rows)
+
+    def close(self):
+        with self._lock:
+            self.flush_attendance()
+            self.conn.close()
@@ -0,0 +1,280 @@
+"""
+Several cameras, one process: every camera shares one embedding pool and one recognizer.
+
+    camera capture threads -> per-camera FaceGate + FaceTracker (main loop)
+        -> one batch of face crops per tick -> embedding pool (embed_crops_batched)
+        -> MatchStage (one match_batch) -> attendance for each camera's class
+
+Cameras come from a JSON config:
+
+    {"cameras": [
+        {"name": "hall-front", "source": "rtsp://10.0.0.21/stream1", "room": "LH-1", "schedules": [12, 13]},
+        {"name": "hall-back", "source": "rtsp://10.0.0.22/stream1", "room": "LH-1", "schedules": [12, 13]},
+        {"name": "room-204", "source": 0, "room": "204"},
+        {"name": "recorded", "source": "class.mp4", "room": "lab", "schedules": [7]}
+    ]}
+
+`source` is a device index, a stream URL or a video file. A camera with
+`schedules` scans only while one of those classes is running; without, it
+follows the whole local timetable like attendance_taker. A camera that cannot
+be opened at startup is retried every CAMERA_RETRY_INTERVAL seconds in the
+background while the others run. Adding a camera adds
+a capture thread, a gate and a tracker, not models or a copy of the gallery:
+the PIPELINE_WORKERS processes hold the models, the recognizer lives here.
+
+Every tick the gated crops of all cameras (up to MAX_BATCH_FACES) go to the
+pool as one batch, so the recognition model runs once for all of them. Each
+camera reports its frame rate, faces offered and dropped, and the latency from
+its frame being picked up to its faces being matched, every STATS_INTERVAL.
+
+    python multi_camera.py cameras.json --warmup
+"""
+import argparse
+import json
+import threading
+import time
+
+import cv2
+
+from attendance_taker import (RECOGNITION_INTERVAL, FRAME_POLL_INTERVAL, PIPELINE_WORKERS, PIPELINE_MAX_INFLIGHT,
+                              STATS_INTERVAL, FACE_INDEX_KIND, FACE_INDEX_PARAMS, FACE_INDEX_PATH,
+                              load_gallery, watch_gallery)
+from face_gate import FaceGate
+from face_tracker import FaceTracker
+from local_store import LocalStore, LOCAL_DB_PATH
+from pipeline import StageStats, LatestFrameCapture, EmbeddingStage, MatchStage, embed_crops_batched
+from recognition_core import FaceRecognitionCore
+
+MAX_BATCH_FACES = 32  # face crops per pool submission; the rest of a tick's crops wait for the next one
+IDLE_POLL_INTERVAL = 10  # seconds between timetable checks while no camera has a class
+CAMERA_RETRY_INTERVAL = 30  # seconds between attempts to open a camera that is offline
+
+
+def open_source(source):
+    cap = cv2.VideoCapture(source)
+    if isinstance(source, str) and '://' in source:
+        cap.set(cv2.CAP_PROP_BUFFERSIZE, 1)  # keep the network stream's latency down
+    return cap
+
+
+class Camera:
+    def __init__(self, name, source, room=None, schedules=None):
+        self.name = name
+        self.source = int(source) if isinstance(source, str) and source.isdigit() else source
+        self.room = room
+        self.schedule_ids = frozenset(schedules) if schedules else None
+        self.stats = StageStats(report_interval=STATS_INTERVAL, label=f"{name} ({room})" if room else name)
+        self.capture = None
+        self.gate = None
+        self.tracker = None
+        self.schedule_id = None
+        self.last_frame_seq = 0
+        self.last_submit = 0.0
+        self.pending = []  # (crop, track id or None) waiting for room in a batch
+        self.picked_up_at = None
+
+    def open(self, tracking):
+        """Set up the gate and tracker and open the source; False if it cannot be opened yet."""
+        self.gate = FaceGate(self.stats)
+        self.tracker = FaceTracker() if tracking else None
+        return self._connect()
+
+    def _connect(self):
+        cap = open_source(self.source)
+        if not cap.isOpened():
+            cap.release()
+            return False
+        frame_interval = 0.0
+        if isinstance(self.source, str) and '://' not in self.source:
+            # A video file plays at its own frame rate rather than as fast as it decodes.
+            frame_interval = 1.0 / (cap.get(cv2.CAP_PROP_FPS) or 25.0)
+        reopen = (lambda: open_source(self.source)) if not isinstance(self.source, int) else None
+        capture = LatestFrameCapture(cap, self.stats, frame_interval=frame_interval, reopen=reopen)
+        capture.pause()  # resumed by the main loop when the camera's class starts
+        capture.start()
+        self.capture = capture
+        return True
+
+    def keep_connecting(self):
+        """Runs in its own thread: retry an offline camera until it opens."""
+        while not self._connect():
+            time.sleep(CAMERA_RETRY_INTERVAL)
+        print(f"📷 {self.name}: camera is online.")
+
+    def end_session(self):
+        self.schedule_id = None
+        self.capture.pause()
+        self.pending = []
+        if self.tracker:
+            self.tracker.reset()
+
+
+def load_cameras(path):
+    with open(path) as f:
+        config = json.load(f)
+    cameras = [Camera(c['name'], c['source'], c.get('room'), c.get('schedules')) for c in config.get('cameras', [])]
+    if not cameras:
+        raise SystemExit(f"❌ No cameras configured in {path}.")
+    names = [camera.name for camera in cameras]
+    if len(set(names)) != len(names):
+        raise SystemExit(f"❌ Camera names must be unique in {path}.")
+    return cameras
+
+
+def collect_batch(cameras, limit=MAX_BATCH_FACES):
+    """Take up to `limit` pending crops, in camera order; returns (crops, segments).
+
+    A segment is (first row, camera, schedule id, track ids or None, picked-up time).
+    """
+    crops, segments = [], []
+    for camera in cameras:
+        if not camera.pending or len(crops) >= limit:
+            continue
+        taken, camera.pending = camera.pending[:limit - len(crops)], camera.pending[limit - len(crops):]
+        track_ids = [track_id for _, track_id in taken] if camera.tracker else None
+        segments.append((len(crops), camera, camera.schedule_id, track_ids, camera.picked_up_at))
+        crops.extend(crop for crop, _ in taken)
+    return crops, segments
+
+
+def run_multi_camera(config_path, warmup=False, tracking=True):
+    cameras = load_cameras(config_path)
+    store = LocalStore(LOCAL_DB_PATH)
+    store.setup()
+
+    recognizer = FaceRecognitionCore(index_kind=FACE_INDEX_KIND, index_params=FACE_INDEX_PARAMS, index_path=FACE_INDEX_PATH)
+    gallery_version = load_gallery(store, recognizer)
+    threading.Thread(target=watch_gallery, args=(store, recognizer, gallery_version), daemon=True).start()
+
+    for camera in cameras:
+        if not camera.open(tracking):
+            # The main loop skips it until keep_connecting() has opened it.
+            print(f"⚠️ Cannot open camera {camera.name} ({camera.source}); retrying every {CAMERA_RETRY_INTERVAL}s.")
+            threading.Thread(target=camera.keep_connecting, daemon=True).start()
+
+    # schedule_id -> user ids already recorded, shared so two cameras in one hall record a student once.
+    marked = {}
+
+    def record(camera, schedule_id, user_id):
+        recorded = marked.setdefault(schedule_id, set())
+        if user_id not in recorded:
+            started = time.monotonic()
+            store.queue_attendance(user_id, schedule_id)
+            recorded.add(user_id)
+            camera.stats.count('recorded', seconds=time.monotonic() - started)
+            print(f"✅ Attendance marked for user ID {user_id} ({camera.name})")
+
+    def on_match(segments, index, match):
+        segment = next(segment for segment in reversed(segments) if segment[0] <= index)
+        first_row, camera, schedule_id, track_ids, picked_up_at = segment
+        camera.stats.count('matched', seconds=time.monotonic() - picked_up_at)
+        if track_ids is None:
+            if match.user_id:
+                record(camera, schedule_id, match.user_id)
+            return
+        track = camera.tracker.add_vote(track_ids[index - first_row], match)
+        if track:
+            camera.stats.count('tracks_identified')
+            record(camera, schedule_id, track.user_id)
+
+    stats = StageStats(report_interval=STATS_INTERVAL, label='Shared pipeline')
+    embedder = EmbeddingStage(stats, workers=PIPELINE_WORKERS, max_inflight=PIPELINE_MAX_INFLIGHT,
+                              worker_fn=embed_crops_batched)
+    matcher = MatchStage(recognizer, embedder.results, on_match, stats)
+    if warmup:
+        started = time.monotonic()
+        for i, timings in enumerate(embedder.warmup()):
+            print(f"🔥 Worker {i}: " + ", ".join(f"{k}={v:.2f}" for k, v in timings.items()))
+        print(f"🔥 Models warm in {time.monotonic() - started:.1f}s.")
+    matcher.start()
+
+    online = sum(1 for camera in cameras if camera.capture is not None)
+    print(f"🚀 Multi-camera attendance is running: {online}/{len(cameras)} camera(s) online, "
+          f"{PIPELINE_WORKERS} embedding worker(s).")
+
+    turn = 0
+    try:
+        while True:
+            store.maybe_flush_attendance()
+            active = []
+            for camera in cameras:
+                if camera.capture is None:
+                    continue  # offline
+                schedule_info = store.current_schedule(schedule_ids=camera.schedule_ids)
+                if not schedule_info:
+                    if camera.schedule_id is not None:
+                        print(f"🔕 {camera.name}: class session ended.")
+                        marked.pop(camera.schedule_id, None)
+                        camera.end_session()
+                    continue
+                schedule_id, end_time_str = schedule_info
+                if schedule_id != camera.schedule_id:
+                    if camera.tracker:
+                        camera.tracker.reset()
+                    camera.schedule_id = schedule_id
+                    camera.pending = []
+                    camera.capture.resume()
+                    print(f"🔔 {camera.name}: class session {schedule_id} started. Scanning until {end_time_str}.")
+                active.append(camera)
+
+            if not active:
+                time.sleep(IDLE_POLL_INTERVAL)
+                continue
+
+            now = time.monotonic()
+            for camera in active:
+                # A camera still waiting for its last crops to be batched is not read again yet.
+                if camera.pending or now - camera.last_submit < RECOGNITION_INTERVAL:
+                    continue
+                camera.last_frame_seq, frame = camera.capture.latest(camera.last_frame_seq)
+                if frame is None:
+                    continue
+                camera.last_submit = camera.picked_up_at = now
+                camera.stats.count('frames_offered')
+                boxes, crops = camera.gate.process(frame, now)
+                track_ids = [None] * len(crops)
+                if camera.tracker and boxes is not None:
+                    tracks = camera.tracker.update(boxes, now)
+                    wanted = [i for i, track in enumerate(tracks) if camera.tracker.needs_recognition(track, now)]
+                    camera.stats.count('tracks_skipped', len(tracks) - len(wanted))
+                    crops = [crops[i] for i in wanted]
+                    track_ids = [tracks[i].id for i in wanted]
+                camera.pending = list(zip(crops, track_ids))
+
+            # Rotate which camera goes first so a crowded one cannot starve the rest.
+            first = turn % len(active)
+            turn += 1
+            crops, segments = collect_batch(active[first:] + active[:first])
+            if crops:
+                if embedder.submit(crops, segments):
+                    stats.count('batch_faces', len(crops))
+                else:
+                    # The pool is busy: drop these faces, as attendance_taker drops a frame.
+                    for _, camera, *_ in segments:
+                        camera.stats.count('dropped_busy')
+
+            for camera in cameras:
+                if camera.capture is not None:
+                    camera.stats.maybe_report()
+            stats.maybe_report()
+            time.sleep(FRAME_POLL_INTERVAL)
+    except KeyboardInterrupt:
+        print("Stopping multi-camera attendance...")
+    finally:
+        captures = [camera.capture for camera in cameras if camera.capture is not None]
+        for capture in captures:
+            capture.stop()
+        matcher.stop()
+        embedder.shutdown()
+        store.close()
+        for capture in captures:
+            capture.cap.release()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Classroom attendance from several cameras in one process.")
+    parser.add_argument('config', help="JSON file listing the cameras")
+    parser.add_argument('--warmup', action='store_true', help="load and warm the face models in every worker before starting")
+    parser.add_argument('--no-tracking', action='store_true', help="record on single matches instead of track votes")
+    args = parser.parse_args()
+    run_multi_camera(args.config, warmup=args.warmup, tracking=not args.no_tracking)
@@ -0,0 +1,253 @@
+"""
+Staged recognition pipeline for the classroom client.
+
+    capture thread  ->  embedding process pool  ->  match/record thread
+    (latest frame)      (bounded, drops frames)     (recognizer + SQLite)
+
+The camera is read continuously so the frame handed to the detector is always
+fresh. The embedding stage accepts at most `max_inflight` frames; anything
+offered while it is full is dropped instead of queued, so a slow kiosk falls
+behind by skipping frames rather than by building up latency.
+"""
+import multiprocessing
+import os
+import queue
+import sys
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, wait
+
+import numpy as np
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'shared'))
+from model_manager import get_model_manager, EMBEDDING_DIM
+
+# MTCNN on a small Haar crop is far cheaper than on the full frame and still
+# aligns the face the way enrollment did. 'skip' embeds the raw crop instead.
+CROP_DETECTOR_BACKEND = 'mtcnn'
+REOPEN_AFTER_FAILURES = 5  # failed reads in a row before LatestFrameCapture reopens its source
+
+
+def init_worker():
+    """Pool initializer: build and warm the models before the worker takes its first frame."""
+    get_model_manager().load()
+
+
+def worker_timings():
+    return get_model_manager().timings
+
+
+def embed_frame(frame):
+    """Runs in a pool worker: detect faces in a frame and return a (faces, dim) float32 array."""
+    return get_model_manager().embed([frame])[0]
+
+
+def embed_crops(crops):
+    """Runs in a pool worker: one embedding row per face crop, NaN where no face was found."""
+    return get_model_manager().embed_faces(crops, detector_backend=CROP_DETECTOR_BACKEND)
+
+
+def embed_crops_batched(crops):
+    """Same rows as embed_crops, but the recognition model runs once over every face found in the crops."""
+    if CROP_DETECTOR_BACKEND == 'skip':
+        return embed_crops(crops)
+    manager = get_model_manager()
+    embeddings = np.full((len(crops), EMBEDDING_DIM), np.nan, dtype=np.float32)
+    found, faces = [], []
+    for i, crop in enumerate(crops):
+        detected = manager.detect_faces(crop, CROP_DETECTOR_BACKEND)
+        if detected:
+            largest = max(detected, key=lambda face: face['facial_area']['w'] * face['facial_area']['h'])
+            found.append(i)
+            faces.append(largest['face'])
+    if faces:
+        embeddings[found] = manager.embed_aligned(faces)
+    return embeddings
+
+
+class StageStats:
+    """Thread-safe per-stage counters and latency totals, printed as throughput."""
+
+    def __init__(self, report_interval=60, label='Pipeline'):
+        self.report_interval = report_interval
+        self.label = label
+        self._lock = threading.Lock()
+        self._counts = {}
+        self._seconds = {}
+        self._window_start = time.monotonic()
+
+    def count(self, name, n=1, seconds=None):
+        with self._lock:
+            self._counts[name] = self._counts.get(name, 0) + n
+            if seconds is not None:
+                self._seconds[name] = self._seconds.get(name, 0.0) + seconds
+
+    def snapshot(self):
+        with self._lock:
+            elapsed = max(time.monotonic() - self._window_start, 1e-9)
+            return {
+                name: {
+                    'count': count,
+                    'per_second': count / elapsed,
+                    'avg_ms': 1000 * self._seconds[name] / count if name in self._seconds and count else None,
+                }
+                for name, count in self._counts.items()
+            }
+
+    def maybe_report(self):
+        if time.monotonic() - self._window_start < self.report_interval:
+            return
+        parts = []
+        for name, stage in sorted(self.snapshot().items()):
+            part = f"{name}={stage['count']} ({stage['per_second']:.2f}/s"
+            part += f", {stage['avg_ms']:.0f}ms)" if stage['avg_ms'] is not None else ")"
+            parts.append(part)
+        print(f"📊 {self.label}: {'  '.join(parts)}")
+        with self._lock:
+            self._counts.clear()
+            self._seconds.clear()
+            self._window_start = time.monotonic()
+
+
+class LatestFrameCapture(threading.Thread):
+    """Reads the camera continuously and keeps only the newest frame.
+
+    `frame_interval` paces reads (for video files, which would otherwise be
+    read as fast as they decode); `reopen()` returns a fresh capture after
+    REOPEN_AFTER_FAILURES failed reads in a row (for network streams).
+    """
+
+    def __init__(self, cap, stats, frame_interval=0, reopen=None):
+        super().__init__(daemon=True)
+        self.cap = cap
+        self.stats = stats
+        self.frame_interval = frame_interval
+        self.reopen = reopen
+        self._failures = 0
+        self._lock = threading.Lock()
+        self._frame = None
+        self._seq = 0
+        self._stopped = threading.Event()
+        self._active = threading.Event()
+        self._active.set()
+
+    def run(self):
+        while not self._stopped.is_set():
+            if not self._active.wait(timeout=0.5):
+                continue
+            started = time.monotonic()
+            ret, frame = self.cap.read()
+            if not ret:
+                self.stats.count('capture_failed')
+                self._failures += 1
+                if self.reopen and self._failures >= REOPEN_AFTER_FAILURES:
+                    self.cap.release()
+                    self.cap = self.reopen()
+                    self._failures = 0
+                    self.stats.count('reopened')
+                time.sleep(1)
+                continue
+            self._failures = 0
+            if self.frame_interval:
+                time.sleep(max(0.0, self.frame_interval - (time.monotonic() - started)))
+            with self._lock:
+                self._frame = frame
+                self._seq += 1
+            self.stats.count('captured')
+
+    def latest(self, after_seq=0):
+        """Return (seq, frame) if a frame newer than after_seq exists, else (after_seq, None)."""
+        with self._lock:
+            if self._seq > after_seq:
+                return self._seq, self._frame
+            return after_seq, None
+
+    def pause(self):
+        self._active.clear()
+
+    def resume(self):
+        self._active.set()
+
+    def stop(self):
+        self._stopped.set()
+
+
+class EmbeddingStage:
+    """Bounded front of the process pool: submit() refuses work instead of queueing it."""
+
+    def __init__(self, stats, workers=2, max_inflight=None, worker_fn=embed_frame):
+        self.stats = stats
+        self.worker_fn = worker_fn
+        self.max_inflight = max_inflight or workers
+        self.workers = workers
+        # Workers load TensorFlow themselves; spawn avoids forking a process that already has it.
+        self.executor = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn'),
+                                            initializer=init_worker)
+        self.results = queue.Queue()
+        self._slots = threading.BoundedSemaphore(self.max_inflight)
+
+    def submit(self, payload, context):
+        if not self._slots.acquire(blocking=False):
+            self.stats.count('dropped_busy')
+            return False
+        submitted_at = time.monotonic()
+        future = self.executor.submit(self.worker_fn, payload)
+        future.add_done_callback(lambda f: self._done(f, context, submitted_at))
+        self.stats.count('submitted')
+        return True
+
+    def _done(self, future, context, submitted_at):
+        self._slots.release()
+        try:
+            embeddings = future.result()
+        except Exception as e:
+            self.stats.count('embed_errors')
+            print(f"❗️ Error during face embedding: {e}")
+            return
+        self.stats.count('embedded', seconds=time.monotonic() - submitted_at)
+        self.results.put((context, embeddings))
+
+    def warmup(self):
+        """Start every worker and wait until its models are loaded; returns their timings."""
+        futures = [self.executor.submit(worker_timings) for _ in range(self.workers)]
+        wait(futures)
+        return [f.result() for f in futures]
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+
+class MatchStage(threading.Thread):
+    """Matches embedded faces and calls on_match(context, index, match), index being the row in the payload."""
+
+    def __init__(self, recognizer, results, on_match, stats):
+        super().__init__(daemon=True)
+        self.recognizer = recognizer
+        self.results = results
+        self.on_match = on_match
+        self.stats = stats
+        self._stopped = threading.Event()
+
+    def run(self):
+        while not self._stopped.is_set():
+            try:
+                context, embeddings = self.results.get(timeout=0.5)
+            except queue.Empty:
+                continue
+            if not len(embeddings):
+                continue
+            # Crops without a face come back as NaN rows.
+            rows = np.flatnonzero(~np.isnan(embeddings).any(axis=1))
+            if not len(rows):
+                continue
+            started = time.monotonic()
+            matches = self.recognizer.match_batch(embeddings[rows])
+            self.stats.count('matched', len(matches), seconds=time.monotonic() - started)
+            for index, match in zip(rows, matches):
+                try:
+                    self.on_match(context, int(index), match)
+                except Exception as e:
+                    print(f"❗️ Error while recording a match: {e}")
+
+    def stop(self):
+        self._stopped.set()
@@ -1,25 +1,170 @@
+import os
+import sys
+import threading
+from collections import namedtuple
+
 import numpy as np
-from scipy.spatial.distance import cosine
+
+from face_index import IVFIndex, create_index, gallery_fingerprint, load_or_build_index
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'shared'))
+from gallery_snapshot import read_snapshot
+
+# One ranked gallery identity for a query face.
+MatchCandidate = namedtuple('MatchCandidate', ['user_id', 'name', 'distance'])
+
+# Result for one query face. user_id/name are None when the best candidate is
+# above the threshold. margin is the cosine-distance gap between the best and
+# the second-best *distinct* user (inf when there is no runner-up).
+MatchResult = namedtuple('MatchResult', ['user_id', 'name', 'distance', 'margin', 'candidates'])
+
+
+def l2_normalize(vectors):
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return vectors / norms
+
 
 class FaceRecognitionCore:
-    def __init__(self, threshold=0.40):
+    def __init__(self, threshold=0.40, index_kind='exact', index_params=None, index_path=None):
         self.threshold = threshold
-        self.known_face_embeddings = []
-        self.known_face_ids = []
-        self.known_face_names = []
+        # 'exact', 'ivf' or 'auto'; see face_index for the recall/latency knobs.
+        self.index_kind = index_kind
+        self.index_params = index_params or {}
+        self.index_path = index_path
+        self.index = None
+        # Gallery rows are grouped by user: every embedding of a user is contiguous.
+        self.known_embeddings = np.empty((0, 0), dtype=np.float32)
+        self.known_ids = np.empty(0, dtype=np.int64)
+        self.known_names = np.empty(0, dtype=object)
+        self.max_embeddings_per_user = 0
+        # Gallery updates can arrive from the sync watcher while a frame is being matched.
+        self._lock = threading.RLock()
 
     def load_known_faces(self, users):
+        matrix, ids, names = self._stack_users(users)
+        with self._lock:
+            self._set_gallery(matrix, ids, names)
+            self._build_index()
+        print(f"Loaded embeddings for {len(np.unique(self.known_ids))} students.")
+
+    def load_snapshot(self, path):
+        """Use a downloaded gallery snapshot as the gallery. Returns its version.
+
+        The embedding and id arrays stay memory-mapped (rows are already
+        normalized), so only the pages the index touches are read from disk.
+        """
+        snapshot = read_snapshot(path)
+        with self._lock:
+            self._set_gallery(snapshot.embeddings, snapshot.ids, snapshot.row_names())
+            self._build_index()
+        print(f"Loaded embeddings for {len(snapshot.names)} students from snapshot version {snapshot.version}.")
+        return snapshot.version
+
+    def upsert_users(self, users):
+        """Add new users or replace every embedding of existing ones, in place."""
+        users = list(users)
+        matrix, ids, names = self._stack_users(users)
+        with self._lock:
+            keep = ~np.isin(self.known_ids, [user[0] for user in users])
+            if len(ids) and not len(self.known_ids):
+                base = np.empty((0, matrix.shape[1]), dtype=np.float32)
+            else:
+                base = self.known_embeddings[keep]
+            # Appending after the kept rows keeps each user's rows contiguous.
+            self._set_gallery(
+                np.concatenate([base, matrix]) if len(ids) else base,
+                np.concatenate([self.known_ids[keep], ids]),
+                np.concatenate([self.known_names[keep], names]),
+            )
+            self._refresh_index()
+
+    def remove_users(self, user_ids):
+        with self._lock:
+            keep = ~np.isin(self.known_ids, list(user_ids))
+            if keep.all():
+                return
+            self._set_gallery(self.known_embeddings[keep], self.known_ids[keep], self.known_names[keep])
+            self._refresh_index()
+
+    @staticmethod
+    def _stack_users(users):
+        # embeddings may be a list of vectors or a (count, dim) array, e.g. a
+        # zero-copy view over a packed blob; rows are only copied once, by vstack.
+        blocks, ids, names = [], [], []
         for user_id, name, embeddings in users:
-            for emb in embeddings:
-                self.known_face_embeddings.append(np.array(emb))
-                self.known_face_ids.append(user_id)
-                self.known_face_names.append(name)
-        print(f"Loaded embeddings for {len(set(self.known_face_ids))} students.")
+            block = np.asarray(embeddings, dtype=np.float32)
+            if block.size == 0:
+                continue
+            block = np.atleast_2d(block)
+            blocks.append(block)
+            ids.extend([user_id] * len(block))
+            names.extend([name] * len(block))
+        matrix = np.ascontiguousarray(l2_normalize(np.vstack(blocks))) if blocks else np.empty((0, 0), dtype=np.float32)
+        return matrix, np.asarray(ids, dtype=np.int64), np.asarray(names, dtype=object)
+
+    def _set_gallery(self, matrix, ids, names):
+        self.known_embeddings = matrix if len(ids) else np.empty((0, 0), dtype=np.float32)
+        self.known_ids = ids
+        self.known_names = names
+        self.max_embeddings_per_user = int(np.unique(ids, return_counts=True)[1].max()) if len(ids) else 0
+
+    def _build_index(self):
+        self.index = create_index(self.index_kind, len(self.known_ids), **self.index_params)
+        if len(self.known_ids):
+            load_or_build_index(self.index, self.known_embeddings, self.known_ids, self.index_path)
+
+    def _refresh_index(self):
+        """Cheap index update after a delta: IVF keeps its trained centroids and only re-buckets rows."""
+        wanted = create_index(self.index_kind, len(self.known_ids), **self.index_params)
+        if (not isinstance(self.index, IVFIndex) or wanted.kind != self.index.kind
+                or not len(self.index.centroids) or not len(self.known_ids)):
+            self._build_index()
+            return
+        self.index.assign(self.known_embeddings)
+        if self.index_path:
+            self.index.save(self.index_path, gallery_fingerprint(self.known_embeddings, self.known_ids))
+
+    def match_batch(self, face_embeddings, top_k=1):
+        """Match every face of a frame against the gallery in one index search."""
+        queries = l2_normalize(np.atleast_2d(np.asarray(face_embeddings, dtype=np.float32)))
+        with self._lock:
+            known_ids, known_names = self.known_ids, self.known_names
+            if not len(known_ids):
+                return [MatchResult(None, None, None, float('inf'), []) for _ in range(len(queries))]
+
+            # Enough rows to still see top_k + 1 distinct users after collapsing
+            # several embeddings of the same user.
+            n_rows = min(len(known_ids), (top_k + 1) * self.max_embeddings_per_user)
+            top_rows, top_sims = self.index.search(queries, n_rows)
+
+        results = []
+        for rows, sims in zip(top_rows, top_sims):
+            candidates, seen = [], set()
+            for row, sim in zip(rows, sims):
+                if row < 0:
+                    break
+                user_id = int(known_ids[row])
+                if user_id in seen:
+                    continue
+                seen.add(user_id)
+                candidates.append(MatchCandidate(user_id, known_names[row], float(1.0 - sim)))
+                if len(candidates) > top_k:
+                    break
+            if not candidates:
+                results.append(MatchResult(None, None, None, float('inf'), []))
+                continue
+            results.append(self._make_result(candidates, top_k))
+        return results
+
+    def _make_result(self, candidates, top_k):
+        best = candidates[0]
+        margin = candidates[1].distance - best.distance if len(candidates) > 1 else float('inf')
+        if best.distance <= self.threshold:
+            return MatchResult(best.user_id, best.name, best.distance, margin, candidates[:top_k])
+        return MatchResult(None, None, best.distance, margin, candidates[:top_k])
 
     def find_matching_face(self, face_embedding):
-        if not self.known_face_embeddings: return None, None
-        distances = [cosine(face_embedding, emb) for emb in self.known_face_embeddings]
-        min_dist_idx = np.argmin(distances)
-        if distances[min_dist_idx] <= self.threshold:
-            return self.known_face_ids[min_dist_idx], self.known_face_names[min_dist_idx]
-        return None, None
\ No newline at end of file
+        result = self.match_batch([face_embedding])[0]
+        return result.user_id, result.name
@@ -0,0 +1,310 @@
+"""
+Offline replay of a recorded class through the recognition pipeline.
+
+A video file or a directory of images goes through the same stages as
+attendance_taker: FaceGate (motion + Haar) -> FaceTracker -> embed_crops
+(MTCNN + FaceNet via DeepFace.represent) -> FaceRecognitionCore.match_batch ->
+LocalStore attendance writes, against a fixture gallery (a .gal snapshot or a
+local database). Stages run inline in this process, one frame at a time, so
+each one's time is measured on its own; the tracker and motion gate run on
+video time, so results do not depend on replay speed.
+
+Reports frames/sec, per-stage time (decode, detect, embed, match, db_write:
+queueing attendance plus the periodic flushes the classroom loop does),
+peak memory and, given a ground-truth CSV (`user_id` column, optionally
+`first_seen_s`), attendance precision/recall and time to recognition.
+
+    python replay.py class.mp4 --gallery gallery_snapshot.gal --truth class_truth.csv
+    python replay.py frames/ --fps 10 --gallery local_database.db --realtime --output run.json
+    python replay.py class.mp4 --gallery g.gal --truth t.csv --compare baseline.json
+"""
+import argparse
+import csv
+import json
+import os
+import resource
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import cv2
+import numpy as np
+
+from attendance_taker import RECOGNITION_INTERVAL, GATE_ENABLED, TRACKING_ENABLED, FACE_INDEX_KIND, FACE_INDEX_PARAMS
+from face_gate import FaceGate
+from face_tracker import FaceTracker
+from local_store import LocalStore
+from pipeline import StageStats, embed_crops, embed_frame
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'shared'))
+from model_manager import get_model_manager
+
+from recognition_core import FaceRecognitionCore
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.bmp')
+STAGES = ('decode', 'detect', 'embed', 'match', 'db_write')
+REPLAY_SCHEDULE_ID = 0  # attendance rows written to the scratch database use this schedule
+
+
+def iter_frames(source, fps=None):
+    """Yield (video time in seconds, frame, seconds spent decoding it)."""
+    if os.path.isdir(source):
+        paths = sorted(os.path.join(source, name) for name in os.listdir(source) if name.lower().endswith(IMAGE_EXTENSIONS))
+        for index, path in enumerate(paths):
+            started = time.perf_counter()
+            frame = cv2.imread(path)
+            decode_s = time.perf_counter() - started
+            if frame is not None:
+                yield index / (fps or 10.0), frame, decode_s
+        return
+    cap = cv2.VideoCapture(source)
+    if not cap.isOpened():
+        raise SystemExit(f"❌ Cannot open {source}")
+    fps = fps or cap.get(cv2.CAP_PROP_FPS) or 25.0
+    index = 0
+    try:
+        while True:
+            started = time.perf_counter()
+            ok, frame = cap.read()
+            decode_s = time.perf_counter() - started
+            if not ok:
+                return
+            yield index / fps, frame, decode_s
+            index += 1
+    finally:
+        cap.release()
+
+
+def load_gallery(path):
+    recognizer = FaceRecognitionCore(index_kind=FACE_INDEX_KIND, index_params=FACE_INDEX_PARAMS)
+    if path.endswith('.gal'):
+        recognizer.load_snapshot(path)
+    else:
+        store = LocalStore(path)
+        try:
+            recognizer.load_known_faces(store.load_users())
+        finally:
+            store.conn.close()
+    return recognizer
+
+
+def load_truth(path):
+    """{user_id: first_seen_s or None} from a CSV with a user_id column."""
+    with open(path, newline='') as f:
+        return {int(row['user_id']): float(row['first_seen_s']) if row.get('first_seen_s') else None
+                for row in csv.DictReader(f) if row.get('user_id')}
+
+
+def score(recorded, truth):
+    """Attendance-level precision/recall of recorded {user_id: video time} against the ground truth."""
+    true_positive = set(recorded) & set(truth)
+    precision = len(true_positive) / len(recorded) if recorded else None
+    recall = len(true_positive) / len(truth) if truth else None
+    delays = [recorded[user_id] - truth[user_id] for user_id in true_positive if truth[user_id] is not None]
+    return {
+        'expected': len(truth),
+        'recorded': len(recorded),
+        'true_positives': len(true_positive),
+        'false_positives': sorted(set(recorded) - set(truth)),
+        'missed': sorted(set(truth) - set(recorded)),
+        'precision': round(precision, 4) if precision is not None else None,
+        'recall': round(recall, 4) if recall is not None else None,
+        'f1': round(2 * precision * recall / (precision + recall), 4) if precision and recall else 0.0,
+        'time_to_recognition_s': {
+            'mean': round(float(np.mean(delays)), 2), 'max': round(float(np.max(delays)), 2)
+        } if delays else None,
+    }
+
+
+def replay(source, gallery, truth=None, fps=None, realtime=False, sample_interval=RECOGNITION_INTERVAL,
+           gate_enabled=GATE_ENABLED, tracking_enabled=TRACKING_ENABLED, trace_memory=False, max_frames=None):
+    if trace_memory:
+        tracemalloc.start()
+    setup_started = time.perf_counter()
+    get_model_manager().load()
+    recognizer = load_gallery(gallery)
+    setup_s = time.perf_counter() - setup_started
+
+    stats = StageStats(report_interval=float('inf'))
+    gate = FaceGate(stats) if gate_enabled else None
+    tracker = FaceTracker() if gate and tracking_enabled else None
+    stage_seconds = dict.fromkeys(STAGES, 0.0)
+    counts = {'frames_read': 0, 'frames_processed': 0, 'faces_embedded': 0, 'faces_matched': 0, 'unknown_matches': 0}
+    recorded = {}  # user_id -> video time it was recorded
+
+    scratch_dir = tempfile.mkdtemp(prefix='replay_')
+    store = LocalStore(os.path.join(scratch_dir, 'replay.db'))
+    store.setup()
+
+    def record(user_id, video_time):
+        if user_id not in recorded:
+            started = time.perf_counter()
+            store.queue_attendance(user_id, REPLAY_SCHEDULE_ID)
+            stage_seconds['db_write'] += time.perf_counter() - started
+            recorded[user_id] = video_time
+
+    wall_started = time.perf_counter()
+    next_sample = 0.0
+    for video_time, frame, decode_s in iter_frames(source, fps):
+        if max_frames and counts['frames_read'] >= max_frames:
+            break
+        counts['frames_read'] += 1
+        stage_seconds['decode'] += decode_s
+        if realtime:
+            ahead = video_time - (time.perf_counter() - wall_started)
+            if ahead > 0:
+                time.sleep(ahead)
+        if video_time < next_sample:
+            continue
+        next_sample = video_time + sample_interval
+        counts['frames_processed'] += 1
+
+        # attendance_taker's loop flushes buffered attendance on every pass; so does the replay.
+        started = time.perf_counter()
+        store.maybe_flush_attendance()
+        stage_seconds['db_write'] += time.perf_counter() - started
+
+        payload, track_ids = frame, None
+        if gate:
+            started = time.perf_counter()
+            boxes, payload = gate.process(frame, video_time)
+            if tracker and boxes is not None:
+                tracks = tracker.update(boxes, video_time)
+                wanted = [i for i, track in enumerate(tracks) if tracker.needs_recognition(track, video_time)]
+                payload = [payload[i] for i in wanted]
+                track_ids = [tracks[i].id for i in wanted]
+            stage_seconds['detect'] += time.perf_counter() - started
+            if not len(payload):
+                continue
+
+        started = time.perf_counter()
+        embeddings = embed_crops(payload) if gate else embed_frame(payload)
+        stage_seconds['embed'] += time.perf_counter() - started
+        counts['faces_embedded'] += len(embeddings)
+        rows = np.flatnonzero(~np.isnan(embeddings).any(axis=1)) if len(embeddings) else []
+        if not len(rows):
+            continue
+
+        started = time.perf_counter()
+        matches = recognizer.match_batch(embeddings[rows])
+        stage_seconds['match'] += time.perf_counter() - started
+        counts['faces_matched'] += len(matches)
+        for index, match in zip(rows, matches):
+            if match.user_id is None:
+                counts['unknown_matches'] += 1
+            if track_ids is None:
+                if match.user_id:
+                    record(match.user_id, video_time)
+                continue
+            track = tracker.add_vote(track_ids[int(index)], match)
+            if track:
+                record(track.user_id, video_time)
+
+    started = time.perf_counter()
+    store.close()
+    stage_seconds['db_write'] += time.perf_counter() - started
+    shutil.rmtree(scratch_dir, ignore_errors=True)
+    wall_s = time.perf_counter() - wall_started
+
+    memory = {'max_rss_mb': round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)}
+    if trace_memory:
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        memory['tracemalloc_peak_mb'] = round(peak / 1e6, 1)
+
+    report = {
+        'source': source,
+        'gallery': gallery,
+        'gallery_users': int(len(np.unique(recognizer.known_ids))),
+        'config': {'realtime': realtime, 'sample_interval_s': sample_interval, 'gate': bool(gate),
+                   'tracking': bool(tracker), 'threshold': recognizer.threshold},
+        'setup_s': round(setup_s, 2),
+        'wall_s': round(wall_s, 2),
+        'video_s': round(video_time, 2) if counts['frames_read'] else 0.0,
+        'counts': counts,
+        'fps': {
+            'read': round(counts['frames_read'] / wall_s, 2) if wall_s else None,
+            'processed': round(counts['frames_processed'] / wall_s, 2) if wall_s else None,
+        },
+        'stages': {
+            name: {'total_s': round(seconds, 3),
+                   'per_frame_ms': round(1000 * seconds / max(counts['frames_read' if name == 'decode' else 'frames_processed'], 1), 2),
+                   'share': round(seconds / wall_s, 3) if wall_s else None}
+            for name, seconds in stage_seconds.items()
+        },
+        'gate': {name: stage['count'] for name, stage in stats.snapshot().items()},
+        'memory': memory,
+        'recorded': {str(user_id): round(t, 2) for user_id, t in sorted(recorded.items())},
+    }
+    if truth is not None:
+        report['accuracy'] = score(recorded, truth)
+    return report
+
+
+def print_report(report):
+    print(f"\n🎞️  {report['source']}: {report['counts']['frames_read']} frames ({report['video_s']:.1f}s of video) "
+          f"in {report['wall_s']:.1f}s; gallery of {report['gallery_users']} students, setup {report['setup_s']:.1f}s")
+    print(f"   {report['fps']['read']} frames/s read, {report['fps']['processed']} frames/s through the pipeline")
+    for name, stage in report['stages'].items():
+        share = f"{stage['share']:.0%}" if stage['share'] is not None else '-'
+        print(f"   {name:9} {stage['total_s']:9.3f}s  {stage['per_frame_ms']:8.2f} ms/frame  {share:>5}")
+    print(f"   memory: " + ", ".join(f"{k}={v}" for k, v in report['memory'].items()))
+    accuracy = report.get('accuracy')
+    if accuracy:
+        print(f"   precision {accuracy['precision']}  recall {accuracy['recall']}  f1 {accuracy['f1']}  "
+              f"({accuracy['true_positives']}/{accuracy['expected']} found, {len(accuracy['false_positives'])} false)")
+        if accuracy['false_positives']:
+            print(f"   ❌ false positives: {accuracy['false_positives']}")
+        if accuracy['missed']:
+            print(f"   ❌ missed: {accuracy['missed']}")
+
+
+def compare(report, baseline, tolerance):
+    """Names of the metrics that got worse than the baseline by more than `tolerance`."""
+    regressions = []
+    fps, base_fps = report['fps']['processed'], baseline.get('fps', {}).get('processed')
+    if fps and base_fps and fps < base_fps * (1 - tolerance):
+        regressions.append(f'fps {base_fps} -> {fps}')
+    for metric in ('precision', 'recall'):
+        value = (report.get('accuracy') or {}).get(metric)
+        base = (baseline.get('accuracy') or {}).get(metric)
+        if value is not None and base is not None and value < base:
+            regressions.append(f'{metric} {base} -> {value}')
+    return regressions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Replay a recorded class through the recognition pipeline.")
+    parser.add_argument('source', help="video file or directory of images")
+    parser.add_argument('--gallery', required=True, help="gallery fixture: .gal snapshot or local database file")
+    parser.add_argument('--truth', help="ground-truth CSV with user_id (and optional first_seen_s) columns")
+    parser.add_argument('--fps', type=float, help="frame rate of an image directory (or override the video's)")
+    parser.add_argument('--realtime', action='store_true', help="replay at recorded speed instead of as fast as possible")
+    parser.add_argument('--sample-interval', type=float, default=RECOGNITION_INTERVAL,
+                        help="seconds of video between frames offered to the pipeline (0 = every frame)")
+    parser.add_argument('--no-gate', action='store_true', help="embed whole frames instead of gated face crops")
+    parser.add_argument('--no-tracking', action='store_true', help="record on single matches instead of track votes")
+    parser.add_argument('--trace-memory', action='store_true', help="also report the tracemalloc peak (slower)")
+    parser.add_argument('--max-frames', type=int)
+    parser.add_argument('--output', help="write the report as JSON")
+    parser.add_argument('--compare', metavar='BASELINE', help="report JSON to compare against")
+    parser.add_argument('--tolerance', type=float, default=0.1, help="allowed frames/sec drop against the baseline")
+    args = parser.parse_args()
+
+    report = replay(args.source, args.gallery, truth=load_truth(args.truth) if args.truth else None, fps=args.fps,
+                    realtime=args.realtime, sample_interval=args.sample_interval, gate_enabled=not args.no_gate,
+                    tracking_enabled=not args.no_tracking, trace_memory=args.trace_memory, max_frames=args.max_frames)
+    print_report(report)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+        print(f"Saved {args.output}")
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(report, json.load(f), args.tolerance)
+        if regressions:
+            print(f"❌ Worse than {args.compare}: {'; '.join(regressions)}")
+            sys.exit(1)
+        print(f"✅ No regression against {args.compare}.")
@@ -1,87 +1,271 @@
+"""
+Sync daemon for the classroom client: pushes local attendance and pulls users,
+schedules and the gallery snapshot from the central server.
+
+- One pooled, keep-alive HTTP session for every request.
+- Syncs every ACTIVE_SYNC_INTERVAL seconds while a class in the local
+  timetable is running and for POST_CLASS_MINUTES after it ends, otherwise
+  every IDLE_SYNC_INTERVAL.
+- While the server is unreachable (or erroring) the interval backs off
+  exponentially with jitter, up to BACKOFF_MAX.
+- Between syncs the unsynced attendance backlog is checked every
+  BACKLOG_CHECK_INTERVAL seconds and pushed right away once it reaches
+  BACKLOG_PUSH_THRESHOLD rows.
+- The pull cursor, device id and gallery ETag live in the local database's
+  sync_state table and are written in the same transaction as the data they
+  describe. An old sync_config.json is imported once and renamed.
+"""
+import os
+import sys
+import random
 import requests
-import sqlite3
+from requests.adapters import HTTPAdapter
 import json
 import time
+import base64
+import uuid
+from local_store import LocalStore, get_sync_state, set_sync_state
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'shared'))
+from gallery_snapshot import read_snapshot
 import datetime
 
 CENTRAL_SERVER_URL = "http://127.0.0.1:5000"
 LOCAL_DB_PATH = 'local_database.db'
-CONFIG_FILE = 'sync_config.json'
-SYNC_INTERVAL = 900 # 15 minutes
+LEGACY_CONFIG_FILE = 'sync_config.json' # imported into sync_state on first start
+IDLE_SYNC_INTERVAL = 900 # 15 minutes outside class hours
+ACTIVE_SYNC_INTERVAL = 60 # during a class and just after it
+POST_CLASS_MINUTES = 15 # how long after a class ends the active interval still applies
+BACKOFF_BASE = 30 # seconds after the first failed sync, doubled per further failure
+BACKOFF_MAX = 1800
+BACKLOG_CHECK_INTERVAL = 10 # seconds between checks of the unsynced attendance count
+BACKLOG_PUSH_THRESHOLD = 200 # unsynced rows that trigger an immediate push
+REQUEST_TIMEOUT = 15
+PUSH_BATCH_SIZE = 1000 # attendance records per request
+PULL_PAGE_SIZE = 500 # changes per page of /api/sync/changes
+SYNC_DEPARTMENT = None # e.g. 'BCT' to only sync one department's users and schedules
+SYNC_YEAR = None # e.g. 2080 to also restrict to one batch
+GALLERY_SNAPSHOT_PATH = 'gallery_snapshot.gal' # memory-mapped by attendance_taker at startup
+
+def make_session():
+    session = requests.Session()
+    # Retries are the scheduler's job (with backoff); the adapter only pools connections.
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=4, max_retries=0)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+http = make_session()
 
-def get_last_sync_time():
+def import_legacy_config(conn, path=LEGACY_CONFIG_FILE):
+    """Move sync_config.json (cursor, device id, gallery ETag) into sync_state, once."""
     try:
-        with open(CONFIG_FILE, 'r') as f:
-            return json.load(f).get('last_sync_time')
-    except (FileNotFoundError, json.JSONDecodeError):
-        return None
+        with open(path, 'r') as f:
+            config = json.load(f)
+    except FileNotFoundError:
+        return
+    except json.JSONDecodeError:
+        config = {}
+    with conn:
+        for key in ('sync_cursor', 'device_id', 'gallery_etag'):
+            if config.get(key) is not None and get_sync_state(conn, key) is None:
+                set_sync_state(conn, key, config[key])
+    os.replace(path, f"{path}.imported")
+    print(f"Imported {path} into the local sync_state table.")
 
-def set_last_sync_time(sync_time):
-    with open(CONFIG_FILE, 'w') as f:
-        json.dump({'last_sync_time': sync_time}, f)
+def get_device_id(conn):
+    # Stable per-kiosk id; the server deduplicates pushed records on (device_id, local id).
+    device_id = get_sync_state(conn, 'device_id')
+    if not device_id:
+        device_id = str(uuid.uuid4())
+        with conn:
+            set_sync_state(conn, 'device_id', device_id)
+    return device_id
 
-def sync_data():
-    print(f"[{datetime.datetime.now()}] Starting sync process...")
-    conn = sqlite3.connect(LOCAL_DB_PATH)
+def unsynced_backlog(conn):
+    return conn.execute("SELECT COUNT(*) FROM attendance WHERE synced = 0").fetchone()[0]
+
+def push_attendance(conn):
+    """Push unsynced attendance in batches; only rows the server confirms are marked synced.
+
+    Returns False if the server could not be reached or refused a batch.
+    """
     cursor = conn.cursor()
-    
-    # --- PUSH local attendance records to the central server ---
-    cursor.execute("SELECT id, user_id, schedule_id, timestamp FROM attendance WHERE synced = 0")
-    records_to_push = cursor.fetchall()
-    if records_to_push:
-        payload = {'records': [{'id': r[0], 'user_id': r[1], 'schedule_id': r[2], 'timestamp': r[3]} for r in records_to_push]}
+    device_id = get_device_id(conn)
+    while True:
+        cursor.execute("SELECT id, user_id, schedule_id, timestamp FROM attendance WHERE synced = 0 ORDER BY id LIMIT ?", (PUSH_BATCH_SIZE,))
+        records_to_push = cursor.fetchall()
+        if not records_to_push:
+            return True
+        payload = {
+            'device_id': device_id,
+            'records': [{'id': r[0], 'user_id': r[1], 'schedule_id': r[2], 'timestamp': r[3]} for r in records_to_push]
+        }
         try:
-            response = requests.post(f"{CENTRAL_SERVER_URL}/api/sync/attendance", json=payload, timeout=15)
-            if response.status_code == 200:
-                print(f"Successfully pushed {len(records_to_push)} attendance records.")
-                ids_to_update = tuple(r[0] for r in records_to_push)
-                placeholders = ', '.join('?' for _ in ids_to_update)
-                query = f"UPDATE attendance SET synced = 1 WHERE id IN ({placeholders})"
-                cursor.execute(query, ids_to_update)
-                conn.commit()
-            else:
-                print(f"Error pushing attendance data: {response.status_code} - {response.text}")
+            response = http.post(f"{CENTRAL_SERVER_URL}/api/sync/attendance", json=payload, timeout=REQUEST_TIMEOUT)
         except requests.exceptions.RequestException as e:
             print(f"Network error while pushing attendance: {e}")
+            return False
+        if response.status_code != 200:
+            print(f"Error pushing attendance data: {response.status_code} - {response.text}")
+            return False
+        results = response.json().get('results', [])
+        stored = [(r['id'],) for r in results if r['status'] in ('accepted', 'duplicate')]
+        # Rejected rows (unknown user/schedule, bad data) would fail again; park them as -1.
+        rejected = [(r['id'],) for r in results if r['status'] == 'rejected' and r.get('id') is not None]
+        with conn:
+            cursor.executemany("UPDATE attendance SET synced = 1 WHERE id = ?", stored)
+            cursor.executemany("UPDATE attendance SET synced = -1 WHERE id = ?", rejected)
+        print(f"Pushed {len(records_to_push)} attendance records: {len(stored)} stored, {len(rejected)} rejected.")
+        if not stored and not rejected:
+            return True
+
+def sync_data(conn):
+    """One full push + pull; returns False if the server was unreachable or answered with an error."""
+    print(f"[{datetime.datetime.now()}] Starting sync process...")
 
-    # --- PULL updates (users, schedules) from the central server ---
-    params = {'last_sync_time': get_last_sync_time()}
+    # --- PUSH local attendance records to the central server ---
+    pushed = push_attendance(conn)
+
+    # --- PULL changes (users, schedules) from the central server, page by page ---
     try:
-        response = requests.get(f"{CENTRAL_SERVER_URL}/api/sync/get_updates", params=params, timeout=15)
-        if response.status_code == 200:
-            data = response.json()
-            updates = data.get('updates', {})
-            
-            # Update local users table
-            users_to_update = updates.get('users', [])
-            if users_to_update:
-                for user in users_to_update:
-                    cursor.execute("INSERT OR REPLACE INTO users (id, name, embeddings) VALUES (?, ?, ?)", 
-                                   (user['id'], user['name'], json.dumps(user.get('embeddings', []))))
-                print(f"Synced {len(users_to_update)} user records.")
-            
-            # Update local schedules table
-            schedules_to_update = updates.get('schedules', [])
-            if schedules_to_update:
-                for s in schedules_to_update:
-                    cursor.execute("INSERT OR REPLACE INTO schedules (id, subject_name, day_of_week, start_time, end_time) VALUES (?, ?, ?, ?, ?)", 
-                                   (s['id'], s['subject_name'], s['day_of_week'], s['start_time'], s['end_time']))
-                print(f"Synced {len(schedules_to_update)} schedule records.")
-
-            conn.commit()
-            set_last_sync_time(data.get('server_time'))
-            print("Sync successful. Updated last sync time.")
-        else:
-            print(f"Error pulling updates: {response.status_code} - {response.text}")
+        if not pull_changes(conn):
+            return False
+        return fetch_gallery_snapshot(conn) and pushed
     except requests.exceptions.RequestException as e:
         print(f"Network error while pulling updates: {e}")
     except Exception as e:
         print(f"An unexpected error occurred during sync: {e}")
+    return False
+
+def apply_changes_page(conn, changes, next_cursor):
+    """Apply one feed page and advance the cursor past it in a single transaction."""
+    user_upserts, user_deletes, schedule_upserts, schedule_deletes = [], [], [], []
+    for change in changes:
+        data = change.get('data')
+        if change['entity'] == 'user':
+            if change['op'] == 'upsert':
+                blob = base64.b64decode(data['embeddings_blob']) if data.get('embeddings_blob') else None
+                user_upserts.append((data['id'], data['name'], blob))
+            else:
+                user_deletes.append((change['id'],))
+        elif change['entity'] == 'schedule':
+            if change['op'] == 'upsert':
+                schedule_upserts.append((data['id'], data['subject_name'], data['day_of_week'], data['start_time'], data['end_time']))
+            else:
+                schedule_deletes.append((change['id'],))
+    with conn:
+        conn.executemany("INSERT OR REPLACE INTO users (id, name, embeddings) VALUES (?, ?, ?)", user_upserts)
+        conn.executemany("DELETE FROM users WHERE id = ?", user_deletes)
+        conn.executemany("INSERT OR REPLACE INTO schedules (id, subject_name, day_of_week, start_time, end_time) VALUES (?, ?, ?, ?, ?)", schedule_upserts)
+        conn.executemany("DELETE FROM schedules WHERE id = ?", schedule_deletes)
+        set_sync_state(conn, 'sync_cursor', next_cursor)
+    return len(user_upserts) + len(schedule_upserts), len(user_deletes) + len(schedule_deletes)
+
+def partition_params():
+    params = {}
+    if SYNC_DEPARTMENT:
+        params['department'] = SYNC_DEPARTMENT
+    if SYNC_YEAR:
+        params['year'] = SYNC_YEAR
+    return params
+
+def pull_changes(conn):
+    cursor = int(get_sync_state(conn, 'sync_cursor', 0))
+    params = {'limit': PULL_PAGE_SIZE, **partition_params()}
+    upserted = deleted = 0
+    while True:
+        # requests asks for gzip and decodes it transparently.
+        response = http.get(f"{CENTRAL_SERVER_URL}/api/sync/changes", params={**params, 'cursor': cursor}, timeout=REQUEST_TIMEOUT)
+        if response.status_code != 200:
+            print(f"Error pulling updates: {response.status_code} - {response.text}")
+            return False
+        page = response.json()
+        cursor = page['next_cursor']
+        page_upserted, page_deleted = apply_changes_page(conn, page.get('changes', []), cursor)
+        upserted += page_upserted
+        deleted += page_deleted
+        if not page.get('has_more'):
+            break
+    print(f"Sync successful: {upserted} record(s) updated, {deleted} removed. Cursor at {cursor}.")
+    return True
+
+def mark_snapshot_current(conn, local_version, etag=None):
+    with conn:
+        conn.execute("INSERT OR REPLACE INTO table_versions (name, version) VALUES ('gallery_snapshot', ?)", (local_version,))
+        if etag is not None:
+            set_sync_state(conn, 'gallery_etag', etag)
+
+def fetch_gallery_snapshot(conn):
+    """Download the department's gallery snapshot if its version changed (conditional GET).
+
+    Returns False if the server answered with an error.
+    """
+    # Read before downloading: the snapshot then covers at least every user pulled so far.
+    local_version = conn.execute("SELECT COALESCE(MAX(seq), 0) FROM user_changes").fetchone()[0]
+    headers = {}
+    etag = get_sync_state(conn, 'gallery_etag')
+    if etag and os.path.exists(GALLERY_SNAPSHOT_PATH):
+        headers['If-None-Match'] = f'"{etag}"'
+    response = http.get(f"{CENTRAL_SERVER_URL}/api/sync/gallery", params=partition_params(), headers=headers, timeout=60, stream=True)
+    if response.status_code == 304:
+        mark_snapshot_current(conn, local_version)
+        return True
+    if response.status_code != 200:
+        print(f"Error fetching gallery snapshot: {response.status_code} - {response.text}")
+        return False
+    tmp_path = f"{GALLERY_SNAPSHOT_PATH}.tmp"
+    with open(tmp_path, 'wb') as f:
+        for chunk in response.iter_content(chunk_size=1 << 16):
+            f.write(chunk)
+    try:
+        snapshot = read_snapshot(tmp_path, verify=True)
+    except ValueError as e:
+        print(f"Discarding downloaded gallery snapshot: {e}")
+        os.remove(tmp_path)
+        return True
+    version = snapshot.version
+    del snapshot
+    os.replace(tmp_path, GALLERY_SNAPSHOT_PATH)
+    mark_snapshot_current(conn, local_version, response.headers.get('ETag', '').strip('"'))
+    print(f"Gallery snapshot updated to version {version}.")
+    return True
+
+def next_sync_delay(store, failures, now=None):
+    """Seconds until the next full sync: backoff after failures, else by class schedule."""
+    if failures:
+        delay = min(BACKOFF_MAX, BACKOFF_BASE * 2 ** (failures - 1))
+        # Jitter so kiosks that lost the server together do not return in lockstep.
+        return delay * random.uniform(0.5, 1.0)
+    if store.class_in_window(now, POST_CLASS_MINUTES):
+        return ACTIVE_SYNC_INTERVAL
+    return IDLE_SYNC_INTERVAL
+
+def run_daemon(path=LOCAL_DB_PATH):
+    store = LocalStore(path)
+    store.setup()
+    conn = store.conn
+    import_legacy_config(conn)
+    failures = 0
+    next_sync = time.monotonic()
+    try:
+        while True:
+            if time.monotonic() >= next_sync:
+                failures = 0 if sync_data(conn) else failures + 1
+                delay = next_sync_delay(store, failures)
+                next_sync = time.monotonic() + delay
+                print(f"Next sync in {delay:.0f} seconds{f' (backing off after {failures} failure(s))' if failures else ''}.")
+            elif not failures:
+                backlog = unsynced_backlog(conn)
+                if backlog >= BACKLOG_PUSH_THRESHOLD:
+                    print(f"[{datetime.datetime.now()}] {backlog} unsynced attendance record(s); pushing now.")
+                    if not push_attendance(conn):
+                        failures = 1
+                        next_sync = time.monotonic() + next_sync_delay(store, failures)
+            time.sleep(max(0.0, min(BACKLOG_CHECK_INTERVAL, next_sync - time.monotonic())))
     finally:
-        conn.close()
+        http.close()
+        store.close()
 
 if __name__ == '__main__':
-    while True:
-        sync_data()
-        print(f"Next sync in {SYNC_INTERVAL} seconds.")
-        time.sleep(SYNC_INTERVAL)
\ No newline at end of file
+    run_daemon()
@@ -0,0 +1,70 @@
+import json
+import math
+import struct
+
+import numpy as np
+
+# Packed layout (little endian):
+#   magic 'EMB1' | dim u16 | count u16 | model name length u16 | model name | padding | float32[count * dim]
+# The header is padded to a multiple of 4 bytes so the float block stays aligned
+# for np.frombuffer.
+MAGIC = b'EMB1'
+HEADER = struct.Struct('<4sHHH')
+DEFAULT_MODEL = 'FaceNet'
+MAX_DIM = MAX_COUNT = 0xFFFF  # u16 header fields
+
+
+def _header_size(model_bytes):
+    size = HEADER.size + len(model_bytes)
+    return size + (-size % 4)
+
+
+def check_embeddings(embeddings):
+    """Return `embeddings` if it is a JSON list of equally long lists of numbers that fits a blob, else raise ValueError."""
+    if not isinstance(embeddings, list) or not all(isinstance(row, list) for row in embeddings):
+        raise ValueError('embeddings must be a list of embeddings (lists of numbers)')
+    if len({len(row) for row in embeddings}) > 1:
+        raise ValueError('embeddings must all have the same length')
+    if len(embeddings) > MAX_COUNT or (embeddings and len(embeddings[0]) > MAX_DIM):
+        raise ValueError(f'at most {MAX_COUNT} embeddings of at most {MAX_DIM} values')
+    for row in embeddings:
+        for value in row:
+            if isinstance(value, bool) or not isinstance(value, (int, float)) or not math.isfinite(value):
+                raise ValueError('embedding values must be finite numbers')
+    return embeddings
+
+
+def pack_embeddings(embeddings, model_name=DEFAULT_MODEL):
+    """Pack a list of equally sized embeddings into one blob. Returns None for no embeddings."""
+    matrix = np.asarray(embeddings, dtype='<f4')
+    if matrix.size == 0:
+        return None
+    matrix = np.atleast_2d(matrix)
+    model_bytes = model_name.encode('utf-8')
+    header = HEADER.pack(MAGIC, matrix.shape[1], matrix.shape[0], len(model_bytes)) + model_bytes
+    header += b'\0' * (_header_size(model_bytes) - len(header))
+    return header + matrix.tobytes()
+
+
+def read_header(blob):
+    """Return (model_name, dim, count, data_offset) of a packed blob."""
+    magic, dim, count, model_len = HEADER.unpack_from(blob)
+    if magic != MAGIC:
+        raise ValueError("Not a packed embedding blob")
+    model_bytes = bytes(blob[HEADER.size:HEADER.size + model_len])
+    return model_bytes.decode('utf-8'), dim, count, _header_size(model_bytes)
+
+
+def unpack_embeddings(blob):
+    """Zero-copy (count, dim) float32 view over a packed blob."""
+    _, dim, count, offset = read_header(blob)
+    return np.frombuffer(blob, dtype='<f4', count=count * dim, offset=offset).reshape(count, dim)
+
+
+def decode_embeddings(value):
+    """Decode a stored embeddings value: packed blob, legacy JSON text, or NULL."""
+    if not value:
+        return np.empty((0, 0), dtype=np.float32)
+    if isinstance(value, str):
+        return np.atleast_2d(np.asarray(json.loads(value), dtype=np.float32))
+    return unpack_embeddings(value)
@@ -0,0 +1,136 @@
+"""
+Versioned binary face gallery snapshot, built by the backend per department/year
+and memory-mapped by classroom clients.
+
+Layout (little endian):
+    header (HEADER, padded to HEADER_SIZE bytes)
+    float32[rows * dim]  L2-normalized embeddings, rows of one user contiguous
+    padding to 8 bytes
+    int64[rows]          user id of each row
+    utf-8 JSON           {"model": ..., "names": {"<user id>": "<name>", ...}, ...}
+
+`version` is the last change_log seq the snapshot includes and `checksum` is
+the SHA-256 of everything after the header.
+"""
+import hashlib
+import json
+import os
+import struct
+import tempfile
+
+import numpy as np
+
+MAGIC = b'GAL1'
+FORMAT_VERSION = 1
+# magic | format version u16 | dim u16 | rows u32 | meta length u32 | version u64 | sha256
+HEADER = struct.Struct('<4sHHIIQ32s')
+HEADER_SIZE = 64
+DEFAULT_MODEL = 'FaceNet'
+
+
+class GallerySnapshot:
+    def __init__(self, version, embeddings, ids, names, meta, checksum):
+        self.version = version
+        self.embeddings = embeddings
+        self.ids = ids
+        self.names = names  # {user_id: name}
+        self.meta = meta
+        self.checksum = checksum
+
+    @property
+    def etag(self):
+        return f'{self.version}-{self.checksum[:16]}'
+
+    def row_names(self):
+        return np.asarray([self.names.get(int(user_id)) for user_id in self.ids], dtype=object)
+
+
+def _normalize(matrix):
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return matrix / norms
+
+
+def _ids_offset(rows, dim):
+    end = HEADER_SIZE + rows * dim * 4
+    return end + (-end % 8)
+
+
+def write_snapshot(path, embeddings, ids, names, version, model_name=DEFAULT_MODEL, **meta):
+    """Atomically write a snapshot; embeddings are normalized here. Returns its checksum."""
+    ids = np.ascontiguousarray(ids, dtype='<i8')
+    embeddings = np.asarray(embeddings, dtype='<f4')
+    dim = embeddings.shape[1] if embeddings.ndim == 2 and len(ids) else 0
+    embeddings = np.ascontiguousarray(_normalize(embeddings.reshape(len(ids), dim)), dtype='<f4') if dim else embeddings[:0]
+    meta = dict(meta, model=model_name, names={str(int(user_id)): name for user_id, name in names.items()})
+    meta_bytes = json.dumps(meta, separators=(',', ':')).encode('utf-8')
+
+    body_padding = b'\0' * (_ids_offset(len(ids), dim) - HEADER_SIZE - embeddings.nbytes)
+    digest = hashlib.sha256()
+    for part in (embeddings.tobytes(), body_padding, ids.tobytes(), meta_bytes):
+        digest.update(part)
+
+    header = HEADER.pack(MAGIC, FORMAT_VERSION, dim, len(ids), len(meta_bytes), version, digest.digest())
+    # A temp file of its own, so concurrent writers never share one.
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)),
+                                    prefix=os.path.basename(path) + '.', suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(header + b'\0' * (HEADER_SIZE - len(header)))
+            f.write(embeddings.tobytes())
+            f.write(body_padding)
+            f.write(ids.tobytes())
+            f.write(meta_bytes)
+        os.chmod(tmp_path, 0o644)  # mkstemp creates it owner-only; snapshots are served and shared
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    return digest.hexdigest()
+
+
+def read_header(path):
+    """Return (version, dim, rows, meta_length, checksum hex) without reading the body."""
+    with open(path, 'rb') as f:
+        raw = f.read(HEADER.size)
+    if len(raw) < HEADER.size:
+        raise ValueError(f"{path} is not a gallery snapshot")
+    magic, format_version, dim, rows, meta_length, version, checksum = HEADER.unpack(raw)
+    if magic != MAGIC:
+        raise ValueError(f"{path} is not a gallery snapshot")
+    if format_version != FORMAT_VERSION:
+        raise ValueError(f"Unsupported gallery snapshot format {format_version}")
+    return version, dim, rows, meta_length, checksum.hex()
+
+
+def verify_snapshot(path):
+    _, dim, rows, meta_length, checksum = read_header(path)
+    expected_size = _ids_offset(rows, dim) + rows * 8 + meta_length
+    if os.path.getsize(path) != expected_size:
+        return False
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        f.seek(HEADER_SIZE)
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest() == checksum
+
+
+def read_snapshot(path, verify=False):
+    """Open a snapshot with its embedding and id arrays memory-mapped (read-only)."""
+    if verify and not verify_snapshot(path):
+        raise ValueError(f"Gallery snapshot {path} failed its checksum")
+    version, dim, rows, meta_length, checksum = read_header(path)
+    ids_offset = _ids_offset(rows, dim)
+    if rows and dim:
+        embeddings = np.memmap(path, dtype='<f4', mode='r', offset=HEADER_SIZE, shape=(rows, dim))
+        ids = np.memmap(path, dtype='<i8', mode='r', offset=ids_offset, shape=(rows,))
+    else:
+        embeddings = np.empty((0, 0), dtype=np.float32)
+        ids = np.empty(0, dtype=np.int64)
+    with open(path, 'rb') as f:
+        f.seek(ids_offset + rows * 8)
+        meta = json.loads(f.read(meta_length).decode('utf-8'))
+    names = {int(user_id): name for user_id, name in meta.pop('names', {}).items()}
+    return GallerySnapshot(version, embeddings, ids, names, meta, checksum)
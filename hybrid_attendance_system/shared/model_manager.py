@@ -0,0 +1,137 @@
+"""
+Loads the face detector and embedding model once per process and keeps them warm.
+
+DeepFace builds FaceNet and MTCNN lazily on the first represent() call, and
+importing it pulls in TensorFlow, so the first recognition after a boot used to
+take several seconds. ModelManager.load() pays all of that up front, records
+how long each step took, and embed()/embed_faces() reuse the built models.
+detect_faces() + embed_aligned() split detection from embedding so callers
+can run the recognition model once over a whole batch of faces.
+"""
+import threading
+import time
+
+import numpy as np
+
+MODEL_NAME = 'FaceNet'
+DETECTOR_BACKEND = 'mtcnn'
+EMBEDDING_DIM = 128
+WARMUP_IMAGE_SIZE = 160
+
+
+class ModelManager:
+    def __init__(self, model_name=MODEL_NAME, detector_backend=DETECTOR_BACKEND):
+        self.model_name = model_name
+        self.detector_backend = detector_backend
+        self.timings = {}
+        self._deepface = None
+        self._model = None
+        self._lock = threading.Lock()
+
+    @property
+    def ready(self):
+        return self._deepface is not None
+
+    def load(self, warmup=True):
+        """Import DeepFace, build the models and run one dummy inference. Safe to call repeatedly."""
+        with self._lock:
+            if self._deepface is not None:
+                return self.timings
+            started = time.perf_counter()
+            from deepface import DeepFace
+            self.timings['import_s'] = time.perf_counter() - started
+
+            started = time.perf_counter()
+            try:
+                self._model = DeepFace.build_model(task='facial_recognition', model_name=self.model_name)
+            except TypeError:
+                # deepface < 0.0.90 takes the model name only.
+                self._model = DeepFace.build_model(self.model_name)
+            self.timings['build_model_s'] = time.perf_counter() - started
+
+            if warmup:
+                # The first pass through TensorFlow and the detector is the slow one.
+                dummy = np.zeros((WARMUP_IMAGE_SIZE, WARMUP_IMAGE_SIZE, 3), dtype=np.uint8)
+                started = time.perf_counter()
+                DeepFace.represent(img_path=dummy, model_name=self.model_name,
+                                   detector_backend=self.detector_backend, enforce_detection=False)
+                self.timings['warmup_s'] = time.perf_counter() - started
+            self._deepface = DeepFace
+        return self.timings
+
+    def represent(self, image, detector_backend=None, enforce_detection=False):
+        self.load()
+        return self._deepface.represent(
+            img_path=image, model_name=self.model_name,
+            detector_backend=detector_backend or self.detector_backend, enforce_detection=enforce_detection
+        )
+
+    def detect_faces(self, image, detector_backend=None):
+        """Aligned faces in a BGR image: dicts with 'face' (RGB float in [0, 1]), 'facial_area' and 'confidence'."""
+        self.load()
+        faces = self._deepface.extract_faces(
+            img_path=image, detector_backend=detector_backend or self.detector_backend,
+            enforce_detection=False, align=True
+        )
+        # Without enforce_detection a miss comes back as the whole image with confidence 0.
+        return [face for face in faces if face.get('confidence', 0) > 0]
+
+    def embed_aligned(self, faces, normalization='base'):
+        """One forward pass of the recognition model over aligned faces from detect_faces(); (n, dim) float32.
+
+        Each face is prepared exactly as DeepFace.represent prepares it (back
+        to BGR, letterboxed to the model's input size, normalized), so the rows
+        are interchangeable with represent()'s embeddings.
+        """
+        self.load()
+        if not len(faces):
+            return np.empty((0, EMBEDDING_DIM), dtype=np.float32)
+        from deepface.modules import preprocessing
+        width, height = self._model.input_shape
+        batch = np.concatenate([
+            # Normalized one face at a time: some normalizations use the image's own mean.
+            preprocessing.normalize_input(
+                img=preprocessing.resize_image(img=np.asarray(face)[:, :, ::-1], target_size=(height, width)),
+                normalization=normalization)
+            for face in faces
+        ])
+        # FacialRecognition.forward() only returns the first row; call the Keras model on the batch.
+        embeddings = self._model.model(batch, training=False)
+        return np.asarray(embeddings, dtype=np.float32).reshape(len(faces), -1)
+
+    def embed(self, frames, detector_backend=None, enforce_detection=False):
+        """Return one (faces, dim) float32 array per frame."""
+        batch = []
+        for frame in frames:
+            results = self.represent(frame, detector_backend, enforce_detection)
+            embeddings = [face_data['embedding'] for face_data in results if face_data.get('embedding')]
+            batch.append(np.asarray(embeddings, dtype=np.float32).reshape(-1, EMBEDDING_DIM))
+        return batch
+
+    def embed_faces(self, crops, detector_backend=None):
+        """One embedding row per face crop (the largest face in it), NaN where none was found."""
+        detector_backend = detector_backend or self.detector_backend
+        embeddings = np.full((len(crops), EMBEDDING_DIM), np.nan, dtype=np.float32)
+        for i, crop in enumerate(crops):
+            results = self.represent(crop, detector_backend)
+            if detector_backend != 'skip':
+                # Without enforce_detection a miss comes back as the whole crop with confidence 0.
+                results = [r for r in results if r.get('face_confidence', 1) > 0]
+            if not results:
+                continue
+            largest = max(results, key=lambda r: r['facial_area']['w'] * r['facial_area']['h'])
+            embeddings[i] = largest['embedding']
+        return embeddings
+
+
+_manager = None
+_manager_lock = threading.Lock()
+
+
+def get_model_manager():
+    """Process-wide ModelManager; each pool worker process gets its own."""
+    global _manager
+    with _manager_lock:
+        if _manager is None:
+            _manager = ModelManager()
+        return _manager
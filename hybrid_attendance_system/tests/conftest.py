@@ -0,0 +1,10 @@
+import os
+import sys
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+for package in ('shared', 'classroom_client', 'backend_server'):
+    sys.path.insert(0, os.path.join(ROOT, package))
+
+# database opens ATTENDANCE_DB_PATH at import time; keep tests off the real one.
+os.environ.setdefault('ATTENDANCE_DB_PATH', os.path.join(tempfile.mkdtemp(prefix='attendance_tests_'), 'test.db'))
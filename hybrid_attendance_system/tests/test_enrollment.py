@@ -0,0 +1,98 @@
+import time
+
+import numpy as np
+import pytest
+
+import enrollment
+from database import create_db
+
+
+class StubPool:
+    def __init__(self, workers):
+        self.workers = workers
+        self.shut_down = False
+
+    def shutdown(self):
+        self.shut_down = True
+
+
+def test_web_pool_is_small_and_stops_when_idle(monkeypatch):
+    monkeypatch.setattr(enrollment, 'make_pool', StubPool)
+    monkeypatch.setattr(enrollment, 'ENROLL_POOL_IDLE_SECONDS', 0.1)
+
+    with enrollment.enrollment_pool() as first:
+        assert first.workers == enrollment.ENROLL_SERVER_WORKERS == 1
+    with enrollment.enrollment_pool() as second:
+        assert second is first
+        time.sleep(0.2)
+        assert not first.shut_down  # in use
+    time.sleep(0.3)
+    assert first.shut_down
+
+    with enrollment.enrollment_pool() as third:
+        assert third is not first
+    enrollment._pool_idle_timer.cancel()
+
+
+def face(person, seed):
+    """A FaceNet-sized embedding: one direction per person plus a little per-image noise."""
+    base = np.random.default_rng(person).normal(size=128)
+    return (base + np.random.default_rng(seed + 1000).normal(scale=0.1, size=128)).astype(np.float32)
+
+
+class EmbeddingPool:
+    """Stands in for the process pool: an image's bytes name the person and image it shows."""
+
+    def map(self, fn, batches):
+        assert fn is enrollment.embed_images
+        for batch in batches:
+            results = []
+            for key, data in batch:
+                person, seed = map(int, data.decode().split(':'))
+                results.append({'key': key, 'embedding': face(person, seed), 'quality': {}, 'reason': None})
+            yield results
+
+
+def images(*faces):
+    return [(f'{i}.jpg', f'{person}:{seed}'.encode()) for i, (person, seed) in enumerate(faces)]
+
+
+def enroll(students, gallery=None, intake=None):
+    if gallery is None:
+        gallery = (np.empty(0, dtype=np.int64), np.empty((0, 0), dtype=np.float32))
+    return enrollment.enroll_students(students, pool=EmbeddingPool(), dry_run=True, intake=intake, gallery=gallery)
+
+
+@pytest.fixture(autouse=True)
+def database():
+    create_db()
+
+
+def test_an_image_of_someone_else_is_dropped():
+    report, = enroll({1: images((10, 0), (10, 1), (10, 2), (11, 0))})
+    assert (report['status'], report['embeddings']) == ('enrolled', 3)
+    assert [image['accepted'] for image in report['images']] == [True, True, True, False]
+    assert report['images'][3]['reason'] == "does not match the student's other images"
+
+
+def test_two_images_of_different_people_are_rejected():
+    report, = enroll({1: images((10, 0), (11, 0))})
+    assert (report['status'], report['reason']) == ('rejected', 'images do not show the same person')
+
+
+def test_a_face_already_in_the_gallery_is_rejected():
+    rows = enrollment._normalize(np.vstack([face(20, 5), face(21, 5)]))
+    gallery = (np.array([99, 2]), rows)
+    duplicate, own = enroll({1: images((20, 0), (20, 1)), 2: images((21, 0), (21, 1))}, gallery)
+    assert duplicate['status'] == 'rejected'
+    assert duplicate['reason'].startswith('face already enrolled for user 99')
+    assert own['status'] == 'enrolled'  # re-enrolling a student is not a duplicate of themselves
+
+
+def test_a_face_enrolled_twice_in_one_intake_is_rejected_across_rounds():
+    intake = {'ids': [], 'rows': []}
+    first, = enroll({1: images((30, 0), (30, 1))}, intake=intake)
+    second, other = enroll({2: images((30, 2), (30, 3)), 3: images((31, 0), (31, 1))}, intake=intake)
+    assert first['status'] == 'enrolled' and other['status'] == 'enrolled'
+    assert second['status'] == 'rejected'
+    assert second['reason'].startswith('face already enrolled for user 1')
@@ -0,0 +1,103 @@
+import pytest
+
+import event_stream
+from database import Session, create_db
+from event_stream import EventBroker, EventLogPoller, iter_stream
+
+
+def stream(events, department='BCT', year=2080, last_event_id=None):
+    lines = iter_stream(department, year, last_event_id, events=events, heartbeat=0.01, max_seconds=5)
+    assert next(lines).startswith(b'retry:')
+    return lines
+
+
+def event_ids(chunk):
+    return [line[4:].decode() for line in chunk.split(b'\n') if line.startswith(b'id: ')]
+
+
+@pytest.fixture
+def broker():
+    return EventBroker(backlog=4, epoch='test')
+
+
+def test_publish_reaches_the_class_and_department_wide(broker):
+    lines = stream(broker)
+    assert next(lines) == b': heartbeat\n\n'
+
+    for_class = broker.publish('notice', 'BCT', 2080, {'message': 'class'})
+    broker.publish('notice', 'BCT', 2081, {'message': 'other year'})
+    broker.publish('notice', 'BEX', 2080, {'message': 'other department'})
+    for_department = broker.publish('schedule', 'BCT', None, {'message': 'department'})
+
+    chunk = next(lines)
+    assert event_ids(chunk) == [for_class, for_department]
+    assert b'event: notice\n' in chunk and b'event: schedule\n' in chunk
+    assert b'other' not in chunk
+
+
+def test_resume_from_last_event_id(broker):
+    first = broker.publish('notice', 'BCT', 2080, {'n': 1})
+    second = broker.publish('notice', 'BCT', 2080, {'n': 2})
+    third = broker.publish('notice', 'BCT', None, {'n': 3})
+
+    assert event_ids(next(stream(broker, last_event_id=first))) == [second, third]
+    assert next(stream(broker, last_event_id=third)) == b': heartbeat\n\n'
+
+
+def test_backlog_overflow_and_unknown_ids_resync(broker):
+    first = broker.publish('notice', 'BCT', 2080, {'n': 0})
+    for n in range(1, 6):
+        broker.publish('notice', 'BCT', 2080, {'n': n})
+
+    for stale in (first, 'before-restart-3', 'garbage'):
+        lines = stream(broker, last_event_id=stale)
+        assert next(lines).startswith(b'event: resync\n')
+        # Then live from the newest event on.
+        assert next(lines) == b': heartbeat\n\n'
+
+
+def test_memory_backend_publishes_on_commit(monkeypatch, broker):
+    monkeypatch.setattr(event_stream, 'EVENT_BACKEND', 'memory')
+    monkeypatch.setattr(event_stream, 'broker', broker)
+    db_session = Session()
+    try:
+        event_stream.publish(db_session, 'notice', 'BCT', 2080, {'n': 1})
+        db_session.rollback()
+        assert broker.latest() == 0
+        event_stream.publish(db_session, 'notice', 'BCT', 2080, {'n': 2})
+        assert broker.latest() == 0
+        db_session.commit()
+        assert broker.latest() == 1
+    finally:
+        db_session.close()
+
+
+def test_event_log_reaches_every_process(monkeypatch):
+    create_db()
+    monkeypatch.setattr(event_stream, 'EVENT_BACKEND', 'database')
+    workers = [EventBroker(backlog=4), EventBroker(backlog=4)]
+    pollers = [EventLogPoller(events) for events in workers]
+    for poller in pollers:
+        poller.preload()
+    lines = [stream(events) for events in workers]
+    for worker_lines in lines:
+        assert next(worker_lines) == b': heartbeat\n\n'
+
+    db_session = Session()
+    event_stream.publish(db_session, 'notice', 'BCT', 2080, {'message': 'rolled back'})
+    db_session.rollback()
+    event_stream.publish(db_session, 'notice', 'BCT', 2080, {'message': 'shared'})
+    for poller in pollers:
+        assert poller.poll() == 0  # not committed yet
+    db_session.commit()
+    db_session.close()
+    for poller in pollers:
+        assert poller.poll() == 1
+    event_id = str(workers[0].latest())
+
+    for worker_lines in lines:
+        assert event_ids(next(worker_lines)) == [event_id]
+    # A new process resumes from the id another one issued.
+    late = EventBroker(backlog=4)
+    EventLogPoller(late).preload()
+    assert late.resume_point(event_id) == int(event_id)
@@ -0,0 +1,46 @@
+import multiprocessing
+import os
+
+import numpy as np
+
+import gallery_snapshots
+from database import Session, User, create_db, pack_embeddings
+from gallery_snapshot import read_snapshot, verify_snapshot
+
+
+def add_students(department, count, start=0):
+    rng = np.random.default_rng(start)
+    db_session = Session()
+    for i in range(start, start + count):
+        db_session.add(User(name=f'student {i}', email=f'{department}{i}@example.com', password_hash='x',
+                            department=department, year=2080,
+                            embeddings=pack_embeddings(rng.normal(size=(2, 128)).tolist())))
+    db_session.commit()
+    db_session.close()
+
+
+def enroll_and_refresh(department, worker, rounds):
+    for i in range(rounds):
+        add_students(department, 1, start=1000 * (worker + 1) + i)
+        gallery_snapshots.refresh_snapshot(department, 2080)
+
+
+def test_workers_refreshing_one_partition_at_once(monkeypatch, tmp_path):
+    create_db()
+    monkeypatch.setattr(gallery_snapshots, 'SNAPSHOT_DIR', str(tmp_path))
+    add_students('SNAP', 500)
+    gallery_snapshots.refresh_snapshot('SNAP', 2080)
+
+    # Forked like gunicorn workers, each enrolling students and rewriting the snapshot.
+    context = multiprocessing.get_context('fork')
+    workers = [context.Process(target=enroll_and_refresh, args=('SNAP', worker, 10)) for worker in range(4)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join(60)
+    assert [worker.exitcode for worker in workers] == [0] * len(workers)
+
+    path = gallery_snapshots.snapshot_path('SNAP', 2080)
+    assert verify_snapshot(path)
+    assert len(read_snapshot(path).names) == 540
+    assert not [name for name in os.listdir(tmp_path) if name.endswith('.tmp')]
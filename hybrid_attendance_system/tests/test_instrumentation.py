@@ -0,0 +1,63 @@
+from flask import Flask, Response
+
+import instrumentation
+
+
+def make_app():
+    app = Flask(__name__)
+    instrumentation.init_app(app)
+
+    @app.route('/stream')
+    def stream():
+        return Response(iter([b': hello\n\n', b': bye\n\n']), mimetype='text/event-stream')
+
+    return app
+
+
+def test_event_streams_are_counted_not_timed(monkeypatch):
+    monkeypatch.setattr(instrumentation, 'metrics', instrumentation.Metrics())
+    monkeypatch.setattr(instrumentation, 'PROFILE_SLOW_MS', 0.0)
+    monkeypatch.setattr(instrumentation, 'PROFILE_SAMPLE_RATE', 1.0)
+    logged = []
+    monkeypatch.setattr(instrumentation.log, 'log', lambda *args, **kwargs: logged.append(args))
+    client = make_app().test_client()
+
+    response = client.get('/stream')
+    route = instrumentation.metrics.routes[('GET', '/stream')]
+    assert route.streams_open == 1
+    assert not instrumentation._profiling.locked()  # the sampled profiler was dropped, not held open
+    assert response.get_data() == b': hello\n\n: bye\n\n'
+    response.close()
+
+    assert (route.streams_opened, route.streams_open, route.latency_ms.count) == (1, 0, 0)
+    assert dict(route.statuses) == {200: 1}
+    assert not logged
+    assert 'http_event_streams_total{method="GET",route="/stream"} 1' in instrumentation.metrics.prometheus()
+
+
+def test_metrics_add_up_across_workers(monkeypatch, tmp_path):
+    worker = instrumentation.Metrics()
+    worker.record_request(('GET', '/api/notices/<int:user_id>'), 200, 12.0, 2, 0.5, 100)
+    worker.record_stream(('GET', '/api/events/<int:user_id>'), 200)
+    exited = worker.state()
+    exited['pid'] = 2 ** 22 + 1  # above pid_max: no such process
+    (tmp_path / 'exited.json').write_text(instrumentation.json.dumps(exited))
+
+    monkeypatch.setattr(instrumentation, 'metrics', instrumentation.Metrics())
+    instrumentation.metrics.record_request(('GET', '/api/notices/<int:user_id>'), 304, 3.0, 1, 0.1, 0)
+    instrumentation.metrics.record_stream(('GET', '/api/events/<int:user_id>'), 200)
+
+    combined = instrumentation.service_metrics(str(tmp_path))
+    notices = combined.routes[('GET', '/api/notices/<int:user_id>')]
+    assert notices.latency_ms.count == 2 and dict(notices.statuses) == {200: 1, 304: 1}
+    assert notices.sql_statements.sum == 3
+    events = combined.routes[('GET', '/api/events/<int:user_id>')]
+    assert (events.streams_opened, events.streams_open) == (2, 1)  # the exited worker's stream is gone
+
+
+def test_metrics_are_refused_through_the_proxy(monkeypatch):
+    monkeypatch.setattr(instrumentation, 'METRICS_DIR', None)
+    client = make_app().test_client()
+    assert client.get('/metrics').status_code == 200
+    assert client.get('/metrics', headers={'X-Forwarded-For': '203.0.113.9'}).status_code == 403
+    assert client.get('/metrics', environ_base={'REMOTE_ADDR': '203.0.113.9'}).status_code == 403
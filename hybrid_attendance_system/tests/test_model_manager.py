@@ -0,0 +1,30 @@
+import numpy as np
+import pytest
+
+pytest.importorskip('deepface')
+
+from model_manager import ModelManager
+
+
+def cosine(a, b):
+    a, b = np.asarray(a, dtype=np.float64), np.asarray(b, dtype=np.float64)
+    return float(a @ b / (np.linalg.norm(a) * np.linalg.norm(b)))
+
+
+@pytest.fixture(scope='module')
+def manager():
+    manager = ModelManager()
+    manager.load(warmup=False)
+    return manager
+
+
+def test_embed_aligned_matches_represent(manager):
+    # Not square, so a stretch instead of represent()'s letterbox would show.
+    image = np.random.default_rng(0).integers(0, 256, (200, 150, 3), dtype=np.uint8)
+    expected = manager.represent(image, detector_backend='skip')[0]['embedding']
+    face = manager._deepface.extract_faces(img_path=image, detector_backend='skip', enforce_detection=False)[0]['face']
+
+    embeddings = manager.embed_aligned([face, face[::-1]])
+
+    assert embeddings.shape == (2, len(expected))
+    assert cosine(embeddings[0], expected) == pytest.approx(1.0, abs=1e-5)
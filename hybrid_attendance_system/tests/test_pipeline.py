@@ -0,0 +1,22 @@
+import numpy as np
+import pytest
+
+pytest.importorskip('deepface')
+
+from pipeline import embed_crops, embed_crops_batched
+
+
+def test_batched_crops_match_unbatched():
+    rng = np.random.default_rng(1)
+    crops = [rng.integers(30, 256, shape, dtype=np.uint8) for shape in ((160, 120, 3), (200, 200, 3), (96, 140, 3))]
+    crops.append(np.zeros((120, 120, 3), dtype=np.uint8))  # no face: a NaN row from both
+
+    expected = embed_crops(crops)
+    batched = embed_crops_batched(crops)
+
+    assert batched.shape == expected.shape
+    np.testing.assert_array_equal(np.isnan(batched).any(axis=1), np.isnan(expected).any(axis=1))
+    found = ~np.isnan(expected).any(axis=1)
+    expected, batched = expected[found], batched[found]
+    similarity = np.sum(expected * batched, axis=1) / (np.linalg.norm(expected, axis=1) * np.linalg.norm(batched, axis=1))
+    np.testing.assert_allclose(similarity, 1.0, atol=1e-5)
@@ -0,0 +1,6 @@
+from database import create_db, check_query_plans
+
+
+def test_endpoint_queries_use_their_indexes():
+    create_db()
+    assert check_query_plans() == []
@@ -0,0 +1,46 @@
+from flask import Flask
+
+from database import Session, create_db
+from response_cache import ResponseCache, cached_json_response, invalidate_shared
+
+app = Flask(__name__)
+
+
+def fetch(cache, key, payload, etag=None):
+    headers = {'If-None-Match': etag} if etag else {}
+    with app.test_request_context(headers=headers):
+        return cached_json_response(key, lambda: payload, cache=cache)
+
+
+def test_a_write_in_one_process_invalidates_every_process():
+    create_db()
+    workers = [ResponseCache(), ResponseCache()]
+    key = ('notices', 'CIV', 2080, None, None)
+    etags = [fetch(cache, key, ['old']).get_etag()[0] for cache in workers]
+    for cache in workers:
+        assert fetch(cache, key, ['old']).headers['X-Cache'] == 'HIT'
+
+    db_session = Session()
+    invalidate_shared(db_session, [('notices', 'CIV')])  # a department-wide notice
+    db_session.commit()
+    db_session.close()
+
+    for cache, etag in zip(workers, etags):
+        response = fetch(cache, key, ['new'], etag)
+        assert response.status_code == 200 and response.headers['X-Cache'] == 'MISS'
+        assert response.get_json() == ['new']
+        assert fetch(cache, key, ['new']).headers['X-Cache'] == 'HIT'
+
+
+def test_rolled_back_writes_invalidate_nothing():
+    create_db()
+    cache = ResponseCache()
+    key = ('schedules', 'CIV', 2081)
+    fetch(cache, key, ['kept'])
+
+    db_session = Session()
+    invalidate_shared(db_session, [('schedules', 'CIV', 2081), ('attendance', 7)])
+    db_session.rollback()
+    db_session.close()
+
+    assert fetch(cache, key, ['rebuilt']).headers['X-Cache'] == 'HIT'
@@ -0,0 +1,42 @@
+import pytest
+
+from app import app
+from database import Session, User, create_db, decode_embeddings
+
+
+@pytest.fixture
+def client():
+    create_db()
+    return app.test_client()
+
+
+def signup(client, email, embeddings):
+    return client.post('/api/signup', json={'name': 'S', 'email': email, 'password': 'pw', 'department': 'SIGN',
+                                            'year': 2080, 'embeddings': embeddings})
+
+
+@pytest.mark.parametrize('embeddings', [
+    [[0.1, 0.2], [0.3]],  # ragged
+    [[[0.1, 0.2]], [[0.3, 0.4]]],  # nested too deep
+    [0.1, 0.2],  # not a list of embeddings
+    'embeddings',
+    [[0.1, 'x']],
+    [[True, False]],
+    [[0.0] * 65536],
+])
+def test_malformed_embeddings_are_a_bad_request(client, embeddings):
+    response = signup(client, 'bad@example.com', embeddings)
+    assert response.status_code == 400
+    assert 'error' in response.get_json()
+
+
+def test_embeddings_are_stored_packed(client):
+    response = signup(client, 'good@example.com', [[0.5, 1], [2, -0.25]])
+    assert response.status_code == 201
+    db_session = Session()
+    try:
+        user = db_session.get(User, response.get_json()['id'])
+        assert decode_embeddings(user.embeddings).tolist() == [[0.5, 1.0], [2.0, -0.25]]
+    finally:
+        db_session.close()
+    assert signup(client, 'none@example.com', []).status_code == 201